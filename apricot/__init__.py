@@ -17,5 +17,7 @@ from .functions import BaseGraphSelection
 from .functions import CustomSelection
 from .functions import CustomGraphSelection
 
+from .utils import SimilarityGraph
+
 
 __version__ = '0.6.1'
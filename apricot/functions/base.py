@@ -6,7 +6,12 @@ This file contains code that implements the core of the submodular selection
 algorithms.
 """
 
+import os
+import math
 import numpy
+import asyncio
+import functools
+import threading
 from tqdm import tqdm
 
 from ..optimizers import BaseOptimizer
@@ -18,11 +23,20 @@ from ..optimizers import StochasticGreedy
 from ..optimizers import BidirectionalGreedy
 from ..optimizers import GreeDi
 from ..optimizers import SieveGreedy
+from ..optimizers import PreemptionGreedy
 from ..optimizers import OPTIMIZERS
 
 from ..utils import PriorityQueue
 from ..utils import check_random_state
 from ..utils import _calculate_pairwise_distances
+from ..utils import _keep_nearest_neighbors
+from ..utils import _rechunk
+from ..utils import _prefetch
+from ..utils import _read_chunks
+from ..utils import _RowBlocks
+from ..utils import _open_row_blocks
+from ..utils import SimilarityCache
+from ..utils import SimilarityGraph
 
 from scipy.sparse import csr_matrix
 
@@ -68,6 +82,38 @@ class BaseSelection(object):
 		and the values in the dictionary should be the values that these
 		parameters take. Default is None.
 
+	min_similarity : float or None
+		When constructing a similarity matrix, the smallest similarity value
+		that will be kept. Similarities are calculated one block of rows at a
+		time and smaller values are dropped as each block is calculated. The
+		result is a sparse similarity matrix whose density adapts to the data
+		rather than having a fixed number of neighbors for each example.
+		Cannot be used together with `n_neighbors`. Default is None.
+
+	block_size : int or None
+		When constructing a dense similarity matrix, the number of rows whose
+		similarities are calculated at a time. The similarities are written
+		into the matrix block by block, using `n_jobs` threads, so that the
+		temporary memory used is proportional to the size of a block rather
+		than to the size of the matrix. If None, the matrix is calculated all
+		at once. Default is None.
+
+	packed : bool
+		Whether to store only the upper triangle of a dense similarity
+		matrix. Because the matrix is symmetric this halves the memory that it
+		takes, and full rows are read through the symmetry in blocks of
+		`block_size` rows whenever gains are calculated, which makes each
+		iteration somewhat slower. Cannot be used with `n_neighbors`,
+		`min_similarity` or a separate ground set. Default is False.
+
+	similarity_cache : str, os.PathLike, SimilarityCache or None
+		A directory, or an `apricot.utils.SimilarityCache` object, to store
+		similarity matrices built from feature matrices in. When a selector
+		is fit to the same data with the same metric and sparsification
+		parameters again, the similarity matrix is memory-mapped from the
+		cache instead of being recalculated. If None, nothing is cached.
+		Default is None.
+
 	reservoir : numpy.ndarray or None
 		The reservoir to use when calculating gains in the sieve greedy
 		streaming optimization algorithm in the `partial_fit` method.
@@ -145,6 +191,10 @@ class BaseSelection(object):
 		self.subset = None
 		self.sparse = None
 		self._X = None
+		self._graph = None
+		self.implicit = False
+		self._cancel = None
+		self._lock = None
 		
 		self.sieve_current_values_ = None
 		self.n_seen_ = 0
@@ -152,6 +202,8 @@ class BaseSelection(object):
 		self.reservoir = reservoir
 		self.max_reservoir_size = max_reservoir_size if reservoir is None else reservoir.shape[0]
 		self.update_reservoir_ = reservoir is None
+		self.reservoir_w_ = None
+		self.reservoir_next_ = None
 
 	def fit(self, X, y=None, sample_weight=None, sample_cost=None):
 		"""Run submodular optimization to select a subset of examples.
@@ -191,14 +243,20 @@ class BaseSelection(object):
 			The fit step returns this selector object.
 		"""
 
-		allowed_dtypes = list, numpy.ndarray, csr_matrix
+		allowed_dtypes = list, numpy.ndarray, csr_matrix, _RowBlocks
 
 		if not isinstance(X, allowed_dtypes):
 			raise ValueError("X must be either a list of lists, a 2D numpy " \
 				"array, or a scipy.sparse.csr_matrix.")
 		if isinstance(X, numpy.ndarray) and len(X.shape) != 2:
 			raise ValueError("X must have exactly two dimensions.")
-		if numpy.min(X) < 0.0 and numpy.max(X) > 0.:
+		if self._graph is not None:
+			negative = self._graph.min < 0. and self._graph.max > 0.
+		else:
+			negative = not self.implicit and numpy.min(X) < 0.0 and \
+				numpy.max(X) > 0.
+
+		if negative:
 			raise ValueError("X cannot contain negative values or must be entirely "\
 				"negative values.")
 		if self.n_samples > X.shape[0]:
@@ -231,7 +289,8 @@ class BaseSelection(object):
 		self.gains = numpy.array(self.gains)
 		return self
 
-	def partial_fit(self, X, y=None, sample_weight=None, sample_cost=None):
+	def partial_fit(self, X, y=None, sample_weight=None, sample_cost=None,
+		window=None):
 		allowed_dtypes = list, numpy.ndarray, csr_matrix
 
 		if not isinstance(X, allowed_dtypes):
@@ -244,10 +303,26 @@ class BaseSelection(object):
 			if X.dtype != 'float64':
 				X = X.astype('float64')
 
-		if not isinstance(self.optimizer, SieveGreedy):
+		if self.optimizer == 'preemption' or isinstance(self.optimizer, 
+			PreemptionGreedy):
+			if window is not None:
+				raise ValueError("A window can only be used with the sieve" \
+					" streaming optimizer.")
+
+			if isinstance(self.optimizer, str):
+				self.optimizer = OPTIMIZERS['preemption'](function=self, 
+					verbose=self.verbose, random_state=self.random_state,
+					**self.optimizer_kwds)
+		elif not isinstance(self.optimizer, SieveGreedy):
+			optimizer_kwds = dict(self.optimizer_kwds)
+			if window is not None:
+				optimizer_kwds['window'] = window
+
 			self.optimizer = OPTIMIZERS['sieve'](function=self, 
 				verbose=self.verbose, random_state=self.random_state,
-				**self.optimizer_kwds)
+				**optimizer_kwds)
+		elif window is not None and window != self.optimizer.window:
+			raise ValueError("The window cannot be changed during a stream.")
 
 		self._X = X if self._X is None else self._X
 		self._initialize(X)
@@ -265,6 +340,207 @@ class BaseSelection(object):
 		self._X = None
 		return self
 
+	def fit_stream(self, chunks, chunk_size=None, prefetch=2, window=None):
+		"""Run streaming submodular optimization on an iterable of chunks.
+
+		This method calls `partial_fit` on each chunk of data produced by an
+		iterable, such as a generator that reads batches from disk. The
+		next chunks are produced, cast to float64, and optionally resized to
+		`chunk_size` rows in a background thread while the current chunk is
+		being processed, so that at most `prefetch` chunks are held in memory
+		in addition to the one being processed.
+
+		Parameters
+		----------
+		chunks : iterable
+			An iterable of 2D numpy arrays, lists of lists, or CSR matrices
+			that all have the same number of columns.
+
+		chunk_size : int or None, optional
+			The number of rows to pass to each call of `partial_fit`. Chunks
+			from the iterable are split or concatenated to this size. If None,
+			the chunks are used as they come. Default is None.
+
+		prefetch : int, optional
+			The number of chunks to produce ahead of the one being processed.
+			If 0, chunks are produced in the calling thread. Default is 2.
+
+		window : int or None, optional
+			If given, only the `window` most recently seen examples can be
+			selected. See `partial_fit` for details. Default is None.
+
+		Returns
+		-------
+		self : BaseSelection
+			The fit step returns this selector object.
+		"""
+
+		for X in _prefetch(_rechunk(chunks, chunk_size), prefetch):
+			self.partial_fit(X, window=window)
+
+		return self
+
+	def partial_fit_from_file(self, path, chunk_rows=10000, prefetch=2, 
+		window=None):
+		"""Run streaming submodular optimization on a data set on disk.
+
+		This method reads a data set from disk in chunks of rows and calls
+		`partial_fit` on each chunk, so that the data set never has to fit in
+		memory. Dense .npy files are memory-mapped and each chunk is a view
+		into the file. Sparse .npz files must contain a CSR matrix, as written
+		by `scipy.sparse.save_npz`, and are read sequentially one chunk at a
+		time. Chunks are only cast to float64 if they are stored with a
+		different dtype. Chunks are read in a background thread, as in
+		`fit_stream`.
+
+		Parameters
+		----------
+		path : str or os.PathLike
+			The path to a .npy or .npz file.
+
+		chunk_rows : int, optional
+			The number of rows to pass to each call of `partial_fit`. Default
+			is 10000.
+
+		prefetch : int, optional
+			The number of chunks to read ahead of the one being processed.
+			If 0, chunks are read in the calling thread. Default is 2.
+
+		window : int or None, optional
+			If given, only the `window` most recently seen examples can be
+			selected. See `partial_fit` for details. Default is None.
+
+		Returns
+		-------
+		self : BaseSelection
+			The fit step returns this selector object.
+		"""
+
+		return self.fit_stream(_read_chunks(path, chunk_rows), 
+			prefetch=prefetch, window=window)
+
+	async def afit(self, X, y=None, sample_weight=None, sample_cost=None,
+		executor=None):
+		"""Run submodular optimization without blocking the event loop.
+
+		This coroutine runs the `fit` method in an executor so that the
+		event loop can continue to run while the selection is performed. The
+		compiled gain kernels release the GIL, so several selections can run
+		in parallel when a thread pool is used. If the coroutine is cancelled,
+		the selection stops before the next example is selected and the
+		cancellation is raised once the executor has finished, leaving the
+		selector partially fit.
+
+		Parameters
+		----------
+		X : list or numpy.ndarray, shape=(n, d)
+			The data set to transform. Must be numeric.
+
+		y : list or numpy.ndarray or None, shape=(n,), optional
+			The labels to transform. If passed in this function will return
+			both the data and th corresponding labels for the rows that have
+			been selected.
+
+		sample_weight : list or numpy.ndarray or None, shape=(n,), optional
+			The weight of each example. Currently ignored in apricot but
+			included to maintain compatibility with sklearn pipelines. 
+
+		sample_cost : list or numpy.ndarray or None, shape=(n,), optional
+			The cost of each item. If set, indicates that optimization should
+			be performed with respect to a knapsack constraint.
+
+		executor : concurrent.futures.Executor or None, optional
+			The executor to run the selection in. If None, the default
+			executor of the event loop is used. Default is None.
+
+		Returns
+		-------
+		self : BaseSelection
+			The fit step returns this selector object.
+		"""
+
+		return await self._run_in_executor(executor, self.fit, X, y=y,
+			sample_weight=sample_weight, sample_cost=sample_cost, 
+			cancel=True)
+
+	async def apartial_fit(self, X, y=None, sample_weight=None, 
+		sample_cost=None, window=None, executor=None):
+		"""Run streaming optimization on a batch without blocking the loop.
+
+		This coroutine runs the `partial_fit` method in an executor. Calls on
+		the same selector are processed one at a time in the order that they
+		were made, so awaiting this coroutine before producing the next
+		batch applies backpressure to the producer. If the coroutine is
+		cancelled, the cancellation is raised once the batch has been
+		processed, so that the streaming state stays consistent.
+
+		Parameters
+		----------
+		X : list or numpy.ndarray, shape=(n, d)
+			The batch of data. Must be numeric.
+
+		y : list or numpy.ndarray or None, shape=(n,), optional
+			Ignored, included to maintain compatibility with `partial_fit`.
+
+		sample_weight : list or numpy.ndarray or None, shape=(n,), optional
+			The weight of each example. Currently ignored in apricot but
+			included to maintain compatibility with sklearn pipelines. 
+
+		sample_cost : list or numpy.ndarray or None, shape=(n,), optional
+			The cost of each item. If set, indicates that optimization should
+			be performed with respect to a knapsack constraint.
+
+		window : int or None, optional
+			If given, only the `window` most recently seen examples can be
+			selected. See `partial_fit` for details. Default is None.
+
+		executor : concurrent.futures.Executor or None, optional
+			The executor to run the selection in. If None, the default
+			executor of the event loop is used. Default is None.
+
+		Returns
+		-------
+		self : BaseSelection
+			The fit step returns this selector object.
+		"""
+
+		return await self._run_in_executor(executor, self.partial_fit, X, 
+			y=y, sample_weight=sample_weight, sample_cost=sample_cost, 
+			window=window)
+
+	async def _run_in_executor(self, executor, func, *args, cancel=False,
+		**kwargs):
+		"""Run a method in an executor, one call at a time.
+
+		If `cancel` is True, cancelling the coroutine will stop the method
+		before the next example is selected. In either case, the coroutine
+		waits for the method to finish before the cancellation is raised.
+		"""
+
+		if self._lock is None:
+			self._lock = asyncio.Lock()
+
+		async with self._lock:
+			loop = asyncio.get_running_loop()
+			self._cancel = threading.Event() if cancel else None
+			future = loop.run_in_executor(executor, 
+				functools.partial(func, *args, **kwargs))
+
+			try:
+				return await asyncio.shield(future)
+			except asyncio.CancelledError:
+				if self._cancel is not None:
+					self._cancel.set()
+
+				try:
+					await future
+				except (asyncio.CancelledError, Exception):
+					pass
+
+				raise
+			finally:
+				self._cancel = None
+
 	def transform(self, X, y=None, sample_weight=None):
 		"""Transform a data set to include only the selected examples.
 
@@ -361,6 +637,146 @@ class BaseSelection(object):
 			sample_cost=sample_cost).transform(X, y=y, 
 			sample_weight=sample_weight)
 
+	def select_many(self, Xs, n_samples=None):
+		"""Run many small, independent selections in a single call.
+
+		This method is meant for workloads where many small selections need
+		to be made, such as selecting from a separate pool of candidates for
+		each query or each user. Calling `fit` on each pool individually
+		involves a fixed amount of Python overhead per call that can dominate
+		the time spent on small pools. Functions that support it will pack
+		the pools into a single array with offsets and run the naive greedy
+		algorithm on all of them in one parallel compiled kernel, with one
+		pool being handled by each thread. Other functions, and sparse pools,
+		fall back to calling `fit` on each pool.
+
+		The optimizer and initial subset of the selector are not used, and
+		the selector is left unfitted.
+
+		Parameters
+		----------
+		Xs : list of numpy.ndarray
+			The data sets to select from. Each must be two dimensional and,
+			for feature-based functions, they must have the same number of
+			columns.
+
+		n_samples : int or None, optional
+			The number of examples to select from each data set. If a data set
+			has fewer examples than this, all of its examples are ranked. If
+			None, use the `n_samples` of the selector. Default is None.
+
+		Returns
+		-------
+		rankings : list of numpy.ndarray
+			The selected examples from each data set, in the order that they
+			were selected.
+
+		gains : list of numpy.ndarray
+			The gain of each selected example when it was added to the
+			growing subset of its data set.
+		"""
+
+		n_samples = n_samples or self.n_samples
+
+		if self.initial_subset is not None:
+			raise ValueError("select_many does not support an initial subset.")
+
+		Xs_ = []
+		for X in Xs:
+			if isinstance(X, list):
+				X = numpy.array(X)
+			if len(X.shape) != 2:
+				raise ValueError("Each X must have exactly two dimensions.")
+			if not isinstance(X, csr_matrix) and X.dtype != 'float64':
+				X = X.astype('float64')
+
+			Xs_.append(X)
+
+		return self._select_many(Xs_, n_samples)
+
+	def _select_many(self, Xs, n_samples):
+		"""Select from each data set by calling `fit` on it in turn."""
+
+		k, optimizer = self.n_samples, self.optimizer
+		self.optimizer = 'naive'
+
+		rankings, gains = [], []
+		for X in Xs:
+			self.n_samples = min(n_samples, X.shape[0])
+			self._X = None
+			self.fit(X)
+
+			rankings.append(self.ranking)
+			gains.append(self.gains)
+
+		self.n_samples, self.optimizer = k, optimizer
+		self.ranking, self.gains, self._X = None, None, None
+		return rankings, gains
+
+	def refine(self, X, max_swaps=100, tol=1e-6):
+		"""Improve a fitted selection using local search swaps.
+
+		The greedy algorithm is a good starting point but usually leaves some
+		of the objective value on the table. This method will repeatedly find
+		the single swap of a selected example for an unselected one that most
+		increases the objective value and perform it, stopping once no swap
+		increases the objective by more than `tol` or `max_swaps` swaps have
+		been made. The examples in the initial subset are never swapped out.
+		The ranking is kept in the same order, with swapped-in examples taking
+		the place of the examples they replaced, and the gains are recomputed
+		with respect to this order.
+
+		Swaps are performed with respect to a cardinality constraint, so
+		this method should not be used after fitting with `sample_cost`.
+
+		Parameters
+		----------
+		X : list or numpy.ndarray, shape=(n, d)
+			The data set that the selector was fit to. Must be numeric.
+
+		max_swaps : int, optional
+			The maximum number of swaps to perform. Default is 100.
+
+		tol : float, optional
+			The minimum increase in the objective value that a swap must have
+			in order to be performed. Default is 1e-6.
+
+		Returns
+		-------
+		self : BaseSelection
+			The refine step returns this selector object.
+		"""
+
+		if self.ranking is None:
+			raise ValueError("The selector must be fit before it can be " \
+				"refined.")
+
+		if not self.sparse:
+			if X.dtype != 'float64':
+				X = X.astype('float64')
+
+		self._X = X if self._X is None else self._X
+
+		ranking = [int(idx) for idx in self.ranking]
+		self.n_swaps_ = 0
+
+		for _ in range(max_swaps):
+			gain, i, idx = self._calculate_swap_gains(X, ranking)
+			if i is None or gain <= tol:
+				break
+
+			ranking[i] = idx
+			self.n_swaps_ += 1
+
+		self._initialize(X)
+		for idx in ranking:
+			gain = self._calculate_gains(X, numpy.array([idx]))[0]
+			self._select_next(X[idx], gain, idx)
+
+		self.ranking = numpy.array(self.ranking)
+		self.gains = numpy.array(self.gains)
+		return self
+
 	def _initialize(self, X, idxs=None):
 		n, d = X.shape
 		self._X = X if self._X is None else self._X
@@ -399,6 +815,38 @@ class BaseSelection(object):
 	def _calculate_gains(self, X, idxs=None):
 		raise NotImplementedError
 
+	def _calculate_swap_gains(self, X, ranking):
+		"""Find the best swap of a selected example for an unselected one.
+
+		This generic implementation removes each selected example in turn,
+		rebuilds the internal statistics from the remaining examples, and
+		then evaluates every other example in a single `_calculate_gains`
+		call. Functions whose gains can be updated incrementally upon
+		removal should override this method.
+
+		Returns the change in objective value of the best swap, the position
+		in the ranking of the example to remove, and the index of the example
+		to add in its place.
+		"""
+
+		best_gain, best_i, best_idx = float("-inf"), None, None
+
+		for i, removed in enumerate(ranking):
+			self._initialize(X)
+			for idx in ranking[:i] + ranking[i+1:]:
+				self._select_next(X[idx], 0., idx)
+
+			gains = self._calculate_gains(X)
+			j = numpy.where(self.idxs == removed)[0][0]
+			gains = gains - gains[j]
+			gains[j] = float("-inf")
+
+			j = numpy.argmax(gains)
+			if gains[j] > best_gain:
+				best_gain, best_i, best_idx = gains[j], i, self.idxs[j]
+
+		return best_gain, best_i, best_idx
+
 	def _calculate_sieve_gains(self, X, thresholds, idxs):
 		n = X.shape[0]
 		d = X.shape[1] if self.reservoir is None else self.max_reservoir_size
@@ -415,8 +863,9 @@ class BaseSelection(object):
 				dtype='int64')
 			self.sieve_total_gains_ = numpy.zeros(l, 
 				dtype='float64')
-			self.sieve_subsets_ = numpy.zeros((l, self.n_samples, 
-				self._X.shape[1]), dtype='float64')
+			self.sieve_row_ids_ = numpy.zeros(0, dtype='int64')
+			self.sieve_rows_ = numpy.zeros((0, self._X.shape[1]), 
+				dtype='float64')
 		else:
 			j = l - self.sieve_current_values_.shape[0]
 			if j > 0:
@@ -432,17 +881,84 @@ class BaseSelection(object):
 					self.sieve_n_selected_, numpy.zeros(j, dtype='int64')])
 				self.sieve_total_gains_ = numpy.concatenate([
 					self.sieve_total_gains_, numpy.zeros(j, dtype='float64')])
-				self.sieve_subsets_ = numpy.concatenate([self.sieve_subsets_, 
-					numpy.zeros((j, self.n_samples, self._X.shape[1]), 
-						dtype='float64')])
+
+	def _prune_sieves(self, mask):
+		"""Discard the state of the sieves that are not in the mask."""
+
+		self.sieve_current_values_ = self.sieve_current_values_[mask]
+		self.sieve_selections_ = self.sieve_selections_[mask]
+		self.sieve_gains_ = self.sieve_gains_[mask]
+		self.sieve_n_selected_ = self.sieve_n_selected_[mask]
+		self.sieve_total_gains_ = self.sieve_total_gains_[mask]
+
+	def _get_sieve_state(self):
+		"""Return the state of the sieves."""
+
+		return {key: value for key, value in vars(self).items() 
+			if key.startswith('sieve_')}
+
+	def _set_sieve_state(self, state=None):
+		"""Set the state of the sieves.
+
+		If no state is given the sieves are reset and will be allocated again
+		when the next batch is seen.
+		"""
+
+		if state is None:
+			state = {'sieve_current_values_': None}
+
+		for key, value in state.items():
+			setattr(self, key, value)
+
+	def _update_sieve_rows(self, n_seen):
+		"""Update the store of rows that have been selected by the sieves.
+
+		The sieves only keep the indices of the items that they select. The
+		rows themselves are kept once, no matter how many sieves select them,
+		in a store that is sorted by index. This method adds the rows from the
+		current batch that were selected by at least one sieve and drops the
+		rows that are no longer selected by any sieve.
+
+		Parameters
+		----------
+		n_seen : int
+			The number of items seen before the current batch, i.e., the
+			index of the first row in the current batch.
+		"""
+
+		selections = self.sieve_selections_[self.sieve_selections_ >= 0]
+		selections = numpy.unique(selections)
+
+		keep = numpy.isin(self.sieve_row_ids_, selections)
+		new_ids = selections[selections >= n_seen]
+
+		if isinstance(self._X, csr_matrix):
+			new_rows = self._X[new_ids - n_seen].toarray()
+		else:
+			new_rows = self._X[new_ids - n_seen]
+
+		self.sieve_row_ids_ = numpy.concatenate([self.sieve_row_ids_[keep],
+			new_ids])
+		self.sieve_rows_ = numpy.concatenate([self.sieve_rows_[keep],
+			new_rows])
+
+	def _sieve_subset(self, i):
+		"""Return the rows that have been selected by the i-th sieve."""
+
+		selections = self.sieve_selections_[i, :self.sieve_n_selected_[i]]
+		idxs = numpy.searchsorted(self.sieve_row_ids_, selections)
+		return self.sieve_rows_[idxs]
 
 	def _select_next(self, X, gain, idx):
+		if self._cancel is not None and self._cancel.is_set():
+			raise asyncio.CancelledError()
+
 		self.ranking.append(idx)
 		self.gains.append(gain)
 		self.mask[idx] = True
 		self.idxs = numpy.where(self.mask == 0)[0]
 
-		if self.sparse:
+		if isinstance(self._X, csr_matrix):
 			X = self._X[idx:idx+1].toarray()
 		else:
 			X = self._X[idx:idx+1]
@@ -511,11 +1027,14 @@ class BaseGraphSelection(BaseSelection):
 		and the values in the dictionary should be the values that these
 		parameters take. Default is None.
 
-	n_neighbors : int or None
+	n_neighbors : int, NNDescent or None
 		When constructing a similarity matrix, the number of nearest neighbors
 		whose similarity values will be kept. The result is a sparse similarity
 		matrix which can significantly speed up computation at the cost of
-		accuracy. Default is None.
+		accuracy. An `apricot.utils.NNDescent` object can be passed in to
+		find approximate nearest neighbors, which is much faster for large
+		data sets. When streaming, the most similar examples in the reservoir
+		are kept for each example in the batch. Default is None.
 
 	reservoir : numpy.ndarray or None
 		The reservoir to use when calculating gains in the sieve greedy
@@ -561,9 +1080,16 @@ class BaseGraphSelection(BaseSelection):
 
 	def __init__(self, n_samples, metric='euclidean', 
 		initial_subset=None, optimizer='two-stage', optimizer_kwds={},
-		n_neighbors=None, reservoir=None, max_reservoir_size=1000, 
+		n_neighbors=None, min_similarity=None, block_size=None, packed=False,
+		similarity_cache=None, reservoir=None, max_reservoir_size=1000, 
 		n_jobs=1, random_state=None, verbose=False):
 
+		if n_neighbors is not None and min_similarity is not None:
+			raise ValueError("Only one of n_neighbors and min_similarity " \
+				"can be set.")
+		if packed and (n_neighbors is not None or min_similarity is not None):
+			raise ValueError("Only dense similarity matrices can be packed.")
+
 		super().__init__(n_samples=n_samples, 
 			initial_subset=initial_subset, optimizer=optimizer, 
 			optimizer_kwds=optimizer_kwds, reservoir=reservoir, 
@@ -572,9 +1098,17 @@ class BaseGraphSelection(BaseSelection):
 
 		self.metric = metric.replace("corr", "correlation")
 		self.n_neighbors = n_neighbors
+		self.min_similarity = min_similarity
+		self.block_size = block_size
+		self.packed = packed
 
+		if isinstance(similarity_cache, (str, os.PathLike)):
+			similarity_cache = SimilarityCache(similarity_cache)
+		self.similarity_cache = similarity_cache
+		self._X_ground = None
 
-	def fit(self, X, y=None, sample_weight=None, sample_cost=None):
+	def fit(self, X, y=None, sample_weight=None, sample_cost=None,
+		ground=None):
 		"""Run submodular optimization to select a subset of examples.
 
 		This method is a wrapper for the full submodular optimization process.
@@ -590,8 +1124,10 @@ class BaseGraphSelection(BaseSelection):
 
 		Parameters
 		----------
-		X : list or numpy.ndarray, shape=(n, d)
-			The data set to transform. Must be numeric.
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set to transform. Must be numeric. A `SimilarityGraph` can
+			also be passed in, in which case its similarity matrix is used
+			instead of building a new one.
 
 		y : list or numpy.ndarray or None, shape=(n,), optional
 			The labels to transform. If passed in this function will return
@@ -606,52 +1142,212 @@ class BaseGraphSelection(BaseSelection):
 			The cost of each item. If set, indicates that optimization should
 			be performed with respect to a knapsack constraint.
 
+		ground : list or numpy.ndarray or None, shape=(m, d), optional
+			The ground set that the selected examples should represent. If
+			passed in, examples are selected from X to represent the ground
+			set, and the similarity matrix has one row for each example in X
+			and one column for each example in the ground set. If None, X is
+			used as the ground set. Default is None.
+
 		Returns
 		-------
 		self : BaseGraphSelection
 			The fit step returns this selector object.
 		"""
 
+		if isinstance(X, SimilarityGraph):
+			if ground is not None:
+				raise ValueError("A ground set cannot be used with a " \
+					"similarity graph.")
+
+			self._graph = X
+			self._X = X.X
+			self._X_ground = None
+			return super().fit(X.X_pairwise, y=y,
+				sample_weight=sample_weight, sample_cost=sample_cost)
+
+		self._graph = None
 		if isinstance(X, csr_matrix) and self.metric not in ("precomputed", "ignore"):
 			raise ValueError("Must passed in a precomputed sparse " \
 				"similarity matrix or a dense feature matrix.")
 		if self.metric == 'precomputed' and X.shape[0] != X.shape[1]:
 			raise ValueError("Precomputed similarity matrices " \
 				"must be square and symmetric.")
-
-		X_pairwise = _calculate_pairwise_distances(X, metric=self.metric, 
-			n_neighbors=self.n_neighbors)
+		if self.packed and (isinstance(X, (csr_matrix, _RowBlocks)) or 
+			ground is not None):
+			raise ValueError("Only dense similarity matrices without a " \
+				"separate ground set can be packed.")
+
+		ground = self._check_ground(X, ground)
+		X_pairwise = _calculate_pairwise_distances(X, Y=ground, 
+			metric=self.metric, n_neighbors=self.n_neighbors, 
+			min_similarity=self.min_similarity, block_size=self.block_size, 
+			packed=self.packed, cache=self.similarity_cache, 
+			n_jobs=self.n_jobs)
 	
 		self._X = X
+		self._X_ground = ground
 		return super().fit(X_pairwise, y=y,
 			sample_weight=sample_weight, sample_cost=sample_cost)
 
-	def partial_fit(self, X, y=None, sample_weight=None, sample_cost=None):
+	def _graph_for(self, X_pairwise):
+		"""Return the similarity graph that a matrix comes from, if any.
+
+		Some optimizers, such as GreeDi, initialize the function on
+		submatrices, to which the statistics of the graph do not apply.
+		"""
+
+		if self._graph is not None and X_pairwise is self._graph.X_pairwise:
+			return self._graph
+		return None
+
+	def _open_row_blocks(self, X):
+		"""Open a similarity matrix stored on disk, if one is passed in."""
+
+		if not isinstance(X, (str, os.PathLike, numpy.memmap)):
+			return X
+
+		if self.metric != 'precomputed':
+			raise ValueError("Similarity matrices stored on disk must be " \
+				"used with metric='precomputed'.")
+
+		return _open_row_blocks(X)
+
+	def _check_ground(self, X, ground):
+		"""Check that a ground set can be used with a data set."""
+
+		if ground is None:
+			return None
+
+		if self.metric in ('precomputed', 'ignore'):
+			raise ValueError("A ground set can only be passed in with a " \
+				"feature matrix, not a precomputed similarity matrix.")
+		if not isinstance(ground, (list, numpy.ndarray)):
+			raise ValueError("The ground set must be either a list of lists " \
+				"or a 2D numpy array.")
+
+		ground = numpy.asarray(ground, dtype='float64')
+		if ground.ndim != 2 or ground.shape[1] != numpy.shape(X)[1]:
+			raise ValueError("The ground set must be a 2D array with the " \
+				"same number of features as X.")
+
+		return ground
+
+	def refine(self, X, max_swaps=100, tol=1e-6):
+		"""Improve a fitted selection using local search swaps.
+
+		See `BaseSelection.refine` for details. The data is converted to a
+		similarity matrix in the same way as in the `fit` method.
+
+		Parameters
+		----------
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set that the selector was fit to. Must be numeric. A
+			`SimilarityGraph` can also be passed in, in which case its
+			similarity matrix is used instead of building a new one.
+
+		max_swaps : int, optional
+			The maximum number of swaps to perform. Default is 100.
+
+		tol : float, optional
+			The minimum increase in the objective value that a swap must have
+			in order to be performed. Default is 1e-6.
+
+		Returns
+		-------
+		self : BaseGraphSelection
+			The refine step returns this selector object.
+		"""
+
+		if isinstance(X, SimilarityGraph):
+			self._graph = X
+			self._X = X.X
+			return super().refine(X.X_pairwise, max_swaps=max_swaps, tol=tol)
+
+		X_pairwise = _calculate_pairwise_distances(X, metric=self.metric,
+			n_neighbors=self.n_neighbors, min_similarity=self.min_similarity,
+			block_size=self.block_size, cache=self.similarity_cache, 
+			n_jobs=self.n_jobs)
+
+		self._graph = None
+		self._X = X
+		return super().refine(X_pairwise, max_swaps=max_swaps, tol=tol)
+
+	def partial_fit(self, X, y=None, sample_weight=None, sample_cost=None,
+		window=None):
+		if self.implicit:
+			raise ValueError("Similarities can only be calculated implicitly " \
+				"in the fit method.")
+
 		if self.reservoir is None:
 			self.reservoir = numpy.empty((self.max_reservoir_size, X.shape[1]))
 
 		if self.update_reservoir_:
-			for i in range(X.shape[0]):
-				if self.reservoir_size < self.max_reservoir_size:
-					self.reservoir[self.reservoir_size] = X[i]
-					self.reservoir_size += 1
-				else:
-					r = self.random_state.choice(self.n_seen_ + i)
-					if r < self.max_reservoir_size:
-						self.reservoir[r] = X[i]
-						#self.current_values_[:, r] = 0.
+			self._update_reservoir(X)
 
 		X_pairwise = _calculate_pairwise_distances(X, 
-			Y=self.reservoir[:self.reservoir_size], metric=self.metric)
+			Y=self.reservoir[:self.reservoir_size], metric=self.metric,
+			min_similarity=self.min_similarity, block_size=self.block_size, 
+			n_jobs=self.n_jobs)
+
+		if isinstance(self.n_neighbors, int):
+			X_pairwise = _keep_nearest_neighbors(X_pairwise, self.n_neighbors)
 
 		self._X = X
 		super().partial_fit(X_pairwise, y=y, 
-			sample_weight=sample_weight, sample_cost=sample_cost)
+			sample_weight=sample_weight, sample_cost=sample_cost,
+			window=window)
 
 		self.current_values = numpy.zeros(self.reservoir_size, 
 			dtype='float64')
 		self.n_seen_ += X.shape[0]
 
+	def _update_reservoir(self, X):
+		"""Add a batch of examples to the reservoir using Algorithm L.
+
+		Rather than drawing a random number for every example, Algorithm L
+		draws the number of examples to skip before the next replacement,
+		so the cost is proportional to the number of replacements instead
+		of the number of examples. The positions of all replacements in a
+		batch are found first and then applied in a single assignment.
+		"""
+
+		n, k = X.shape[0], self.max_reservoir_size
+
+		m = min(k - self.reservoir_size, n)
+		if m > 0:
+			self.reservoir[self.reservoir_size:self.reservoir_size+m] = X[:m]
+			self.reservoir_size += m
+
+		if self.reservoir_size < k:
+			return
+
+		if self.reservoir_w_ is None:
+			self.reservoir_w_ = math.exp(math.log(self._random_uniform()) / k)
+			self.reservoir_next_ = k + math.floor(math.log(
+				self._random_uniform()) / math.log(1 - self.reservoir_w_))
+
+		positions, rows = [], []
+		while self.reservoir_next_ < self.n_seen_ + n:
+			positions.append(self.random_state.randint(k))
+			rows.append(self.reservoir_next_ - self.n_seen_)
+
+			self.reservoir_w_ *= math.exp(math.log(self._random_uniform()) / k)
+			self.reservoir_next_ += math.floor(math.log(
+				self._random_uniform()) / math.log(1 - self.reservoir_w_)) + 1
+
+		if len(positions) > 0:
+			# Keep only the last replacement of each position.
+			positions, rows = numpy.array(positions), numpy.array(rows)
+			_, idxs = numpy.unique(positions[::-1], return_index=True)
+			idxs = positions.shape[0] - 1 - idxs
+			self.reservoir[positions[idxs]] = X[rows[idxs]]
+
+	def _random_uniform(self):
+		"""Draw a uniform random number in (0, 1]."""
+
+		return 1. - self.random_state.random_sample()
+
 	def _initialize(self, X_pairwise, idxs=None):
 		super()._initialize(X_pairwise, idxs=idxs)
 
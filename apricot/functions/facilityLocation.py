@@ -8,18 +8,34 @@ from ..optimizers import LazyGreedy
 from ..optimizers import ApproximateLazyGreedy
 from ..optimizers import SieveGreedy
 
+from ..utils import _calculate_pairwise_block
+from ..utils import _calculate_pairwise_distances
+from ..utils import _RowBlocks
+from ..utils import SimilarityGraph
+
 from tqdm import tqdm
 
 from numba import njit
 from numba import prange
 
+from scipy.sparse import csr_matrix
+
 dtypes = 'void(float64[:,:], float64[:], float64[:], int64[:])'
 sdtypes = 'void(float64[:], int32[:], int32[:], float64[:], float64[:], int64[:])'
 sieve_dtypes = 'void(float64[:,:], int64, float64[:,:], int64[:,:],' \
 	'float64[:,:], float64[:], float64[:], int64[:], int64[:])' 
+sieve_sparse_dtypes = 'void(float64[:], int32[:], int32[:], int64, int64,' \
+	'float64[:,:], int64[:,:], float64[:,:], float64[:], float64[:],' \
+	'int64[:], int64[:])'
+many_dtypes = 'void(float64[:], int64[:], int64[:], int64, int64[:,:],' \
+	'float64[:,:])'
+swap_dtypes = 'void(float64[:,:], float64[:], float64[:], int64[:],' \
+	'float64[:], float64[:], int64[:], int64[:])'
+swap_sparse_dtypes = 'void(float64[:], int32[:], int32[:], float64[:],' \
+	'float64[:], int64[:], float64[:], float64[:], int64[:], int64[:])'
 
 def calculate_gains(dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_(X, gains, current_values, idxs):
 		for i in prange(idxs.shape[0]):
 			idx = idxs[i]
@@ -28,7 +44,7 @@ def calculate_gains(dtypes, parallel, fastmath, cache):
 
 
 def calculate_gains_sparse(dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sparse_(X_data, X_indices, X_indptr, gains, current_values, idxs):
 		for i in prange(idxs.shape[0]):
 			idx = idxs[i]
@@ -43,7 +59,7 @@ def calculate_gains_sparse(dtypes, parallel, fastmath, cache):
 
 
 def calculate_gains_sieve(dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sieve_(X, k, current_values, selections, gains, 
 		total_gains, max_values, n_selected, idxs):
 		n, d = X.shape
@@ -70,6 +86,134 @@ def calculate_gains_sieve(dtypes, parallel, fastmath, cache):
 	return calculate_gains_sieve_
 
 
+def calculate_gains_sieve_sparse(dtypes, parallel, fastmath, cache):
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
+	def calculate_gains_sieve_sparse_(X_data, X_indices, X_indptr, d, k, 
+		current_values, selections, gains, total_gains, max_values, 
+		n_selected, idxs):
+		t = max_values.shape[0]
+
+		for j in prange(t):
+			if n_selected[j] == k:
+				continue
+
+			# The value of the current subset on the columns in this batch,
+			# which can change as the reservoir fills up.
+			value = 0.
+			for m in range(d):
+				value += current_values[j, m]
+			value /= d
+
+			for i in range(idxs.shape[0]):
+				if n_selected[j] == k:
+					break
+
+				idx = idxs[i]
+				start = X_indptr[i]
+				end = X_indptr[i+1]
+				threshold = (max_values[j] / 2. - total_gains[j]) / (k - n_selected[j])
+
+				increase = 0.
+				for l in range(start, end):
+					m = X_indices[l]
+					increase += max(X_data[l] - current_values[j, m], 0.)
+
+				gain = value + increase / d - total_gains[j]
+
+				if gain > threshold:
+					for l in range(start, end):
+						m = X_indices[l]
+						current_values[j, m] = max(X_data[l], 
+							current_values[j, m])
+
+					value += increase / d
+					total_gains[j] = value
+
+					selections[j, n_selected[j]] = idx
+					gains[j, n_selected[j]] = gain
+					n_selected[j] += 1
+
+	return calculate_gains_sieve_sparse_
+
+
+@njit(many_dtypes, nogil=True, parallel=True, fastmath=True)
+def select_many_greedy(X, sizes, offsets, k, rankings, gains):
+	for p in prange(sizes.shape[0]):
+		n = sizes[p]
+		start = offsets[p]
+
+		current_values = numpy.zeros(n, dtype=numpy.float64)
+		mask = numpy.zeros(n, dtype=numpy.int8)
+
+		for l in range(min(k, n)):
+			best_gain = 0.
+			best_idx = -1
+
+			for i in range(n):
+				if mask[i] == 1:
+					continue
+
+				gain = 0.
+				for j in range(n):
+					gain += max(X[start + i*n + j] - current_values[j], 0.)
+
+				if best_idx == -1 or gain > best_gain:
+					best_gain = gain
+					best_idx = i
+
+			for j in range(n):
+				current_values[j] = max(X[start + best_idx*n + j],
+					current_values[j])
+
+			mask[best_idx] = 1
+			rankings[p, l] = best_idx
+			gains[p, l] = best_gain
+
+
+@njit(swap_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_swap_gains(X, best_values, second_values, owners, losses,
+	swap_gains, swap_positions, idxs):
+	for i in prange(idxs.shape[0]):
+		idx = idxs[i]
+		gains = -losses
+		gain = 0.
+
+		for j in range(X.shape[1]):
+			g = max(X[idx, j] - best_values[j], 0.)
+			gain += g
+
+			if owners[j] >= 0:
+				gains[owners[j]] += max(X[idx, j] - second_values[j], 0.) - g
+
+		k = numpy.argmax(gains)
+		swap_gains[i] = gain + gains[k]
+		swap_positions[i] = k
+
+
+@njit(swap_sparse_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_swap_gains_sparse(X_data, X_indices, X_indptr, best_values,
+	second_values, owners, losses, swap_gains, swap_positions, idxs):
+	for i in prange(idxs.shape[0]):
+		idx = idxs[i]
+		gains = -losses
+		gain = 0.
+
+		start = X_indptr[idx]
+		end = X_indptr[idx+1]
+
+		for l in range(start, end):
+			j = X_indices[l]
+			g = max(X_data[l] - best_values[j], 0.)
+			gain += g
+
+			if owners[j] >= 0:
+				gains[owners[j]] += max(X_data[l] - second_values[j], 0.) - g
+
+		k = numpy.argmax(gains)
+		swap_gains[i] = gain + gains[k]
+		swap_positions[i] = k
+
+
 class FacilityLocationSelection(BaseGraphSelection):
 	"""A selector based off a facility location submodular function.
 
@@ -159,11 +303,60 @@ class FacilityLocationSelection(BaseGraphSelection):
 		and the values in the dictionary should be the values that these
 		parameters take. Default is None.
 
-	n_neighbors : int or None
+	n_neighbors : int, NNDescent or None
 		When constructing a similarity matrix, the number of nearest neighbors
 		whose similarity values will be kept. The result is a sparse similarity
 		matrix which can significantly speed up computation at the cost of
-		accuracy. Default is None.
+		accuracy. An `apricot.utils.NNDescent` object can be passed in to
+		find approximate nearest neighbors, which is much faster for large
+		data sets. When streaming, the most similar examples in the reservoir
+		are kept for each example in the batch. Default is None.
+
+	min_similarity : float or None
+		When constructing a similarity matrix, the smallest similarity value
+		that will be kept. Similarities are calculated one block of rows at a
+		time and smaller values are dropped as each block is calculated. The
+		result is a sparse similarity matrix whose density adapts to the data
+		rather than having a fixed number of neighbors for each example.
+		Cannot be used together with `n_neighbors`. Default is None.
+
+	block_size : int or None
+		When constructing a dense similarity matrix, the number of rows whose
+		similarities are calculated at a time. The similarities are written
+		into the matrix block by block, using `n_jobs` threads, so that the
+		temporary memory used is proportional to the size of a block rather
+		than to the size of the matrix. If None, the matrix is calculated all
+		at once. When the similarity matrix is stored on disk, this is instead
+		the number of rows read at a time when calculating gains, and if None,
+		blocks of about 64MB are read. Default is None.
+
+	packed : bool
+		Whether to store only the upper triangle of a dense similarity
+		matrix. Because the matrix is symmetric this halves the memory that it
+		takes, and full rows are read through the symmetry in blocks of
+		`block_size` rows whenever gains are calculated, which makes each
+		iteration somewhat slower. Cannot be used with `n_neighbors`,
+		`min_similarity` or a separate ground set. Default is False.
+
+	similarity_cache : str, os.PathLike, SimilarityCache or None
+		A directory, or an `apricot.utils.SimilarityCache` object, to store
+		similarity matrices built from feature matrices in. When a selector
+		is fit to the same data with the same metric and sparsification
+		parameters again, the similarity matrix is memory-mapped from the
+		cache instead of being recalculated. If None, nothing is cached.
+		Default is None.
+
+	implicit : bool
+		Whether to calculate the similarities between candidates and the
+		ground set on the fly from a dense feature matrix in the `fit` method
+		instead of materializing the full similarity matrix. Only the current
+		similarity of each example to its closest selected example is stored,
+		and so the memory used is proportional to the size of the data set and
+		a single block of `block_size` candidates rather than to its square.
+		Cannot be used with a precomputed matrix, `n_neighbors` or
+		`min_similarity`, and only optimizers that operate on the full data
+		set, such as 'naive', 'lazy', 'two-stage' and 'stochastic', are
+		supported. Default is False.
 
 	reservoir : numpy.ndarray or None
 		The reservoir to use when calculating gains in the sieve greedy
@@ -205,16 +398,35 @@ class FacilityLocationSelection(BaseGraphSelection):
 
 	def __init__(self, n_samples, metric='euclidean', 
 		initial_subset=None, optimizer='lazy', optimizer_kwds={}, 
-		n_neighbors=None, reservoir=None, max_reservoir_size=1000,
-		n_jobs=1, random_state=None, verbose=False):
+		n_neighbors=None, min_similarity=None, block_size=None, packed=False,
+		similarity_cache=None, implicit=False, reservoir=None, 
+		max_reservoir_size=1000, n_jobs=1, random_state=None, verbose=False):
+
+		if implicit and metric in ('precomputed', 'ignore'):
+			raise ValueError("Cannot calculate similarities implicitly from " \
+				"a precomputed similarity matrix.")
+		if implicit and (n_neighbors is not None or 
+			min_similarity is not None):
+			raise ValueError("Cannot calculate similarities implicitly " \
+				"when building a sparse similarity matrix.")
+		if implicit and packed:
+			raise ValueError("Cannot calculate similarities implicitly " \
+				"when packing the similarity matrix.")
 
 		super().__init__(n_samples=n_samples, 
 			metric=metric, initial_subset=initial_subset, optimizer=optimizer, 
 			optimizer_kwds=optimizer_kwds, n_neighbors=n_neighbors, 
-			reservoir=reservoir, max_reservoir_size=max_reservoir_size,
+			min_similarity=min_similarity, block_size=block_size, 
+			packed=packed, similarity_cache=similarity_cache, 
+			reservoir=reservoir, max_reservoir_size=max_reservoir_size, 
 			n_jobs=n_jobs, random_state=random_state, verbose=verbose)
 
-	def fit(self, X, y=None, sample_weight=None, sample_cost=None):
+		self.implicit = implicit
+		self.max_distance_ = None
+		self._ground = None
+
+	def fit(self, X, y=None, sample_weight=None, sample_cost=None,
+		ground=None):
 		"""Run submodular optimization to select the examples.
 
 		This method is a wrapper for the full submodular optimization process.
@@ -230,8 +442,15 @@ class FacilityLocationSelection(BaseGraphSelection):
 
 		Parameters
 		----------
-		X : list or numpy.ndarray, shape=(n, d)
-			The data set to transform. Must be numeric.
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set to transform. Must be numeric. When the metric is
+			'precomputed', this can also be a similarity matrix stored on
+			disk, as a numpy.memmap, the path to a .npy file, or the path to
+			a directory of .npy files that each contain a block of rows and
+			are ordered by name. Rows are then only read from disk when
+			gains are calculated for them. A `SimilarityGraph` can also be
+			passed in, in which case its similarity matrix is used instead of
+			building a new one.
 
 		y : list or numpy.ndarray or None, shape=(n,), optional
 			The labels to transform. If passed in this function will return
@@ -246,25 +465,106 @@ class FacilityLocationSelection(BaseGraphSelection):
 			The cost of each item. If set, indicates that optimization should
 			be performed with respect to a knapsack constraint.
 
+		ground : list or numpy.ndarray or None, shape=(m, d), optional
+			The ground set that the selected examples should represent. If
+			passed in, examples are selected from X to represent the ground
+			set, and the similarity matrix has one row for each example in X
+			and one column for each example in the ground set. If None, X is
+			used as the ground set. Default is None.
+
 		Returns
 		-------
 		self : FacilityLocationSelection
 			The fit step returns this selector object.
 		"""
 
-		return super().fit(X, y=y, 
+		if self.implicit and isinstance(X, SimilarityGraph):
+			raise ValueError("Similarities cannot be calculated implicitly " \
+				"from a similarity graph.")
+		elif not self.implicit:
+			X = self._open_row_blocks(X)
+			return super().fit(X, y=y, sample_weight=sample_weight, 
+				sample_cost=sample_cost, ground=ground)
+
+		if isinstance(X, csr_matrix):
+			raise ValueError("Similarities can only be calculated implicitly " \
+				"from a dense feature matrix.")
+
+		X = numpy.asarray(X, dtype='float64')
+		if X.ndim != 2:
+			raise ValueError("X must have exactly two dimensions.")
+
+		ground = self._check_ground(X, ground)
+		self._X_ground = ground
+
+		# Similarities other than cosine and correlation are the largest
+		# distance minus each distance, and so a first pass over all blocks
+		# is needed to find the largest distance.
+		self.max_distance_ = None
+		if self.metric not in ('correlation', 'cosine'):
+			Y = X if ground is None else ground
+			block_size = self._implicit_block_size(Y.shape[0])
+			self.max_distance_ = max(_calculate_pairwise_block(
+				X[start:start+block_size], Y, metric=self.metric, 
+				idxs=self._implicit_idxs(numpy.arange(start, 
+					min(start+block_size, X.shape[0])))
+				).max() for start in range(0, X.shape[0], block_size))
+
+		self._X = X
+		return super(BaseGraphSelection, self).fit(X, y=y, 
 			sample_weight=sample_weight, sample_cost=sample_cost)
 
+	def _implicit_block_size(self, n):
+		"""The number of candidates to calculate similarities for at once."""
+
+		if self.block_size is not None:
+			return self.block_size
+		return max(1, 2 ** 24 // max(n, 1))
+
+	def _implicit_idxs(self, idxs):
+		"""The examples in the ground set that candidates correspond to."""
+
+		return idxs if self._X_ground is None else None
+
+	def _calculate_implicit_similarities(self, X, idxs):
+		"""Calculate the similarities between candidates and the ground set.
+
+		X contains the features of the candidates and idxs their positions in
+		the ground set, whose similarity to themselves is set to the largest
+		similarity possible to match the full similarity matrix.
+		"""
+
+		X_block = _calculate_pairwise_block(X, self._ground, 
+			metric=self.metric, idxs=self._implicit_idxs(idxs))
+
+		if self.metric in ('correlation', 'cosine'):
+			return numpy.subtract(1, X_block, out=X_block)
+		return numpy.subtract(self.max_distance_, X_block, out=X_block)
+
 	def _initialize(self, X_pairwise):
 		super()._initialize(X_pairwise)
 
+		if self.implicit:
+			self._ground = X_pairwise if self._X_ground is None else \
+				self._X_ground
+			self.current_values = numpy.zeros(self._ground.shape[0], 
+				dtype='float64')
+
 		if self.initial_subset is None:
 			pass
 		elif self.initial_subset.ndim == 2:
 			raise ValueError("When using facility location, the initial subset"\
 				" must be a one dimensional array of indices.")
 		elif self.initial_subset.ndim == 1:
-			if not self.sparse:
+			if self.implicit:
+				block_size = self._implicit_block_size(self._ground.shape[0])
+				for start in range(0, len(self.initial_subset), block_size):
+					idxs = self.initial_subset[start:start+block_size]
+					X_block = self._calculate_implicit_similarities(
+						X_pairwise[idxs], idxs)
+					self.current_values = numpy.maximum(X_block.max(axis=0),
+						self.current_values)
+			elif not self.sparse:
 				for i in self.initial_subset:
 					self.current_values = numpy.maximum(X_pairwise[i],
 						self.current_values).astype('float64')
@@ -277,6 +577,9 @@ class FacilityLocationSelection(BaseGraphSelection):
 				" matrix of examples or a one dimensional mask.")
 
 		self.current_values_sum = self.current_values.sum()
+		if self.implicit:
+			return
+
 		self.calculate_gains_ = calculate_gains_sparse if self.sparse else calculate_gains
 		dtypes_ = sdtypes if self.sparse else dtypes
 
@@ -287,27 +590,133 @@ class FacilityLocationSelection(BaseGraphSelection):
 		else: 
 			self.calculate_gains_ = self.calculate_gains_(dtypes_, True, True, False)
 
-		#calculate_sieve_gains_ = calculate_gains_sieve_sparse if self.sparse else calculate_gains_sieve
-		#dtypes_ = sieve_sparse_dtypes if self.sparse else sieve_dtypes 
-		#self.calculate_sieve_gains_ = calculate_sieve_gains_(dtypes_, 
-		#	True, True, False)
-
-		self.calculate_sieve_gains_ = calculate_gains_sieve(sieve_dtypes,
+		calculate_sieve_gains_ = calculate_gains_sieve_sparse if self.sparse else calculate_gains_sieve
+		dtypes_ = sieve_sparse_dtypes if self.sparse else sieve_dtypes 
+		self.calculate_sieve_gains_ = calculate_sieve_gains_(dtypes_, 
 			True, True, False)
 
 	def _calculate_gains(self, X_pairwise, idxs=None):
 		idxs = idxs if idxs is not None else self.idxs
 		gains = numpy.zeros(idxs.shape[0], dtype='float64')
 
-		if self.sparse:
+		if self.implicit:
+			block_size = self._implicit_block_size(self._ground.shape[0])
+			for start in range(0, idxs.shape[0], block_size):
+				end = min(start + block_size, idxs.shape[0])
+				X_block = self._calculate_implicit_similarities(
+					X_pairwise[idxs[start:end]], idxs[start:end])
+				X_block = numpy.subtract(X_block, self.current_values, 
+					out=X_block)
+				X_block = numpy.maximum(X_block, 0, out=X_block)
+				gains[start:end] = X_block.sum(axis=1)
+		elif self.sparse:
 			self.calculate_gains_(X_pairwise.data, X_pairwise.indices, 
 				X_pairwise.indptr, gains, self.current_values, idxs)
+		elif isinstance(X_pairwise, _RowBlocks):
+			for start, end, X_block in X_pairwise.iter_rows(idxs, 
+				self.block_size):
+				self.calculate_gains_(X_block, gains[start:end], 
+					self.current_values, numpy.arange(end - start))
+			gains -= self.current_values_sum
 		else:
 			self.calculate_gains_(X_pairwise, gains, self.current_values, idxs)
 			gains -= self.current_values_sum
 
 		return gains
 
+	def _select_many(self, Xs, n_samples):
+		"""Select from many data sets using a single compiled kernel.
+
+		Each data set is converted to a similarity matrix, the matrices are
+		flattened and concatenated, and the naive greedy algorithm is run on
+		each one in parallel.
+		"""
+
+		if self.n_neighbors is not None or self.min_similarity is not None \
+			or self.packed or any(isinstance(X, csr_matrix) for X in Xs):
+			return super()._select_many(Xs, n_samples)
+
+		Xs_pairwise = []
+		for X in Xs:
+			if self.metric == 'precomputed' and X.shape[0] != X.shape[1]:
+				raise ValueError("Precomputed similarity matrices " \
+					"must be square and symmetric.")
+
+			X_pairwise = _calculate_pairwise_distances(X, metric=self.metric)
+			Xs_pairwise.append(X_pairwise.ravel().astype('float64'))
+
+		sizes = numpy.array([X.shape[0] for X in Xs], dtype='int64')
+		offsets = numpy.zeros(len(Xs), dtype='int64')
+		offsets[1:] = numpy.cumsum(sizes ** 2)[:-1]
+
+		rankings = numpy.zeros((len(Xs), n_samples), dtype='int64') - 1
+		gains = numpy.zeros((len(Xs), n_samples), dtype='float64')
+
+		select_many_greedy(numpy.concatenate(Xs_pairwise), sizes, offsets,
+			n_samples, rankings, gains)
+
+		ks = numpy.minimum(sizes, n_samples)
+		return ([r[:k] for r, k in zip(rankings, ks)],
+			[g[:k] for g, k in zip(gains, ks)])
+
+	def _calculate_swap_gains(self, X_pairwise, ranking):
+		"""Find the best swap of a selected example for an unselected one.
+
+		For facility location, the loss from removing a selected example only
+		depends on the columns that it is currently the most similar selected
+		example for. By keeping track of the largest and second largest
+		similarity in each column, and which selected example the largest one
+		belongs to, the change in objective value from every possible swap
+		involving a candidate can be calculated in a single pass over that
+		candidate's row.
+		"""
+
+		n, d = X_pairwise.shape
+		best_values = numpy.zeros(d, dtype='float64')
+		second_values = numpy.zeros(d, dtype='float64')
+		owners = numpy.zeros(d, dtype='int64') - 1
+
+		fixed = [] if self.initial_subset is None else list(self.initial_subset)
+		rows = list(enumerate(ranking)) + [(-1, idx) for idx in fixed]
+
+		for i, idx in rows:
+			if self.sparse:
+				x = X_pairwise[idx].toarray()[0]
+			else:
+				x = X_pairwise[idx]
+
+			better = x > best_values
+			second_values = numpy.where(better, best_values,
+				numpy.maximum(second_values, x))
+			best_values = numpy.where(better, x, best_values)
+			owners = numpy.where(better, i, owners)
+
+		mask = owners >= 0
+		losses = numpy.bincount(owners[mask], minlength=len(ranking),
+			weights=(best_values - second_values)[mask]).astype('float64')
+
+		mask = numpy.ones(n, dtype=bool)
+		mask[ranking] = False
+		mask[fixed] = False
+		idxs = numpy.where(mask)[0]
+
+		if idxs.shape[0] == 0:
+			return float("-inf"), None, None
+
+		swap_gains = numpy.zeros(idxs.shape[0], dtype='float64')
+		swap_positions = numpy.zeros(idxs.shape[0], dtype='int64')
+
+		if self.sparse:
+			calculate_swap_gains_sparse(X_pairwise.data, X_pairwise.indices,
+				X_pairwise.indptr, best_values, second_values, owners,
+				losses, swap_gains, swap_positions, idxs)
+		else:
+			calculate_swap_gains(X_pairwise, best_values, second_values,
+				owners, losses, swap_gains, swap_positions, idxs)
+
+		j = numpy.argmax(swap_gains)
+		return swap_gains[j], swap_positions[j], idxs[j]
+
 	def _calculate_sieve_gains(self, X_pairwise, thresholds, idxs):
 		"""This function will update the internal statistics from a stream.
 
@@ -322,7 +731,8 @@ class FacilityLocationSelection(BaseGraphSelection):
 
 		if self.sparse:
 			self.calculate_sieve_gains_(X_pairwise.data, X_pairwise.indices, 
-				X_pairwise.indptr, self.n_samples, self.sieve_current_values_,
+				X_pairwise.indptr, X_pairwise.shape[1], self.n_samples, 
+				self.sieve_current_values_,
 				self.sieve_selections_, self.sieve_gains_, 
 				self.sieve_total_gains_, thresholds, 
 				self.sieve_n_selected_, idxs)
@@ -335,7 +745,11 @@ class FacilityLocationSelection(BaseGraphSelection):
 	def _select_next(self, X_pairwise, gain, idx):
 		"""This function will add the given item to the selected set."""
 
-		if self.sparse:
+		if self.implicit:
+			X_row = self._calculate_implicit_similarities(
+				X_pairwise.reshape(1, -1), numpy.array([idx]))[0]
+			self.current_values = numpy.maximum(X_row, self.current_values)
+		elif self.sparse:
 			self.current_values = numpy.maximum(
 				X_pairwise.toarray()[0], self.current_values)
 		else:
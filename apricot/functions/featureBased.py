@@ -13,7 +13,9 @@ from tqdm import tqdm
 from numba import njit
 from numba import prange
 
-@njit('float64[:](float64[:])', fastmath=True)
+from scipy.sparse import csr_matrix
+
+@njit('float64[:](float64[:])', nogil=True, fastmath=True)
 def sigmoid(X):
 	return X / (1. + X)
 
@@ -25,9 +27,10 @@ sieve_dtypes = 'void(float64[:,:], int64, float64[:,:], int64[:,:],' \
 sieve_sparse_dtypes = 'void(float64[:], int32[:], int32[:], int64,' \
 	'float64[:,:], int64[:,:], float64[:,:], float64[:], float64[:],' \
 	'int64[:], int64[:])'
+many_dtypes = 'void(float64[:,:], int64[:], int64, int64[:,:], float64[:,:])'
 
 def calculate_gains(func, dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_(X, gains, current_values, idxs):
 		for i in prange(idxs.shape[0]):
 			idx = idxs[i] 
@@ -36,7 +39,7 @@ def calculate_gains(func, dtypes, parallel, fastmath, cache):
 	return calculate_gains_
 
 def calculate_gains_sparse(func, dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sparse_(X_data, X_indices, X_indptr, gains, 
 		current_values, current_concave_values, idxs):
 		for i in prange(idxs.shape[0]):
@@ -53,7 +56,7 @@ def calculate_gains_sparse(func, dtypes, parallel, fastmath, cache):
 
 
 def calculate_gains_sieve(func, dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sieve_(X, k, current_values, selections, gains, 
 		total_gains, max_values, n_selected, idxs):
 		n = X.shape[0]
@@ -80,7 +83,7 @@ def calculate_gains_sieve(func, dtypes, parallel, fastmath, cache):
 
 
 def calculate_gains_sieve_sparse(func, dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sieve_sparse_(X_data, X_indices, X_indptr, k, 
 		current_values, selections, gains, total_gains, max_values, 
 		n_selected, idxs):
@@ -115,6 +118,44 @@ def calculate_gains_sieve_sparse(func, dtypes, parallel, fastmath, cache):
 	return calculate_gains_sieve_sparse_
 
 
+def select_many_greedy(func, dtypes, parallel, fastmath, cache):
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
+	def select_many_greedy_(X, offsets, k, rankings, gains):
+		d = X.shape[1]
+
+		for p in prange(offsets.shape[0] - 1):
+			start = offsets[p]
+			n = offsets[p+1] - start
+
+			current_values = numpy.zeros(d, dtype=numpy.float64)
+			current_concave_values_sum = 0.
+			mask = numpy.zeros(n, dtype=numpy.int8)
+
+			for l in range(min(k, n)):
+				best_gain = 0.
+				best_idx = -1
+
+				for i in range(n):
+					if mask[i] == 1:
+						continue
+
+					gain = func(current_values + X[start + i]).sum()
+					gain -= current_concave_values_sum
+
+					if best_idx == -1 or gain > best_gain:
+						best_gain = gain
+						best_idx = i
+
+				current_values += X[start + best_idx]
+				current_concave_values_sum = func(current_values).sum()
+
+				mask[best_idx] = 1
+				rankings[p, l] = best_idx
+				gains[p, l] = best_gain
+
+	return select_many_greedy_
+
+
 class FeatureBasedSelection(BaseSelection):
 	"""A selector based off a feature based submodular function.
 
@@ -324,6 +365,37 @@ class FeatureBasedSelection(BaseSelection):
 		self.calculate_sieve_gains_ = calculate_sieve_gains_(self.concave_func,
 			dtypes_, True, True, False)
 
+	def _select_many(self, Xs, n_samples):
+		"""Select from many data sets using a single compiled kernel.
+
+		The data sets are concatenated into a single matrix, with offsets
+		marking where each one begins, and the naive greedy algorithm is run
+		on each one in parallel.
+		"""
+
+		if any(isinstance(X, csr_matrix) for X in Xs):
+			return super()._select_many(Xs, n_samples)
+
+		if len(set(X.shape[1] for X in Xs)) > 1:
+			raise ValueError("All data sets must have the same number of " \
+				"features.")
+
+		sizes = numpy.array([X.shape[0] for X in Xs], dtype='int64')
+		offsets = numpy.zeros(len(Xs) + 1, dtype='int64')
+		offsets[1:] = numpy.cumsum(sizes)
+
+		rankings = numpy.zeros((len(Xs), n_samples), dtype='int64') - 1
+		gains = numpy.zeros((len(Xs), n_samples), dtype='float64')
+
+		select_many_greedy_ = select_many_greedy(self.concave_func,
+			many_dtypes, True, True, False)
+		select_many_greedy_(numpy.concatenate(Xs), offsets, n_samples,
+			rankings, gains)
+
+		ks = numpy.minimum(sizes, n_samples)
+		return ([r[:k] for r, k in zip(rankings, ks)],
+			[g[:k] for g, k in zip(gains, ks)])
+
 	def _calculate_gains(self, X, idxs=None):
 		"""This function will return the gain that each example would give.
 
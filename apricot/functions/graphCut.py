@@ -6,6 +6,9 @@ import numpy
 from .base import BaseGraphSelection
 
 from ..utils import _calculate_pairwise_distances
+from ..utils import _keep_nearest_neighbors
+from ..utils import _drop_small_similarities
+from ..utils import _RowBlocks
 
 from tqdm import tqdm
 
@@ -14,34 +17,77 @@ from numba import prange
 
 from scipy.sparse import csr_matrix
 
-sieve_dtypes = 'void(float64[:,:], int64, float64[:,:], int64[:,:],' \
-	'float64[:,:], float64[:], float64[:], int64[:], float64[:], int64[:])' 
-
-def calculate_gains_sieve(dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
-	def calculate_gains_sieve_(X, k, current_values, selections, gains, 
-		total_gains, max_values, n_selected, row_sums, idxs):
-		n, d = X.shape
-		t = max_values.shape[0]
-
-		for j in prange(t):
-			for i in range(n):
-				if n_selected[j] == k:
-					break
-
-				idx = idxs[i]
-				threshold = (max_values[j] / 2. - total_gains[j]) / (k - n_selected[j])
-				gain = row_sums[i] - current_values[j, i]
-
-				if gain > threshold:
-					total_gains[j] += gain
-
-					selections[j, n_selected[j]] = idx
-					gains[j, n_selected[j]] = gain
-					n_selected[j] += 1
-
-	return calculate_gains_sieve_
-
+sieve_dtypes = 'void(float64[:,:], float64[:], float64[:,:], float64[:],' \
+	'int64, int64, int64[:,:], int64[:,:], float64[:,:], float64[:],' \
+	'float64[:], int64[:], int64[:])'
+sieve_sparse_dtypes = 'void(float64[:], int32[:], int32[:], float64[:],' \
+	'float64[:,:], float64[:], int64, int64, int64[:,:], int64[:,:],' \
+	'float64[:,:], float64[:], float64[:], int64[:], int64[:])'
+
+@njit(sieve_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_gains_sieve(X, self_values, X_subset, row_sums, d, k, 
+	positions, selections, gains, total_gains, thresholds, n_selected, idxs):
+	n = X.shape[0]
+	t = thresholds.shape[0]
+
+	for j in prange(t):
+		if n_selected[j] == k:
+			continue
+
+		redundancy = self_values.copy()
+		for i in range(n):
+			for p in range(n_selected[j]):
+				redundancy[i] += 2 * X_subset[i, positions[j, p]]
+
+		for i in range(n):
+			if n_selected[j] == k:
+				break
+
+			idx = idxs[i]
+			threshold = (thresholds[j] / 2. - total_gains[j]) / (k - n_selected[j])
+			gain = (row_sums[i] - redundancy[i]) / d
+
+			if gain > threshold:
+				for m in range(n):
+					redundancy[m] += 2 * X[i, m]
+
+				total_gains[j] += gain
+				selections[j, n_selected[j]] = idx
+				gains[j, n_selected[j]] = gain
+				n_selected[j] += 1
+
+@njit(sieve_sparse_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_gains_sieve_sparse(X_data, X_indices, X_indptr, self_values, 
+	X_subset, row_sums, d, k, positions, selections, gains, total_gains, 
+	thresholds, n_selected, idxs):
+	n = self_values.shape[0]
+	t = thresholds.shape[0]
+
+	for j in prange(t):
+		if n_selected[j] == k:
+			continue
+
+		redundancy = self_values.copy()
+		for i in range(n):
+			for p in range(n_selected[j]):
+				redundancy[i] += 2 * X_subset[i, positions[j, p]]
+
+		for i in range(n):
+			if n_selected[j] == k:
+				break
+
+			idx = idxs[i]
+			threshold = (thresholds[j] / 2. - total_gains[j]) / (k - n_selected[j])
+			gain = (row_sums[i] - redundancy[i]) / d
+
+			if gain > threshold:
+				for l in range(X_indptr[i], X_indptr[i+1]):
+					redundancy[X_indices[l]] += 2 * X_data[l]
+
+				total_gains[j] += gain
+				selections[j, n_selected[j]] = idx
+				gains[j, n_selected[j]] = gain
+				n_selected[j] += 1
 
 class GraphCutSelection(BaseGraphSelection):
 	"""A selector based on using a graph-cut function.
@@ -123,11 +169,45 @@ class GraphCutSelection(BaseGraphSelection):
 		and the values in the dictionary should be the values that these
 		parameters take. Default is None.
 
-	n_neighbors : int or None
+	n_neighbors : int, NNDescent or None
 		When constructing a similarity matrix, the number of nearest neighbors
 		whose similarity values will be kept. The result is a sparse similarity
 		matrix which can significantly speed up computation at the cost of
-		accuracy. Default is None.
+		accuracy. An `apricot.utils.NNDescent` object can be passed in to
+		find approximate nearest neighbors, which is much faster for large
+		data sets. Default is None.
+
+	min_similarity : float or None
+		When constructing a similarity matrix, the smallest similarity value
+		that will be kept. Similarities are calculated one block of rows at a
+		time and smaller values are dropped as each block is calculated. The
+		result is a sparse similarity matrix whose density adapts to the data
+		rather than having a fixed number of neighbors for each example.
+		Cannot be used together with `n_neighbors`. Default is None.
+
+	block_size : int or None
+		When constructing a dense similarity matrix, the number of rows whose
+		similarities are calculated at a time. The similarities are written
+		into the matrix block by block, using `n_jobs` threads, so that the
+		temporary memory used is proportional to the size of a block rather
+		than to the size of the matrix. If None, the matrix is calculated all
+		at once. Default is None.
+
+	packed : bool
+		Whether to store only the upper triangle of a dense similarity
+		matrix. Because the matrix is symmetric this halves the memory that it
+		takes, and full rows are read through the symmetry in blocks of
+		`block_size` rows whenever gains are calculated, which makes each
+		iteration somewhat slower. Cannot be used with `n_neighbors`,
+		`min_similarity` or a separate ground set. Default is False.
+
+	similarity_cache : str, os.PathLike, SimilarityCache or None
+		A directory, or an `apricot.utils.SimilarityCache` object, to store
+		similarity matrices built from feature matrices in. When a selector
+		is fit to the same data with the same metric and sparsification
+		parameters again, the similarity matrix is memory-mapped from the
+		cache instead of being recalculated. If None, nothing is cached.
+		Default is None.
 
 	reservoir : numpy.ndarray or None
 		The reservoir to use when calculating gains in the sieve greedy
@@ -173,13 +253,16 @@ class GraphCutSelection(BaseGraphSelection):
 
 	def __init__(self, n_samples=10, metric='euclidean', alpha=1,
 		initial_subset=None, optimizer='naive', optimizer_kwds={},
-		n_neighbors=None, reservoir=None, max_reservoir_size=1000, 
+		n_neighbors=None, min_similarity=None, block_size=None, packed=False,
+		similarity_cache=None, reservoir=None, max_reservoir_size=1000, 
 		n_jobs=1, random_state=None, verbose=False):
 		self.alpha = alpha
 
 		super().__init__(n_samples=n_samples, 
 			metric=metric, initial_subset=initial_subset, optimizer=optimizer,  
-			n_neighbors=n_neighbors, reservoir=reservoir, 
+			n_neighbors=n_neighbors, min_similarity=min_similarity, 
+			block_size=block_size, packed=packed, 
+			similarity_cache=similarity_cache, reservoir=reservoir, 
 			max_reservoir_size=max_reservoir_size, n_jobs=n_jobs, 
 			random_state=random_state, optimizer_kwds={}, verbose=verbose)
 
@@ -199,8 +282,10 @@ class GraphCutSelection(BaseGraphSelection):
 
 		Parameters
 		----------
-		X : list or numpy.ndarray, shape=(n, d)
-			The data set to transform. Must be numeric.
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set to transform. Must be numeric. A `SimilarityGraph` can
+			also be passed in, in which case its similarity matrix is used
+			instead of building a new one.
 
 		y : list or numpy.ndarray or None, shape=(n,), optional
 			The labels to transform. If passed in this function will return
@@ -228,12 +313,32 @@ class GraphCutSelection(BaseGraphSelection):
 		super()._initialize(X_pairwise)
 
 		if self.reservoir is not None:
-			X_pairwise = _calculate_pairwise_distances(self._X, 
+			self.batch_pairwise = _calculate_pairwise_distances(self._X, 
 				metric=self.metric)
-
-		if self.sparse:
+			self.current_values = numpy.diag(self.batch_pairwise).astype(
+				'float64')
+			self.row_sums = self.alpha * numpy.asarray(
+				X_pairwise.sum(axis=1)).reshape(-1)
+
+			if isinstance(self.n_neighbors, int):
+				self.batch_pairwise = _keep_nearest_neighbors(
+					self.batch_pairwise, self.n_neighbors)
+			elif self.min_similarity is not None:
+				self.batch_pairwise = _drop_small_similarities(
+					self.batch_pairwise, self.min_similarity)
+
+			return
+
+		graph = self._graph_for(X_pairwise)
+		if graph is not None:
+			self.row_sums = self.alpha * graph.row_sums
+			self.current_values = graph.diagonal.copy()
+		elif self.sparse:
 			self.row_sums = self.alpha * numpy.array(X_pairwise.sum(axis=1))[:,0]
 			self.current_values = X_pairwise.diagonal().astype('float64')
+		elif isinstance(X_pairwise, _RowBlocks):
+			self.row_sums = self.alpha * X_pairwise.sum(axis=1)
+			self.current_values = X_pairwise.diagonal()
 		else:
 			self.row_sums = self.alpha * X_pairwise.sum(axis=1)
 			self.current_values = numpy.diag(X_pairwise).astype('float64')
@@ -254,9 +359,6 @@ class GraphCutSelection(BaseGraphSelection):
 			raise ValueError("The initial subset must be either a two dimensional" \
 				" matrix of examples or a one dimensional mask.")
 
-		self.calculate_sieve_gains_ = calculate_gains_sieve(sieve_dtypes, 
-			True, True, False)
-
 	def _calculate_gains(self, X_pairwise, idxs=None):
 		idxs = idxs if idxs is not None else self.idxs
 		gains = self.row_sums[idxs] - self.current_values[idxs]
@@ -274,37 +376,39 @@ class GraphCutSelection(BaseGraphSelection):
 		super()._calculate_sieve_gains(X_pairwise,
 			thresholds, idxs)
 
-		n, m = X_pairwise.shape[0], len(thresholds)
-		row_sums = self.alpha * X_pairwise.mean(axis=1)
-		sieve_current_values_ = numpy.tile(numpy.diag(
-			_calculate_pairwise_distances(self._X, metric=self.metric)), (m, 1))
-
-		for i in range(m):
-			l = self.sieve_n_selected_[i]
-			if l == self.n_samples or l == 0:
-				continue
+		if self.sieve_rows_.shape[0] > 0:
+			X_subset = _calculate_pairwise_distances(self._X, 
+				Y=self.sieve_rows_, metric=self.metric)
+		else:
+			X_subset = numpy.zeros((self._X.shape[0], 0), dtype='float64')
 
-			sieve_current_values_[i] = _calculate_pairwise_distances(
-				self._X, Y=self.sieve_subsets_[i, :l], 
-				metric=self.metric).mean(axis=1)
+		positions = numpy.searchsorted(self.sieve_row_ids_, 
+			self.sieve_selections_)
 
-		if self.sparse:
-			self.calculate_sieve_gains_(X_pairwise.data, 
-				X_pairwise.indices, X_pairwise.indptr, 
-				self.n_samples, sieve_current_values_, 
+		if isinstance(self.batch_pairwise, csr_matrix):
+			calculate_gains_sieve_sparse(self.batch_pairwise.data, 
+				self.batch_pairwise.indices, self.batch_pairwise.indptr,
+				self.current_values, X_subset, self.row_sums, 
+				X_pairwise.shape[1], self.n_samples, positions, 
 				self.sieve_selections_, self.sieve_gains_, 
-				self.sieve_total_gains_, thresholds, 
-				self.sieve_n_selected_, idxs)
+				self.sieve_total_gains_, thresholds, self.sieve_n_selected_, 
+				idxs)
 		else:
-			self.calculate_sieve_gains_(X_pairwise, self.n_samples, 
-				sieve_current_values_, self.sieve_selections_, 
-				self.sieve_gains_, self.sieve_total_gains_, thresholds, 
-				self.sieve_n_selected_, row_sums, idxs)
+			calculate_gains_sieve(self.batch_pairwise, self.current_values,
+				X_subset, self.row_sums, X_pairwise.shape[1], self.n_samples, 
+				positions, self.sieve_selections_, self.sieve_gains_, 
+				self.sieve_total_gains_, thresholds, self.sieve_n_selected_, 
+				idxs)
 
 	def _select_next(self, X_pairwise, gain, idx):
 		"""This function will add the given item to the selected set."""
 
-		if self.sparse:
+		if self.reservoir is not None:
+			if isinstance(self.batch_pairwise, csr_matrix):
+				self.current_values += self.batch_pairwise[idx].toarray()[0] * 2
+			else:
+				self.current_values += self.batch_pairwise[idx] * 2
+		elif self.sparse:
 			self.current_values += X_pairwise.toarray()[0] * 2
 		else:
 			self.current_values += X_pairwise * 2
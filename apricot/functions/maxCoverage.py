@@ -20,7 +20,7 @@ sieve_sparse_dtypes = 'void(float64[:], int32[:], int32[:], int64,' \
 	'int64[:], float64, int64[:])'
 
 def calculate_gains(dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_(X, gains, current_values, threshold, idxs):
 		for i in prange(idxs.shape[0]):
 			idx = idxs[i] 
@@ -29,7 +29,7 @@ def calculate_gains(dtypes, parallel, fastmath, cache):
 
 
 def calculate_gains_sparse(dtypes, parallel, fastmath, cache):
-	@njit(sdtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(sdtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sparse_(X_data, X_indices, X_indptr, gains, 
 		current_values, threshold, idxs):
 		for i in prange(idxs.shape[0]):
@@ -44,7 +44,7 @@ def calculate_gains_sparse(dtypes, parallel, fastmath, cache):
 
 
 def calculate_gains_sieve(dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sieve_(X, k, current_values, selections, gains, 
 		total_gains, max_values, n_selected, thresh, idxs):
 		n = X.shape[0]
@@ -72,7 +72,7 @@ def calculate_gains_sieve(dtypes, parallel, fastmath, cache):
 
 
 def calculate_gains_sieve_sparse(dtypes, parallel, fastmath, cache):
-	@njit(dtypes, parallel=parallel, fastmath=fastmath, cache=cache)
+	@njit(dtypes, nogil=True, parallel=parallel, fastmath=fastmath, cache=cache)
 	def calculate_gains_sieve_sparse_(X_data, X_indices, X_indptr, k, 
 		current_values, selections, gains, total_gains, max_values, 
 		n_selected, thresh, idxs):
@@ -5,10 +5,40 @@ import numpy
 
 from .base import BaseSelection
 from .base import BaseGraphSelection
+from .featureBased import FeatureBasedSelection
+from .featureBased import calculate_gains_sieve
+from .featureBased import calculate_gains_sieve_sparse
+from .featureBased import sieve_dtypes
+from .featureBased import sieve_sparse_dtypes
 from ..utils import _calculate_pairwise_distances
+from ..utils import SimilarityGraph
 
 from tqdm import tqdm
 
+from numba import njit
+
+def weighted_concave_func(funcs, weights):
+	"""Return a compiled weighted sum of concave functions.
+
+	The sum is built by chaining closures so that each function remains
+	a compile-time constant of the resulting function.
+	"""
+
+	func, weight = funcs[0], weights[0]
+
+	if len(funcs) == 1:
+		@njit(nogil=True, fastmath=True)
+		def weighted_concave_func_(X):
+			return weight * func(X)
+	else:
+		rest = weighted_concave_func(funcs[1:], weights[1:])
+
+		@njit(nogil=True, fastmath=True)
+		def weighted_concave_func_(X):
+			return weight * func(X) + rest(X)
+
+	return weighted_concave_func_
+
 class MixtureSelection(BaseSelection):
 	"""A selection approach based on a mixture of submodular functions.
 
@@ -161,6 +191,8 @@ class MixtureSelection(BaseSelection):
 		self.metric = metric.replace("corr", "correlation")
 		self.n_neighbors = n_neighbors
 
+		self.calculate_sieve_gains_ = {}
+
 		for function in self.functions:
 			function.initial_subset = self.initial_subset
 			function.reservoir = reservoir
@@ -183,8 +215,10 @@ class MixtureSelection(BaseSelection):
 
 		Parameters
 		----------
-		X : list or numpy.ndarray, shape=(n, d)
-			The data set to transform. Must be numeric.
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set to transform. Must be numeric. A `SimilarityGraph` can
+			also be passed in, in which case its similarity matrix is used
+			instead of building a new one.
 
 		y : list or numpy.ndarray or None, shape=(n,), optional
 			The labels to transform. If passed in this function will return
@@ -205,15 +239,60 @@ class MixtureSelection(BaseSelection):
 			The fit step returns this selector object.
 		"""
 
-		# If self.metric is ignore, this will return the same matrix.
-		# Otherwise, it will convert it to a pairwise similarity matrix.
-		self._X = X
-		X = _calculate_pairwise_distances(X, metric=self.metric, 
-			n_neighbors=self.n_neighbors)
-
+		X = self._use_graph(X)
 		return super().fit(X, y=y, 
 			sample_weight=sample_weight, sample_cost=sample_cost)
 
+	def refine(self, X, max_swaps=100, tol=1e-6):
+		"""Improve a fitted selection using local search swaps.
+
+		See `BaseSelection.refine` for details. If a metric was specified,
+		the data is converted to a similarity matrix in the same way as in
+		the `fit` method.
+
+		Parameters
+		----------
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set that the selector was fit to. Must be numeric. A
+			`SimilarityGraph` can also be passed in, in which case its
+			similarity matrix is used instead of building a new one.
+
+		max_swaps : int, optional
+			The maximum number of swaps to perform. Default is 100.
+
+		tol : float, optional
+			The minimum increase in the objective value that a swap must have
+			in order to be performed. Default is 1e-6.
+
+		Returns
+		-------
+		self : MixtureSelection
+			The refine step returns this selector object.
+		"""
+
+		X = self._use_graph(X)
+		return super().refine(X, max_swaps=max_swaps, tol=tol)
+
+	def _use_graph(self, X):
+		"""Share a similarity graph with the functions, if one is passed in.
+
+		If X is not a similarity graph and the metric is not 'ignore', it is
+		converted into a pairwise similarity matrix.
+		"""
+
+		if isinstance(X, SimilarityGraph):
+			self._graph, self._X = X, X.X
+			X = X.X_pairwise
+		else:
+			self._graph, self._X = None, X
+			X = _calculate_pairwise_distances(X, metric=self.metric, 
+				n_neighbors=self.n_neighbors)
+
+		for function in self.functions:
+			function._graph = self._graph
+
+		return X
+
 	def _initialize(self, X):
 		super()._initialize(X)
 
@@ -237,9 +316,49 @@ class MixtureSelection(BaseSelection):
 		return gains
 
 	def _calculate_sieve_gains(self, X, thresholds, idxs):
+		"""This function will update the internal statistics from a stream.
+
+		When every component is a feature-based function, the sieves of every
+		component contain the same items and so share the same column sums.
+		The mixture is then itself a feature-based function whose concave 
+		function is the weighted sum of the concave functions of the 
+		components, and a single compiled kernel is run on the sieves of the
+		mixture. Otherwise, each example is passed through the sieves of each
+		component one at a time.
+		"""
+
 		super()._calculate_sieve_gains(X, 
 			thresholds, idxs)
 
+		if all(isinstance(function, FeatureBasedSelection) 
+			for function in self.functions):
+
+			if self.sparse not in self.calculate_sieve_gains_:
+				func = weighted_concave_func([function.concave_func for 
+					function in self.functions], self.weights)
+
+				if self.sparse:
+					self.calculate_sieve_gains_[True] = (
+						calculate_gains_sieve_sparse(func, 
+							sieve_sparse_dtypes, True, True, False))
+				else:
+					self.calculate_sieve_gains_[False] = calculate_gains_sieve(
+						func, sieve_dtypes, True, True, False)
+
+			if self.sparse:
+				self.calculate_sieve_gains_[True](X.data, X.indices, 
+					X.indptr, self.n_samples, self.sieve_current_values_, 
+					self.sieve_selections_, self.sieve_gains_, 
+					self.sieve_total_gains_, thresholds, 
+					self.sieve_n_selected_, idxs)
+			else:
+				self.calculate_sieve_gains_[False](X, self.n_samples, 
+					self.sieve_current_values_, self.sieve_selections_, 
+					self.sieve_gains_, self.sieve_total_gains_, thresholds, 
+					self.sieve_n_selected_, idxs)
+
+			return
+
 		for function in self.functions:
 			super(function.__class__, function)._calculate_sieve_gains(X,
 				thresholds, idxs)
@@ -282,7 +401,30 @@ class MixtureSelection(BaseSelection):
 							if vi < self.n_samples:
 								function.sieve_selections_[l, vi] = 0
 								function.sieve_gains_[l, vi] = 0
-								function.sieve_subsets_[l, vi] = 0
+
+	def _prune_sieves(self, mask):
+		"""Discard the state of the sieves that are not in the mask."""
+
+		super()._prune_sieves(mask)
+
+		for function in self.functions:
+			if function.sieve_current_values_ is not None:
+				function._prune_sieves(mask)
+
+	def _get_sieve_state(self):
+		"""Return the state of the sieves and of the sieves of each function."""
+
+		states = [function._get_sieve_state() for function in self.functions]
+		return super()._get_sieve_state(), states
+
+	def _set_sieve_state(self, state=None):
+		"""Set the state of the sieves and of the sieves of each function."""
+
+		state, states = state if state is not None else (None, [None] * self.m)
+		super()._set_sieve_state(state)
+
+		for function, function_state in zip(self.functions, states):
+			function._set_sieve_state(function_state)
 
 	def _select_next(self, X, gain, idx):
 		"""This function will add the given item to the selected set."""
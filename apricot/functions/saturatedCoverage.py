@@ -5,6 +5,9 @@ import numpy
 
 from .base import BaseGraphSelection
 
+from ..utils import _calculate_pairwise_distances
+from ..utils import _RowBlocks
+
 from tqdm import tqdm
 
 from numba import njit
@@ -14,6 +17,11 @@ from scipy.sparse import csr_matrix
 
 dtypes = 'void(float64[:,:], float64[:], float64[:], float64[:], int64[:])'
 sdtypes = 'void(float64[:], int32[:], int32[:], float64[:], float64[:], float64[:], int64[:])'
+sieve_dtypes = 'void(float64[:,:], int64, float64[:,:], int64[:,:],' \
+	'float64[:,:], float64[:], float64[:], int64[:], float64[:], int64[:])'
+sieve_sparse_dtypes = 'void(float64[:], int32[:], int32[:], int64, int64,' \
+	'float64[:,:], int64[:,:], float64[:,:], float64[:], float64[:],' \
+	'int64[:], float64[:], int64[:])'
 
 @njit(dtypes, nogil=True, parallel=True)
 def select_next(X, gains, current_values, max_values, idxs):
@@ -33,6 +41,92 @@ def select_next_sparse(X_data, X_indices, X_indptr, gains, current_values, max_v
 			k = X_indices[j]
 			gains[i] += min(X_data[j] + current_values[k], max_values[k]) - current_values[k]
 
+@njit(sieve_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_gains_sieve(X, k, current_values, selections, gains, 
+	total_gains, thresholds, n_selected, max_values, idxs):
+	n, d = X.shape
+	t = thresholds.shape[0]
+
+	for j in prange(t):
+		if n_selected[j] == k:
+			continue
+
+		# The value of the current subset on the reservoir, which can change
+		# as the reservoir fills up.
+		value = 0.
+		for m in range(d):
+			value += min(current_values[j, m], max_values[m])
+		value /= d
+
+		for i in range(n):
+			if n_selected[j] == k:
+				break
+
+			idx = idxs[i]
+			threshold = (thresholds[j] / 2. - total_gains[j]) / (k - n_selected[j])
+
+			increase = 0.
+			for m in range(d):
+				increase += (min(current_values[j, m] + X[i, m], max_values[m])
+					- min(current_values[j, m], max_values[m]))
+
+			gain = value + increase / d - total_gains[j]
+
+			if gain > threshold:
+				for m in range(d):
+					current_values[j, m] += X[i, m]
+
+				value += increase / d
+				total_gains[j] = value
+
+				selections[j, n_selected[j]] = idx
+				gains[j, n_selected[j]] = gain
+				n_selected[j] += 1
+
+@njit(sieve_sparse_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_gains_sieve_sparse(X_data, X_indices, X_indptr, d, k, 
+	current_values, selections, gains, total_gains, thresholds, n_selected, 
+	max_values, idxs):
+	t = thresholds.shape[0]
+
+	for j in prange(t):
+		if n_selected[j] == k:
+			continue
+
+		value = 0.
+		for m in range(d):
+			value += min(current_values[j, m], max_values[m])
+		value /= d
+
+		for i in range(idxs.shape[0]):
+			if n_selected[j] == k:
+				break
+
+			idx = idxs[i]
+			start = X_indptr[i]
+			end = X_indptr[i+1]
+			threshold = (thresholds[j] / 2. - total_gains[j]) / (k - n_selected[j])
+
+			increase = 0.
+			for l in range(start, end):
+				m = X_indices[l]
+				increase += (min(current_values[j, m] + X_data[l], max_values[m])
+					- min(current_values[j, m], max_values[m]))
+
+			gain = value + increase / d - total_gains[j]
+
+			if gain > threshold:
+				for l in range(start, end):
+					m = X_indices[l]
+					current_values[j, m] += X_data[l]
+
+				value += increase / d
+				total_gains[j] = value
+
+				selections[j, n_selected[j]] = idx
+				gains[j, n_selected[j]] = gain
+				n_selected[j] += 1
+
 class SaturatedCoverageSelection(BaseGraphSelection):
 	"""A saturated coverage submodular selection algorithm.
 
@@ -59,6 +153,10 @@ class SaturatedCoverageSelection(BaseGraphSelection):
 	to the selected set (the saturation). Like most graph-based functons, 
 	the saturated coverage function requires access to the full ground set.
 
+	When streaming, the reservoir is used in place of the ground set, and so
+	each example in the reservoir saturates at alpha times its total
+	similarity to the other examples in the reservoir.
+
 	Parameters
 	----------
 	n_samples : int
@@ -113,11 +211,47 @@ class SaturatedCoverageSelection(BaseGraphSelection):
 		and the values in the dictionary should be the values that these
 		parameters take. Default is None.
 
-	n_neighbors : int or None
+	n_neighbors : int, NNDescent or None
 		When constructing a similarity matrix, the number of nearest neighbors
 		whose similarity values will be kept. The result is a sparse similarity
 		matrix which can significantly speed up computation at the cost of
-		accuracy. Default is None.
+		accuracy. An `apricot.utils.NNDescent` object can be passed in to
+		find approximate nearest neighbors, which is much faster for large
+		data sets. Default is None.
+
+	min_similarity : float or None
+		When constructing a similarity matrix, the smallest similarity value
+		that will be kept. Similarities are calculated one block of rows at a
+		time and smaller values are dropped as each block is calculated. The
+		result is a sparse similarity matrix whose density adapts to the data
+		rather than having a fixed number of neighbors for each example.
+		Cannot be used together with `n_neighbors`. Default is None.
+
+	block_size : int or None
+		When constructing a dense similarity matrix, the number of rows whose
+		similarities are calculated at a time. The similarities are written
+		into the matrix block by block, using `n_jobs` threads, so that the
+		temporary memory used is proportional to the size of a block rather
+		than to the size of the matrix. If None, the matrix is calculated all
+		at once. When the similarity matrix is stored on disk, this is instead
+		the number of rows read at a time when calculating gains, and if None,
+		blocks of about 64MB are read. Default is None.
+
+	packed : bool
+		Whether to store only the upper triangle of a dense similarity
+		matrix. Because the matrix is symmetric this halves the memory that it
+		takes, and full rows are read through the symmetry in blocks of
+		`block_size` rows whenever gains are calculated, which makes each
+		iteration somewhat slower. Cannot be used with `n_neighbors`,
+		`min_similarity` or a separate ground set. Default is False.
+
+	similarity_cache : str, os.PathLike, SimilarityCache or None
+		A directory, or an `apricot.utils.SimilarityCache` object, to store
+		similarity matrices built from feature matrices in. When a selector
+		is fit to the same data with the same metric and sparsification
+		parameters again, the similarity matrix is memory-mapped from the
+		cache instead of being recalculated. If None, nothing is cached.
+		Default is None.
 
 	reservoir : numpy.ndarray or None
 		The reservoir to use when calculating gains in the sieve greedy
@@ -162,18 +296,22 @@ class SaturatedCoverageSelection(BaseGraphSelection):
 	"""
 
 	def __init__(self, n_samples=10, metric='euclidean', alpha=0.1,
-		initial_subset=None, optimizer='two-stage', n_neighbors=None, n_jobs=1, 
-		random_state=None, reservoir=None, max_reservoir_size=None, 
-		optimizer_kwds={}, verbose=False):
+		initial_subset=None, optimizer='two-stage', n_neighbors=None, 
+		min_similarity=None, block_size=None, packed=False,
+		similarity_cache=None, n_jobs=1, random_state=None, reservoir=None, 
+		max_reservoir_size=1000, optimizer_kwds={}, verbose=False):
 		self.alpha = alpha
 
 		super().__init__(n_samples=n_samples, 
 			metric=metric,initial_subset=initial_subset, optimizer=optimizer, 
-			optimizer_kwds=optimizer_kwds, n_neighbors=n_neighbors,
-			reservoir=reservoir, max_reservoir_size=max_reservoir_size,
+			optimizer_kwds=optimizer_kwds, n_neighbors=n_neighbors, 
+			min_similarity=min_similarity, block_size=block_size, 
+			packed=packed, similarity_cache=similarity_cache, 
+			reservoir=reservoir, max_reservoir_size=max_reservoir_size, 
 			n_jobs=n_jobs, random_state=random_state, verbose=verbose)
 
-	def fit(self, X, y=None, sample_weight=None, sample_cost=None):
+	def fit(self, X, y=None, sample_weight=None, sample_cost=None,
+		ground=None):
 		"""Run submodular optimization to select the examples.
 
 		This method is a wrapper for the full submodular optimization process.
@@ -189,8 +327,15 @@ class SaturatedCoverageSelection(BaseGraphSelection):
 
 		Parameters
 		----------
-		X : list or numpy.ndarray, shape=(n, d)
-			The data set to transform. Must be numeric.
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set to transform. Must be numeric. When the metric is
+			'precomputed', this can also be a similarity matrix stored on
+			disk, as a numpy.memmap, the path to a .npy file, or the path to
+			a directory of .npy files that each contain a block of rows and
+			are ordered by name. Rows are then only read from disk when
+			gains are calculated for them. A `SimilarityGraph` can also be
+			passed in, in which case its similarity matrix is used instead of
+			building a new one.
 
 		y : list or numpy.ndarray or None, shape=(n,), optional
 			The labels to transform. If passed in this function will return
@@ -205,19 +350,38 @@ class SaturatedCoverageSelection(BaseGraphSelection):
 			The cost of each item. If set, indicates that optimization should
 			be performed with respect to a knapsack constraint.
 
+		ground : list or numpy.ndarray or None, shape=(m, d), optional
+			The ground set that the selected examples should represent. If
+			passed in, examples are selected from X to represent the ground
+			set, and the similarity matrix has one row for each example in X
+			and one column for each example in the ground set. If None, X is
+			used as the ground set. Default is None.
+
 		Returns
 		-------
 		self : SaturatedCoverageSelection
 			The fit step returns this selector object.
 		"""
 
-		return super().fit(X, y=y, 
-			sample_weight=sample_weight, sample_cost=sample_cost)
+		X = self._open_row_blocks(X)
+		return super().fit(X, y=y, sample_weight=sample_weight, 
+			sample_cost=sample_cost, ground=ground)
 
 	def _initialize(self, X_pairwise):
 		super()._initialize(X_pairwise)
 
-		if self.sparse:
+		if self.reservoir is not None:
+			X_reservoir = _calculate_pairwise_distances(
+				self.reservoir[:X_pairwise.shape[1]], metric=self.metric)
+			self.max_values = self.alpha * X_reservoir.sum(axis=1)
+		elif self._X_ground is not None:
+			# Each example in the ground set saturates at alpha times its
+			# total similarity to the candidates.
+			self.max_values = self.alpha * numpy.asarray(
+				X_pairwise.sum(axis=0)).ravel()
+		elif self._graph_for(X_pairwise) is not None:
+			self.max_values = self.alpha * self._graph.row_sums
+		elif self.sparse:
 			self.max_values = self.alpha * numpy.array(
 				X_pairwise.sum(axis=1))[:,0]
 		else:
@@ -249,6 +413,12 @@ class SaturatedCoverageSelection(BaseGraphSelection):
 			select_next_sparse(X_pairwise.data,
 				X_pairwise.indices, X_pairwise.indptr, gains,
 				self.current_values, self.max_values, idxs)
+		elif isinstance(X_pairwise, _RowBlocks):
+			for start, end, X_block in X_pairwise.iter_rows(idxs, 
+				self.block_size):
+				select_next(X_block, gains[start:end], self.current_values,
+					self.max_values, numpy.arange(end - start))
+			gains -= self.current_values.sum()
 		else:
 			select_next(X_pairwise, gains, self.current_values,
 				self.max_values, idxs)
@@ -256,6 +426,29 @@ class SaturatedCoverageSelection(BaseGraphSelection):
 
 		return gains
 
+	def _calculate_sieve_gains(self, X_pairwise, thresholds, idxs):
+		"""This function will update the internal statistics from a stream.
+
+		This function will update the various internal statistics that are a
+		part of the sieve algorithm for streaming submodular optimization. This
+		function does not directly return gains but it updates the values
+		used by a streaming optimizer.
+		"""
+
+		super()._calculate_sieve_gains(X_pairwise, thresholds, idxs)
+
+		if self.sparse:
+			calculate_gains_sieve_sparse(X_pairwise.data, X_pairwise.indices,
+				X_pairwise.indptr, X_pairwise.shape[1], self.n_samples,
+				self.sieve_current_values_, self.sieve_selections_, 
+				self.sieve_gains_, self.sieve_total_gains_, thresholds, 
+				self.sieve_n_selected_, self.max_values, idxs)
+		else:
+			calculate_gains_sieve(X_pairwise, self.n_samples, 
+				self.sieve_current_values_, self.sieve_selections_, 
+				self.sieve_gains_, self.sieve_total_gains_, thresholds, 
+				self.sieve_n_selected_, self.max_values, idxs)
+
 	def _select_next(self, X_pairwise, gain, idx):
 		"""This function will add the given item to the selected set."""
 
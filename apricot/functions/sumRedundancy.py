@@ -5,8 +5,90 @@ import numpy
 
 from .base import BaseGraphSelection
 
+from ..utils import _calculate_pairwise_distances
+from ..utils import _keep_nearest_neighbors
+from ..utils import _drop_small_similarities
+from ..utils import _RowBlocks
+
 from tqdm import tqdm
 
+from numba import njit
+from numba import prange
+
+from scipy.sparse import csr_matrix
+
+sieve_dtypes = 'void(float64[:,:], float64[:], float64[:,:], int64, int64,' \
+	'float64, int64[:,:], int64[:,:], float64[:,:], float64[:], float64[:],' \
+	'int64[:], int64[:])'
+sieve_sparse_dtypes = 'void(float64[:], int32[:], int32[:], float64[:],' \
+	'float64[:,:], int64, int64, float64, int64[:,:], int64[:,:],' \
+	'float64[:,:], float64[:], float64[:], int64[:], int64[:])'
+
+@njit(sieve_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_gains_sieve(X, self_values, X_subset, d, k, shift, positions,
+	selections, gains, total_gains, thresholds, n_selected, idxs):
+	n = X.shape[0]
+	t = thresholds.shape[0]
+
+	for j in prange(t):
+		if n_selected[j] == k:
+			continue
+
+		redundancy = self_values.copy()
+		for i in range(n):
+			for p in range(n_selected[j]):
+				redundancy[i] += 2 * X_subset[i, positions[j, p]]
+
+		for i in range(n):
+			if n_selected[j] == k:
+				break
+
+			idx = idxs[i]
+			threshold = (thresholds[j] / 2. - total_gains[j]) / (k - n_selected[j])
+			gain = (shift - redundancy[i]) / d
+
+			if gain > threshold:
+				for m in range(n):
+					redundancy[m] += 2 * X[i, m]
+
+				total_gains[j] += gain
+				selections[j, n_selected[j]] = idx
+				gains[j, n_selected[j]] = gain
+				n_selected[j] += 1
+
+@njit(sieve_sparse_dtypes, nogil=True, parallel=True, fastmath=True)
+def calculate_gains_sieve_sparse(X_data, X_indices, X_indptr, self_values, 
+	X_subset, d, k, shift, positions, selections, gains, total_gains, 
+	thresholds, n_selected, idxs):
+	n = self_values.shape[0]
+	t = thresholds.shape[0]
+
+	for j in prange(t):
+		if n_selected[j] == k:
+			continue
+
+		redundancy = self_values.copy()
+		for i in range(n):
+			for p in range(n_selected[j]):
+				redundancy[i] += 2 * X_subset[i, positions[j, p]]
+
+		for i in range(n):
+			if n_selected[j] == k:
+				break
+
+			idx = idxs[i]
+			threshold = (thresholds[j] / 2. - total_gains[j]) / (k - n_selected[j])
+			gain = (shift - redundancy[i]) / d
+
+			if gain > threshold:
+				for l in range(X_indptr[i], X_indptr[i+1]):
+					redundancy[X_indices[l]] += 2 * X_data[l]
+
+				total_gains[j] += gain
+				selections[j, n_selected[j]] = idx
+				gains[j, n_selected[j]] = gain
+				n_selected[j] += 1
+
 class SumRedundancySelection(BaseGraphSelection):
 	"""A selector based off a sum redundancy submodular function.
 	
@@ -34,6 +116,15 @@ class SumRedundancySelection(BaseGraphSelection):
 	between two examples. While sum redundancy functions involves calculating 
 	the sum of the entire similarity matrix in principle, in practice if one 
 	is only calculating the gains this step can be ignored.
+
+	Because every gain of this function is negative, it cannot be directly
+	optimized by the sieve streaming algorithm, which requires positive
+	gains. When streaming, a constant is added to the gain of each example
+	that is large enough to make all gains non-negative for subsets of up to
+	`n_samples` examples. Because all full subsets have the same size, this
+	does not change which subset is best. The similarities between each
+	batch and the previously selected examples are calculated from the
+	selected examples themselves rather than from the reservoir.
 	
 	This implementation allows users to pass in either their own symmetric
 	square matrix of similarity values, or a data matrix as normal and a function
@@ -88,11 +179,45 @@ class SumRedundancySelection(BaseGraphSelection):
 		and the values in the dictionary should be the values that these
 		parameters take. Default is None.
 
-	n_neighbors : int or None
+	n_neighbors : int, NNDescent or None
 		When constructing a similarity matrix, the number of nearest neighbors
 		whose similarity values will be kept. The result is a sparse similarity
 		matrix which can significantly speed up computation at the cost of
-		accuracy. Default is None.
+		accuracy. An `apricot.utils.NNDescent` object can be passed in to
+		find approximate nearest neighbors, which is much faster for large
+		data sets. Default is None.
+
+	min_similarity : float or None
+		When constructing a similarity matrix, the smallest similarity value
+		that will be kept. Similarities are calculated one block of rows at a
+		time and smaller values are dropped as each block is calculated. The
+		result is a sparse similarity matrix whose density adapts to the data
+		rather than having a fixed number of neighbors for each example.
+		Cannot be used together with `n_neighbors`. Default is None.
+
+	block_size : int or None
+		When constructing a dense similarity matrix, the number of rows whose
+		similarities are calculated at a time. The similarities are written
+		into the matrix block by block, using `n_jobs` threads, so that the
+		temporary memory used is proportional to the size of a block rather
+		than to the size of the matrix. If None, the matrix is calculated all
+		at once. Default is None.
+
+	packed : bool
+		Whether to store only the upper triangle of a dense similarity
+		matrix. Because the matrix is symmetric this halves the memory that it
+		takes, and full rows are read through the symmetry in blocks of
+		`block_size` rows whenever gains are calculated, which makes each
+		iteration somewhat slower. Cannot be used with `n_neighbors`,
+		`min_similarity` or a separate ground set. Default is False.
+
+	similarity_cache : str, os.PathLike, SimilarityCache or None
+		A directory, or an `apricot.utils.SimilarityCache` object, to store
+		similarity matrices built from feature matrices in. When a selector
+		is fit to the same data with the same metric and sparsification
+		parameters again, the similarity matrix is memory-mapped from the
+		cache instead of being recalculated. If None, nothing is cached.
+		Default is None.
 
 	reservoir : numpy.ndarray or None
 		The reservoir to use when calculating gains in the sieve greedy
@@ -138,16 +263,21 @@ class SumRedundancySelection(BaseGraphSelection):
 
 	def __init__(self, n_samples=10, metric='euclidean', 
 		initial_subset=None, optimizer='two-stage', n_neighbors=None, 
-		reservoir=None, max_reservoir_size=1000, n_jobs=1, 
-		random_state=None, optimizer_kwds={}, verbose=False):
+		min_similarity=None, block_size=None, packed=False,
+		similarity_cache=None, reservoir=None, max_reservoir_size=1000, 
+		n_jobs=1, random_state=None, optimizer_kwds={}, verbose=False):
 
 		super().__init__(n_samples=n_samples, 
 			metric=metric, initial_subset=initial_subset, optimizer=optimizer, 
-			n_neighbors=n_neighbors, reservoir=reservoir, 
+			n_neighbors=n_neighbors, min_similarity=min_similarity, 
+			block_size=block_size, packed=packed, 
+			similarity_cache=similarity_cache, reservoir=reservoir, 
 			max_reservoir_size=max_reservoir_size, n_jobs=n_jobs, 
 			random_state=random_state, optimizer_kwds=optimizer_kwds, 
 			verbose=verbose)
 
+		self.max_redundancy_ = None
+
 	def fit(self, X, y=None, sample_weight=None, sample_cost=None):
 		"""Run submodular optimization to select the examples.
 
@@ -164,8 +294,10 @@ class SumRedundancySelection(BaseGraphSelection):
 
 		Parameters
 		----------
-		X : list or numpy.ndarray, shape=(n, d)
-			The data set to transform. Must be numeric.
+		X : list, numpy.ndarray or SimilarityGraph, shape=(n, d)
+			The data set to transform. Must be numeric. A `SimilarityGraph` can
+			also be passed in, in which case its similarity matrix is used
+			instead of building a new one.
 
 		y : list or numpy.ndarray or None, shape=(n,), optional
 			The labels to transform. If passed in this function will return
@@ -191,10 +323,36 @@ class SumRedundancySelection(BaseGraphSelection):
 
 	def _initialize(self, X_pairwise, idxs=None):
 		super()._initialize(X_pairwise, idxs=idxs)
+
+		if self.reservoir is not None:
+			self.batch_pairwise = _calculate_pairwise_distances(self._X,
+				metric=self.metric)
+			self.current_values = numpy.diag(self.batch_pairwise).astype(
+				'float64')
+
+			if isinstance(self.n_neighbors, int):
+				self.batch_pairwise = _keep_nearest_neighbors(
+					self.batch_pairwise, self.n_neighbors)
+			elif self.min_similarity is not None:
+				self.batch_pairwise = _drop_small_similarities(
+					self.batch_pairwise, self.min_similarity)
+
+			if self.max_redundancy_ is None:
+				self.max_redundancy_ = ((2 * self.n_samples - 1) * 
+					self.current_values.max())
+
+			return
+
 		idxs = idxs if idxs is not None else numpy.arange(X_pairwise.shape[0])
 
-		for i, idx in enumerate(idxs):
-			self.current_values[i] = X_pairwise[idx, idx]
+		graph = self._graph_for(X_pairwise)
+		if graph is not None:
+			self.current_values[:] = graph.diagonal[idxs]
+		elif isinstance(X_pairwise, _RowBlocks):
+			self.current_values[:] = X_pairwise.diagonal()[idxs]
+		else:
+			for i, idx in enumerate(idxs):
+				self.current_values[i] = X_pairwise[idx, idx]
 
 		if self.initial_subset is None:
 			return
@@ -214,12 +372,55 @@ class SumRedundancySelection(BaseGraphSelection):
 
 	def _calculate_gains(self, X_pairwise, idxs=None):
 		idxs = idxs if idxs is not None else self.idxs
+
+		if self.reservoir is not None:
+			return self.max_redundancy_ - self.current_values[idxs]
 		return -self.current_values[idxs]
 
+	def _calculate_sieve_gains(self, X_pairwise, thresholds, idxs):
+		"""This function will update the internal statistics from a stream.
+
+		This function will update the various internal statistics that are a
+		part of the sieve algorithm for streaming submodular optimization. This
+		function does not directly return gains but it updates the values
+		used by a streaming optimizer.
+		"""
+
+		super()._calculate_sieve_gains(X_pairwise, thresholds, idxs)
+
+		if self.sieve_rows_.shape[0] > 0:
+			X_subset = _calculate_pairwise_distances(self._X, 
+				Y=self.sieve_rows_, metric=self.metric)
+		else:
+			X_subset = numpy.zeros((self._X.shape[0], 0), dtype='float64')
+
+		positions = numpy.searchsorted(self.sieve_row_ids_, 
+			self.sieve_selections_)
+
+		if isinstance(self.batch_pairwise, csr_matrix):
+			calculate_gains_sieve_sparse(self.batch_pairwise.data, 
+				self.batch_pairwise.indices, self.batch_pairwise.indptr,
+				self.current_values, X_subset, X_pairwise.shape[1], 
+				self.n_samples, self.max_redundancy_, positions, 
+				self.sieve_selections_, self.sieve_gains_, 
+				self.sieve_total_gains_, thresholds, self.sieve_n_selected_, 
+				idxs)
+		else:
+			calculate_gains_sieve(self.batch_pairwise, self.current_values,
+				X_subset, X_pairwise.shape[1], self.n_samples, 
+				self.max_redundancy_, positions, self.sieve_selections_, 
+				self.sieve_gains_, self.sieve_total_gains_, thresholds, 
+				self.sieve_n_selected_, idxs)
+
 	def _select_next(self, X_pairwise, gain, idx):
 		"""This function will add the given item to the selected set."""
 
-		if self.sparse:
+		if self.reservoir is not None:
+			if isinstance(self.batch_pairwise, csr_matrix):
+				self.current_values += self.batch_pairwise[idx].toarray()[0] * 2
+			else:
+				self.current_values += self.batch_pairwise[idx] * 2
+		elif self.sparse:
 			self.current_values += X_pairwise.toarray()[0] * 2
 		else:
 			self.current_values += X_pairwise * 2
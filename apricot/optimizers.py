@@ -5,13 +5,83 @@ import os
 import copy
 import numpy
 import scipy
+import multiprocessing
 
 from tqdm import tqdm
 
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+
 from .utils import PriorityQueue
 from .utils import check_random_state
 from .utils import _calculate_pairwise_distances
 
+
+def _share_array(X):
+	"""Copy an array into a new block of shared memory.
+
+	Returns the shared memory block, which must be kept alive and unlinked
+	by the caller, and a picklable description that can be used by other
+	processes to attach to it.
+	"""
+
+	shm = SharedMemory(create=True, size=max(X.nbytes, 1))
+	X_shared = numpy.ndarray(X.shape, dtype=X.dtype, buffer=shm.buf)
+	X_shared[:] = X
+	return shm, (shm.name, X.shape, X.dtype.str)
+
+def _attach_array(spec):
+	"""Attach to a block of shared memory as a read-only array."""
+
+	name, shape, dtype = spec
+	shm = SharedMemory(name=name)
+	X = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf)
+	X.flags.writeable = False
+	return shm, X
+
+def _vstack(X, Y):
+	"""Stack two matrices that are either both dense or both sparse."""
+
+	if isinstance(X, scipy.sparse.csr_matrix):
+		return scipy.sparse.vstack([X, Y]).tocsr()
+	return numpy.concatenate([X, Y])
+
+def _coreset_select(function, optimizer, specs, shape, idxs, l,
+	sample_cost):
+	"""Select a coreset from one partition of the data.
+
+	This function is run in a worker process. The data is read from shared
+	memory and only the rows (and, for square similarity matrices, the
+	columns) belonging to the partition are copied out before the optimizer
+	is run on them. The selected indices, mapped back to the full data set,
+	are returned alongside the singleton gain of each selected item.
+	"""
+
+	shms, arrays = zip(*[_attach_array(spec) for spec in specs])
+
+	if len(arrays) == 3:
+		X = scipy.sparse.csr_matrix(arrays, shape=shape)
+	else:
+		X = arrays[0]
+
+	X_subset = X[idxs]
+	if shape[0] == shape[1]:
+		X_subset = X_subset[:, idxs]
+
+	del X, arrays
+	for shm in shms:
+		shm.close()
+
+	function._initialize(X_subset)
+	optimizer = OPTIMIZERS[optimizer](function=function, verbose=False)
+	optimizer.select(X_subset, l, sample_cost=sample_cost)
+	ranking = numpy.array(function.ranking, dtype='int64')
+
+	function._initialize(X_subset)
+	gains = function._calculate_gains(X_subset, ranking)
+	return idxs[ranking], gains
+
+
 class BaseOptimizer(object):
 	"""An approach for optimizing submodular functions.
 
@@ -771,6 +841,182 @@ class GreeDi(BaseOptimizer):
 			self.function._select_next(X[idx], gain, idx)
 
 
+class CoresetGreedy(BaseOptimizer):
+	"""A randomized composable coreset approach using a local process pool.
+
+	This optimizer is a parallel variant of GreeDi. The data is first randomly
+	partitioned into :math:`m` chunks and a coreset of :math:`l` examples is
+	selected from each chunk by a standard optimizer. Unlike GreeDi, each
+	chunk is handled by a separate worker process, so the first stage can use
+	every core on a machine rather than a single one. Because the partitions
+	are random, the union of the coresets is a good summary of the full data
+	set and running a second optimizer on this union yields a set whose
+	quality is close to that of running the optimizer on the full data set.
+	A good default is to select :math:`2k` examples from each partition.
+
+	The data is copied once into shared memory, which the workers attach to
+	in a read-only manner, and each worker copies out only the rows of its
+	own partition. No other state is shared between the workers. Because the
+	workers are started using the 'spawn' method, scripts that use this
+	optimizer should guard their entry point with
+	`if __name__ == '__main__':`.
+
+	.. code::python
+
+		from apricot import FeatureBasedSelection
+
+		X = numpy.random.randint(10, size=(10000, 100))
+
+		selector = FeatureBasedSelection(100, 'sqrt', optimizer='coreset',
+			optimizer_kwds={'n_jobs': 4})
+		selector.fit(X)
+
+	Parameters
+	----------
+	function : base.BaseSelection
+		A submodular function that implements the `_calculate_gains` and
+		`_select_next` methods. This is the function that will be
+		optimized.
+
+	m : int or None, optional
+		The number of partitions to split the data into. If None, use one
+		partition for each worker. Default is None.
+
+	l : int or None, optional
+		The number of exemplars to select from each partition. If None, use
+		twice the number of examples that will be selected. Default is None.
+
+	optimizer1 : str, optional
+		The optimizer to use in the first stage of the process where l
+		exemplars are selected from each partition. Must be a key in
+		`OPTIMIZERS`. Default is 'lazy'.
+
+	optimizer2 : str or base.Optimizer, optional
+		The optimizer to use in the second stage where k exemplars are
+		selected from the union of the coresets. Default is 'lazy'.
+
+	random_state : int or RandomState or None, optional
+		The random seed to use for the random partitioning.
+
+	n_jobs : int or None, optional
+		The number of worker processes to use. If None, use the number of
+		CPUs on the machine. If 1, the partitions are processed in the
+		current process. Default is None.
+
+	verbose : bool
+		Whether to display a progress bar during the optimization process.
+
+
+	Attributes
+	----------
+	self.function : base.BaseSelection or None
+		A submodular function that implements the `_calculate_gains` and
+		`_select_next` methods. This is the function that will be
+		optimized. If None, will be set by the selector when passed in.
+
+	self.coreset_ : numpy.ndarray
+		The indices of the examples in the union of the coresets.
+
+	self.coreset_gains_ : numpy.ndarray
+		The singleton gain of each example in the union of the coresets,
+		i.e., the gain that each example has with respect to an empty set
+		within its own partition.
+
+	self.verbose : bool
+		Whether to display a progress bar during the optimization process.
+	"""
+
+	def __init__(self, function=None, m=None, l=None, optimizer1='lazy',
+		optimizer2='lazy', random_state=None, n_jobs=None, verbose=False):
+		self.m = m
+		self.l = l
+		self.optimizer1 = optimizer1
+		self.optimizer2 = optimizer2
+		self.coreset_ = None
+		self.coreset_gains_ = None
+		super().__init__(function=function,
+			random_state=random_state, n_jobs=n_jobs, verbose=verbose)
+
+	def select(self, X, k, sample_cost=None):
+		if self.optimizer1 not in OPTIMIZERS:
+			raise ValueError("optimizer1 must be a string in {}.".format(
+				str(OPTIMIZERS.keys())))
+
+		n_jobs = self.n_jobs or os.cpu_count() or 1
+		m = self.m or n_jobs
+		l = self.l or 2 * k
+
+		if sample_cost is None:
+			sample_cost = numpy.ones(X.shape[0], dtype='float64')
+
+		if k > (m * l):
+			raise ValueError("k must be smaller than m * l")
+
+		partitions = numpy.arange(X.shape[0]) % m
+		self.random_state.shuffle(partitions)
+
+		if isinstance(X, scipy.sparse.csr_matrix):
+			shared = [_share_array(a) for a in (X.data, X.indices, X.indptr)]
+		else:
+			shared = [_share_array(numpy.asarray(X))]
+
+		shms, specs = zip(*shared)
+
+		function = copy.copy(self.function)
+		function._X = None
+		function.initial_subset = None
+		function.verbose = False
+
+		try:
+			args = []
+			for i in range(m):
+				idxs = numpy.where(partitions == i)[0]
+				if idxs.shape[0] == 0:
+					continue
+
+				args.append((function, self.optimizer1, specs, X.shape, idxs,
+					min(l, idxs.shape[0]), sample_cost[idxs]))
+
+			if n_jobs == 1:
+				results = [_coreset_select(*arg) for arg in args]
+			else:
+				context = multiprocessing.get_context('spawn')
+				with ProcessPoolExecutor(max_workers=min(n_jobs, len(args)),
+					mp_context=context) as pool:
+					results = list(pool.map(_coreset_select, *zip(*args)))
+		finally:
+			for shm in shms:
+				shm.close()
+				shm.unlink()
+
+		rankings, gains = zip(*results)
+		self.coreset_ = numpy.concatenate(rankings)
+		self.coreset_gains_ = numpy.concatenate(gains)
+
+		if isinstance(self.optimizer2, str):
+			optimizer2 = OPTIMIZERS[self.optimizer2](function=self.function,
+				verbose=self.verbose)
+		elif not isinstance(self.optimizer2, BaseOptimizer):
+			raise ValueError("optimizer2 must be either a string or an " \
+				"optimizer object.")
+		else:
+			optimizer2 = self.optimizer2
+
+		rankings = self.coreset_
+		X_subset = X[rankings]
+		if X.shape[0] == X.shape[1]:
+			X_subset = X_subset[:, rankings]
+
+		self.function._initialize(X_subset)
+		optimizer2.select(X_subset, k, sample_cost=sample_cost[rankings])
+		rankings = rankings[self.function.ranking]
+
+		self.function._initialize(X)
+		for idx in rankings:
+			gain = self.function._calculate_gains(X, numpy.array([idx]))[0]
+			self.function._select_next(X[idx], gain, idx)
+
+
 class RandomGreedy(BaseOptimizer):
 	"""The naive greedy algorithm for optimization.
 
@@ -1051,6 +1297,28 @@ class SieveGreedy(BaseOptimizer):
 		`_select_next` methods. This is the function that will be
 		optimized.
 
+	epsilon : float, optional
+		The spacing between successive estimates of the optimal value, such
+		that each threshold is (1 + epsilon) times the previous one. Default
+		is 0.01.
+
+	prune : bool, optional
+		Whether to discard sieves whose estimate of the optimal value is
+		below the value of the best subset found so far, as in
+		Sieve-Streaming++. This bounds the number of sieves that are kept,
+		and so the memory and time spent on each batch, over long streams.
+		Default is True.
+
+	window : int or None, optional
+		If set, only the `window` most recently seen items can be selected,
+		and items that leave the window expire from the selection. This is
+		done by keeping a checkpoint, i.e., an independent set of sieves,
+		for each batch in the window, and returning the selection of the
+		oldest checkpoint that started inside the window. Checkpoints whose
+		value is within a factor of (1 - epsilon) of an older checkpoint are
+		discarded, as in the smooth histogram approach to sliding windows.
+		Each batch must not be larger than the window. Default is None.
+
 	self.verbose : bool
 		Whether to display a progress bar during the optimization process.
 
@@ -1062,6 +1330,14 @@ class SieveGreedy(BaseOptimizer):
 		`_select_next` methods. This is the function that will be
 		optimized.
 
+	self.thresholds : list
+		The estimates of the optimal value that currently have a sieve.
+
+	self.checkpoints_ : list
+		When a window is used, the index of the first item seen by each
+		checkpoint, the state of its thresholds, and the state of its sieves,
+		from oldest to newest.
+
 	self.verbose : bool
 		Whether to display a progress bar during the optimization process.
 
@@ -1070,12 +1346,16 @@ class SieveGreedy(BaseOptimizer):
 		evaluated.
 	"""
 
-	def __init__(self, function=None, epsilon=0.01, random_state=None, 
-		n_jobs=None, verbose=False):
+	def __init__(self, function=None, epsilon=0.01, prune=True, window=None,
+		random_state=None, n_jobs=None, verbose=False):
 		self.epsilon = epsilon
+		self.prune = prune
+		self.window = window
 		self.n_seen_ = 0
+		self.n_thresholds_ = 1
 		self.thresholds = [1]
 		self.max_gain = -1
+		self.checkpoints_ = []
 
 		super().__init__(function=function, 
 			random_state=random_state, n_jobs=n_jobs, verbose=verbose)
@@ -1083,6 +1363,17 @@ class SieveGreedy(BaseOptimizer):
 	def select(self, X, k, sample_cost=None):
 		"""Select elements in a naive greedy manner."""
 
+		if self.window is None:
+			self._select(X, k, sample_cost)
+		else:
+			self._select_window(X, k, sample_cost)
+
+		self._set_best()
+		self.n_seen_ += X.shape[0]
+
+	def _select(self, X, k, sample_cost=None):
+		"""Update the sieves using a batch of data."""
+
 		# This is not a great use of the apricot API. An optimizer shouldn't
 		# be using its own special gain calculating function. However, it is
 		# much faster to do things this way so I'll keep it in for now.
@@ -1096,7 +1387,7 @@ class SieveGreedy(BaseOptimizer):
 		max_marginal_gain = marginal_gains.max()
 		if max_marginal_gain > self.max_gain:
 			self.max_gain = max_marginal_gain
-			j = len(self.thresholds)
+			j = self.n_thresholds_
 			threshold = (1 + self.epsilon) ** j - 1
 			while threshold <= self.max_gain * k:
 				self.thresholds.append(threshold)
@@ -1104,10 +1395,67 @@ class SieveGreedy(BaseOptimizer):
 				j += 1
 				threshold = (1 + self.epsilon) ** j - 1
 
+			self.n_thresholds_ = j
+
+		if self.prune and self.function.sieve_current_values_ is not None:
+			self._prune(k)
+
 		thresholds = numpy.array(self.thresholds, dtype='float64')
 		idxs = numpy.arange(n, dtype='int64') + self.n_seen_
 
 		self.function._calculate_sieve_gains(X, thresholds, idxs)
+		self.function._update_sieve_rows(self.n_seen_)
+
+	def _select_window(self, X, k, sample_cost=None):
+		"""Update the checkpoints of a sliding window using a batch of data."""
+
+		if X.shape[0] > self.window:
+			raise ValueError("Batches cannot be larger than the window.")
+
+		self.checkpoints_.append((self.n_seen_, {'thresholds': [1],
+			'n_thresholds_': 1, 'max_gain': -1}, None))
+
+		values = []
+		for i, (start, state, sieve_state) in enumerate(self.checkpoints_):
+			self._set_state(state, sieve_state)
+			self._select(X, k, sample_cost)
+
+			self.checkpoints_[i] = (start,) + self._get_state()
+			values.append(self.function.sieve_total_gains_.max())
+
+		i = 0
+		while i < len(self.checkpoints_) - 2:
+			if values[i+2] >= (1 - self.epsilon) * values[i]:
+				del self.checkpoints_[i+1], values[i+1]
+			else:
+				i += 1
+
+		# Keep at most one checkpoint that started before the window, which
+		# bounds the value of the checkpoints that started inside it.
+		start = self.n_seen_ + X.shape[0] - self.window
+		while len(self.checkpoints_) > 1 and self.checkpoints_[1][0] <= start:
+			del self.checkpoints_[0]
+
+		i = 0 if self.checkpoints_[0][0] >= start else 1
+		self._set_state(*self.checkpoints_[i][1:])
+
+	def _get_state(self):
+		"""Return the state of the thresholds and of the sieves."""
+
+		state = {'thresholds': self.thresholds, 
+			'n_thresholds_': self.n_thresholds_, 'max_gain': self.max_gain}
+		return state, self.function._get_sieve_state()
+
+	def _set_state(self, state, sieve_state):
+		"""Set the state of the thresholds and of the sieves."""
+
+		self.thresholds = state['thresholds']
+		self.n_thresholds_ = state['n_thresholds_']
+		self.max_gain = state['max_gain']
+		self.function._set_sieve_state(sieve_state)
+
+	def _set_best(self):
+		"""Set the selection of the function to that of the best sieve."""
 
 		best_idx = numpy.argmax(self.function.sieve_total_gains_)
 		ranking = self.function.sieve_selections_[best_idx]
@@ -1115,19 +1463,186 @@ class SieveGreedy(BaseOptimizer):
 		gain = self.function.sieve_gains_[best_idx]
 		gain = gain[:self.function.sieve_n_selected_[best_idx]]
 
-		for i in range(len(self.thresholds)):
-			for j in range(k):
-				m = self.function.sieve_selections_[i, j]
-				if m >= self.n_seen_:
-					if isinstance(self.function._X, scipy.sparse.csr_matrix):
-						self.function.sieve_subsets_[i, j] = self.function._X[m - self.n_seen_].toarray()[0]
-					else:
-						self.function.sieve_subsets_[i, j] = self.function._X[m - self.n_seen_]
-
 		self.function.ranking = ranking
 		self.function.gains = gain
-		self.function.subset = self.function.sieve_subsets_[best_idx]
-		self.n_seen_ += X.shape[0]
+		self.function.subset = self.function._sieve_subset(best_idx)
+
+	def _prune(self, k):
+		"""Discard the sieves that can no longer yield the best subset.
+
+		Following Sieve-Streaming++, the value of the best subset found so far
+		is a lower bound on the value of the optimal subset, so any estimate
+		of the optimal value below it is known to be too low and its sieve can
+		be discarded. Sieves that are already full can also be discarded
+		because their value can no longer change. The sieve with the best
+		value is always kept, as are the thresholds that do not have a sieve
+		yet but are at least as large as the lower bound.
+		"""
+
+		total_gains = self.function.sieve_total_gains_
+		n_selected = self.function.sieve_n_selected_
+		n_sieves = total_gains.shape[0]
+		best_idx = numpy.argmax(total_gains)
+
+		thresholds = numpy.array(self.thresholds, dtype='float64')
+		mask = thresholds >= total_gains[best_idx]
+		mask[:n_sieves] &= n_selected < k
+		mask[best_idx] = True
+
+		self.function._prune_sieves(mask[:n_sieves])
+		self.thresholds = thresholds[mask].tolist()
+
+
+class PreemptionGreedy(BaseOptimizer):
+	"""The preemption streaming algorithm.
+
+	The sieve streaming algorithm keeps many candidate subsets, one for each
+	estimate of the optimal value, and updates all of them for every batch.
+	When memory is scarce, a single candidate subset can be kept instead.
+	Each example in the subset is given a weight equal to its marginal gain
+	when it was added. While the subset has fewer than k examples, any
+	example with a positive gain is added. Once it is full, an incoming
+	example preempts the example with the smallest weight when its marginal
+	gain is larger than (1 + c) times that weight. This approach uses O(k)
+	memory and O(k) work per example, and has a constant-factor guarantee
+	for monotone submodular functions.
+
+	Because examples cannot be removed from the internal statistics of a
+	function, the gains within a batch are calculated with respect to the
+	current subset plus any examples that were preempted during the batch.
+	Because of submodularity these gains are lower bounds, making swaps more
+	conservative. The statistics are rebuilt from the current subset at the
+	start of each batch, so the calculation is exact when each batch has a
+	single example.
+
+	.. code::python
+
+		from apricot import FeatureBasedSelection
+
+		X = numpy.random.randint(10, size=(10000, 100))
+
+		selector = FeatureBasedSelection(100, 'sqrt', optimizer='preemption')
+		selector.partial_fit(X)
+
+	Parameters
+	----------
+	self.function : base.BaseSelection
+		A submodular function that implements the `_calculate_gains` and
+		`_select_next` methods. This is the function that will be
+		optimized.
+
+	c : float, optional
+		The factor by which the gain of an incoming example must exceed the
+		smallest weight in the subset, such that a swap is made when the gain
+		is larger than (1 + c) times that weight. Default is 1.
+
+	self.verbose : bool
+		Whether to display a progress bar during the optimization process.
+
+
+	Attributes
+	----------
+	self.function : base.BaseSelection
+		A submodular function that implements the `_calculate_gains` and
+		`_select_next` methods. This is the function that will be
+		optimized.
+
+	self.ranking_ : numpy.ndarray
+		The index in the stream of each example in the subset.
+
+	self.weights_ : numpy.ndarray
+		The weight of each example in the subset, which is its marginal gain
+		when it was added.
+
+	self.verbose : bool
+		Whether to display a progress bar during the optimization process.
+	"""
+
+	def __init__(self, function=None, c=1., random_state=None, n_jobs=None, 
+		verbose=False):
+		self.c = c
+		self.n_seen_ = 0
+		self.ranking_ = numpy.zeros(0, dtype='int64')
+		self.weights_ = numpy.zeros(0, dtype='float64')
+		self.inputs_ = None
+		self.rows_ = None
+
+		super().__init__(function=function, 
+			random_state=random_state, n_jobs=n_jobs, verbose=verbose)
+
+	def select(self, X, k, sample_cost=None):
+		"""Select elements using the preemption streaming algorithm."""
+
+		n, m = X.shape[0], self.ranking_.shape[0]
+		if sample_cost is None:
+			sample_cost = numpy.ones(n, dtype='float64')
+
+		# The subset is added to the front of the batch. When a reservoir is
+		# still filling up the batch can be wider than the stored rows.
+		if self.inputs_ is None:
+			Z, Z_raw = X, self.function._X
+		elif isinstance(X, scipy.sparse.csr_matrix):
+			Z = _vstack(self.inputs_, X)
+			Z_raw = _vstack(self.rows_, self.function._X)
+		else:
+			inputs = numpy.zeros((m, X.shape[1]), dtype='float64')
+			inputs[:, :self.inputs_.shape[1]] = self.inputs_
+			Z = numpy.concatenate([inputs, X])
+			Z_raw = _vstack(self.rows_, self.function._X)
+
+		self.function._X = Z_raw
+		self.function._initialize(Z)
+		for j in range(m):
+			self.function._select_next(Z[j], 0., j)
+
+		members = list(range(m))
+		weights = list(self.weights_)
+
+		start = m
+		while start < Z.shape[0]:
+			idxs = numpy.arange(start, Z.shape[0], dtype='int64')
+			gains = self.function._calculate_gains(Z, idxs) / sample_cost[idxs - m]
+
+			if len(members) < k:
+				threshold = 0.
+			else:
+				threshold = (1 + self.c) * min(weights)
+
+			candidates = numpy.where(gains > threshold)[0]
+			if candidates.shape[0] == 0:
+				break
+
+			j, gain = idxs[candidates[0]], gains[candidates[0]]
+			if len(members) == k:
+				i = numpy.argmin(weights)
+				del members[i], weights[i]
+
+			members.append(j)
+			weights.append(gain)
+			self.function._select_next(Z[j], gain, j)
+
+			if self.verbose:
+				self.function.pbar.update(1)
+
+			start = j + 1
+
+		members = numpy.array(members, dtype='int64')
+		idxs = numpy.concatenate([self.ranking_, 
+			numpy.arange(n, dtype='int64') + self.n_seen_])
+
+		self.ranking_ = idxs[members]
+		self.weights_ = numpy.array(weights, dtype='float64')
+		self.inputs_ = Z[members]
+		self.rows_ = Z_raw[members]
+
+		self.function.ranking = self.ranking_
+		self.function.gains = self.weights_
+		if isinstance(self.rows_, scipy.sparse.csr_matrix):
+			self.function.subset = self.rows_.toarray()
+		else:
+			self.function.subset = self.rows_
+
+		self.n_seen_ += n
 
 
 OPTIMIZERS = {
@@ -1140,6 +1655,8 @@ OPTIMIZERS = {
 	'stochastic' : StochasticGreedy,
 	'sample' : SampleGreedy,
 	'greedi' : GreeDi,
+	'coreset' : CoresetGreedy,
 	'bidirectional' : BidirectionalGreedy,
 	'sieve' : SieveGreedy,
+	'preemption' : PreemptionGreedy,
 }
@@ -6,9 +6,18 @@ This code contains utility functions to support the main functionality of
 the code.
 """
 
+import os
+import queue
+import shutil
+import hashlib
+import tempfile
 import numbers
 import numpy
 import itertools
+import threading
+import zipfile
+
+from concurrent.futures import ThreadPoolExecutor
 
 from heapq import heappush
 from heapq import heappop
@@ -16,10 +25,14 @@ from heapq import heapify
 from heapq import heapreplace
 
 from scipy.sparse import csr_matrix
+from scipy.sparse import vstack
 
 from sklearn.metrics import pairwise_distances
 from sklearn.neighbors import KNeighborsTransformer
 
+from numba import njit
+from numba import prange
+
 class PriorityQueue(object):
     """A priority queue implementation.
 
@@ -178,10 +191,1001 @@ def check_random_state(seed):
         return seed
     raise ValueError(f"{seed!r} cannot be used to seed a numpy.random.RandomState instance")
 
-def _calculate_pairwise_distances(X, Y=None, metric='precomputed', n_neighbors=None):
+def _calculate_pairwise_block(X, Y, metric='euclidean', idxs=None):
+    """Calculate the distances between a block of rows and all rows of Y.
+
+    For cosine and correlation the distances are returned after the
+    1 - (1 - d) ** 2 transformation, so that subtracting them from one gives
+    the similarities. For all other metrics the raw distances are returned,
+    squared for euclidean, and the similarities are the largest distance in
+    the full matrix minus these.
+
+    Parameters
+    ----------
+    X : numpy.ndarray, shape=(n, d)
+        The block of rows to calculate distances for.
+
+    Y : numpy.ndarray, shape=(m, d)
+        The data to calculate distances to.
+
+    metric : str, optional
+        The distance metric to use. Default is 'euclidean'.
+
+    idxs : numpy.ndarray or None, shape=(n,), optional
+        The row of Y that each row of X corresponds to. The distance between
+        these pairs is set to exactly zero. Default is None.
+
+    Returns
+    -------
+    X_block : numpy.ndarray, shape=(n, m)
+        The distances.
+    """
+
+    if metric == 'euclidean':
+        X_block = pairwise_distances(X, Y=Y, metric=metric, squared=True)
+    else:
+        X_block = pairwise_distances(X, Y=Y, metric=metric)
+
+    if idxs is not None:
+        X_block[numpy.arange(X_block.shape[0]), idxs] = 0
+
+    if metric == 'correlation' or metric == 'cosine':
+        X_block = numpy.subtract(1, X_block, out=X_block)
+        X_block = numpy.square(X_block, out=X_block)
+        X_block = numpy.subtract(1, X_block, out=X_block)
+
+    return X_block
+
+def _calculate_pairwise_distances_blocked(X, Y=None, metric='euclidean',
+    block_size=None, max_memory=None, out=None, n_jobs=1):
+    """Calculate a dense similarity matrix one block of rows at a time.
+
+    The distances between each block of rows of X and all rows of Y are
+    calculated and transformed into similarities in the same way as in
+    `_calculate_pairwise_distances`, and are written directly into the
+    output matrix, so that the peak memory is the output matrix plus the
+    temporaries of a single block per thread. For metrics other than cosine
+    and correlation, the similarities depend on the largest distance in the
+    matrix, and so the distances are written in a first pass that also finds
+    the maximum and are transformed in place block by block in a second pass.
+
+    Parameters
+    ----------
+    X : numpy.ndarray, shape=(n, d)
+        The data to calculate similarities for.
+
+    Y : numpy.ndarray or None, shape=(m, d), optional
+        The data to calculate similarities to. If None, use X. Default is
+        None.
+
+    metric : str, optional
+        The distance metric to use. Default is 'euclidean'.
+
+    block_size : int or None, optional
+        The number of rows in each block. If None, the size is derived from
+        `max_memory`. Default is None.
+
+    max_memory : int or None, optional
+        The maximum number of bytes that the distances of a single block
+        should take. Only used if `block_size` is None. If both are None,
+        blocks of 1024 rows are used. Default is None.
+
+    out : numpy.ndarray or None, shape=(n, m), optional
+        A preallocated float64 matrix, such as a `numpy.memmap`, to write the
+        similarities into. If None, a new matrix is allocated. Default is
+        None.
+
+    n_jobs : int, optional
+        The number of threads to calculate blocks with. Default is 1.
+
+    Returns
+    -------
+    out : numpy.ndarray, shape=(n, m)
+        The similarity matrix.
+    """
+
+    Y_ = X if Y is None else Y
+    n, m = X.shape[0], Y_.shape[0]
+
+    if block_size is None:
+        if max_memory is None:
+            block_size = 1024
+        else:
+            block_size = max(1, int(max_memory // (8 * max(m, 1))))
+
+    if out is None:
+        out = numpy.empty((n, m), dtype='float64')
+    elif out.shape != (n, m):
+        raise ValueError("out must have shape {}.".format((n, m)))
+
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n,
+        block_size)]
+
+    def calculate_block(block):
+        start, end = block
+
+        # The distance of each example to itself is exactly zero when all
+        # pairwise distances are calculated at once, but may not be when a
+        # block of rows is compared to all rows.
+        idxs = numpy.arange(start, end) if Y is None else None
+        X_block = _calculate_pairwise_block(X[start:end], Y_, metric=metric,
+            idxs=idxs)
+
+        if metric == 'correlation' or metric == 'cosine':
+            numpy.subtract(1, X_block, out=out[start:end])
+            return None
+
+        out[start:end] = X_block
+        return X_block.max() if X_block.size > 0 else None
+
+    maxes = _map_blocks(calculate_block, blocks, n_jobs)
+
+    maxes = [value for value in maxes if value is not None]
+    if len(maxes) > 0:
+        max_value = max(maxes)
+        for start, end in blocks:
+            numpy.subtract(max_value, out[start:end], out=out[start:end])
+
+    return out
+
+def _calculate_pairwise_distances_thresholded(X, Y=None, metric='euclidean',
+    min_similarity=0., block_size=None, n_jobs=1):
+    """Calculate a sparse similarity matrix one block of rows at a time.
+
+    The similarities between each block of rows of X and all rows of Y are
+    calculated in the same way as in `_calculate_pairwise_distances`, and
+    those smaller than `min_similarity` are dropped before the block is
+    added to the sparse matrix, so that the dense similarities of only a
+    single block per thread are held in memory. For metrics other than
+    cosine and correlation, the similarities depend on the largest distance
+    in the matrix, and so a first pass over all blocks finds the largest
+    distance.
+
+    Parameters
+    ----------
+    X : numpy.ndarray, shape=(n, d)
+        The data to calculate similarities for.
+
+    Y : numpy.ndarray or None, shape=(m, d), optional
+        The data to calculate similarities to. If None, use X. Default is
+        None.
+
+    metric : str, optional
+        The distance metric to use. Default is 'euclidean'.
+
+    min_similarity : float, optional
+        The smallest similarity to keep. Default is 0.
+
+    block_size : int or None, optional
+        The number of rows in each block. If None, blocks of 1024 rows are
+        used. Default is None.
+
+    n_jobs : int, optional
+        The number of threads to calculate blocks with. Default is 1.
+
+    Returns
+    -------
+    X_pairwise : scipy.sparse.csr_matrix, shape=(n, m)
+        The sparse similarity matrix.
+    """
+
+    Y_ = X if Y is None else Y
+    n, m = X.shape[0], Y_.shape[0]
+    block_size = 1024 if block_size is None else block_size
+
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n,
+        block_size)]
+
+    def calculate_distances(block):
+        start, end = block
+        idxs = numpy.arange(start, end) if Y is None else None
+        return _calculate_pairwise_block(X[start:end], Y_, metric=metric,
+            idxs=idxs)
+
+    if metric == 'correlation' or metric == 'cosine':
+        max_value = 1.
+    else:
+        max_value = max(_map_blocks(lambda block: calculate_distances(
+            block).max(), blocks, n_jobs))
+
+    def calculate_block(block):
+        X_block = calculate_distances(block)
+        X_block = numpy.subtract(max_value, X_block, out=X_block)
+        X_block[X_block < min_similarity] = 0
+        return csr_matrix(X_block)
+
+    X_pairwise = vstack(_map_blocks(calculate_block, blocks, n_jobs), 
+        format='csr')
+
+    if X_pairwise.indices.dtype != 'int32':
+        X_pairwise = csr_matrix((X_pairwise.data, 
+            X_pairwise.indices.astype('int32'), 
+            X_pairwise.indptr.astype('int32')), shape=X_pairwise.shape)
+
+    return X_pairwise
+
+def _calculate_pairwise_distances_packed(X, metric='euclidean', 
+    block_size=None, n_jobs=1):
+    """Calculate the upper triangle of a similarity matrix.
+
+    Each block of rows of X is compared only to itself and to the rows that
+    come after it, and the similarities on and above the diagonal are
+    written into a packed array, so that neither the full matrix nor the
+    similarities below the diagonal are ever calculated. The similarities
+    are the same as those from `_calculate_pairwise_distances_blocked`.
+
+    Parameters
+    ----------
+    X : numpy.ndarray, shape=(n, d)
+        The data to calculate similarities for.
+
+    metric : str, optional
+        The distance metric to use. Default is 'euclidean'.
+
+    block_size : int or None, optional
+        The number of rows in each block. If None, blocks of 1024 rows are
+        used. Default is None.
+
+    n_jobs : int, optional
+        The number of threads to calculate blocks with. Default is 1.
+
+    Returns
+    -------
+    X_pairwise : _PackedSymmetric, shape=(n, n)
+        The similarity matrix.
+    """
+
+    n = X.shape[0]
+    block_size = 1024 if block_size is None else block_size
+    packed = numpy.empty(n * (n + 1) // 2, dtype='float64')
+
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n,
+        block_size)]
+
+    def calculate_block(block):
+        start, end = block
+        X_block = _calculate_pairwise_block(X[start:end], X[start:], 
+            metric=metric, idxs=numpy.arange(end - start))
+
+        _pack_rows(X_block, packed, start, n)
+        return X_block.max()
+
+    maxes = _map_blocks(calculate_block, blocks, n_jobs)
+
+    if metric == 'correlation' or metric == 'cosine':
+        numpy.subtract(1, packed, out=packed)
+    elif len(maxes) > 0:
+        numpy.subtract(max(maxes), packed, out=packed)
+
+    return _PackedSymmetric(packed, n)
+
+def _map_blocks(func, blocks, n_jobs=1):
+    """Apply a function to each block of rows, using threads if n_jobs > 1."""
+
+    if n_jobs == 1 or len(blocks) == 1:
+        return [func(block) for block in blocks]
+
+    n_jobs = n_jobs if n_jobs > 0 else None
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(func, blocks))
+
+def _normalize_rows(X, metric):
+    """Scale each row to unit length, after centering it for correlation.
+
+    The cosine similarity between two normalized rows, or the correlation
+    between two centered and normalized rows, is their dot product. Rows
+    that are entirely zero are left as zeros.
+    """
+
+    X = numpy.array(X, dtype='float64')
+    if metric == 'correlation':
+        X -= X.mean(axis=1, keepdims=True)
+
+    norms = numpy.linalg.norm(X, axis=1, keepdims=True)
+    X /= numpy.where(norms > 0, norms, 1)
+    return X
+
+def _calculate_nearest_neighbors_blocked(X, Y=None, metric='euclidean',
+    n_neighbors=10, block_size=None, n_jobs=1):
+    """Find the nearest neighbors of each row one block of rows at a time.
+
+    The distances between each block of rows of X and all rows of Y are
+    calculated, and only the smallest `n_neighbors + 1` distances in each
+    row are kept, matching `KNeighborsTransformer` in distance mode. The
+    result is a sparse matrix of distances, with euclidean distances not
+    squared, that is transformed into similarities in the same way as the
+    output of `KNeighborsTransformer`. The peak memory is the sparse matrix
+    plus the distances of a single block per thread, rather than the full
+    dense matrix of distances.
+
+    Parameters
+    ----------
+    X : numpy.ndarray, shape=(n, d)
+        The data to find the nearest neighbors for.
+
+    Y : numpy.ndarray or None, shape=(m, d), optional
+        The data to find the nearest neighbors in. If None, use X, in which
+        case each example is its own nearest neighbor. Default is None.
+
+    metric : str, optional
+        The distance metric to use. Default is 'euclidean'.
+
+    n_neighbors : int, optional
+        The number of neighbors to keep in addition to the nearest one.
+        Default is 10.
+
+    block_size : int or None, optional
+        The number of rows in each block. If None, blocks of 1024 rows are
+        used. Default is None.
+
+    n_jobs : int, optional
+        The number of threads to calculate blocks with. Default is 1.
+
+    Returns
+    -------
+    X_pairwise : scipy.sparse.csr_matrix, shape=(n, m)
+        The distances to the nearest neighbors of each row.
+    """
+
+    # For cosine and correlation the rows are normalized once, so that the
+    # distances of each block are a single matrix product.
+    normalized = metric == 'correlation' or metric == 'cosine'
+    if normalized:
+        X = _normalize_rows(X, metric)
+        Y = None if Y is None else _normalize_rows(Y, metric)
+
+    Y_ = X if Y is None else Y
+    n, m = X.shape[0], Y_.shape[0]
+    k = min(n_neighbors + 1, m)
+    block_size = 1024 if block_size is None else block_size
+
+    blocks = [(start, min(start + block_size, n)) for start in range(0, n,
+        block_size)]
+
+    def calculate_block(block):
+        start, end = block
+        idxs = numpy.arange(start, end) if Y is None else None
+
+        if normalized:
+            # An in-place version of 1 - (1 - d) ** 2 where d = 1 - X.dot(Y.T)
+            X_block = numpy.dot(X[start:end], Y_.T)
+            X_block = numpy.clip(X_block, -1, 1, out=X_block)
+            X_block = numpy.square(X_block, out=X_block)
+            X_block = numpy.subtract(1, X_block, out=X_block)
+
+            if idxs is not None:
+                X_block[numpy.arange(end - start), idxs] = 0
+        else:
+            X_block = _calculate_pairwise_block(X[start:end], Y_, 
+                metric=metric, idxs=idxs)
+
+        X_block = _keep_nearest_neighbors(numpy.negative(X_block, 
+            out=X_block), k)
+        X_block.data = numpy.negative(X_block.data, out=X_block.data)
+        if metric == 'euclidean':
+            X_block.data = numpy.sqrt(numpy.maximum(X_block.data, 0,
+                out=X_block.data), out=X_block.data)
+
+        return X_block
+
+    X_blocks = _map_blocks(calculate_block, blocks, n_jobs)
+    return vstack(X_blocks, format='csr')
+
+@njit(nogil=True, fastmath=True)
+def _nn_distance(X, u, v, metric):
+    """The distance between two rows, squared if euclidean."""
+
+    d = 0.
+    if metric == 0:
+        for l in range(X.shape[1]):
+            d += (X[u, l] - X[v, l]) ** 2
+        return d
+
+    for l in range(X.shape[1]):
+        d += X[u, l] * X[v, l]
+    return 1. - d * d
+
+
+@njit(nogil=True, fastmath=True)
+def _nn_heap_push(dists, idxs, flags, i, d, j, flag):
+    """Add a neighbor to the max-heap of the nearest neighbors of a row."""
+
+    if d >= dists[i, 0]:
+        return 0
+
+    k = idxs.shape[1]
+    for p in range(k):
+        if idxs[i, p] == j:
+            return 0
+
+    p = 0
+    while True:
+        left, right = 2 * p + 1, 2 * p + 2
+        if left >= k:
+            break
+        elif right >= k or dists[i, left] >= dists[i, right]:
+            child = left
+        else:
+            child = right
+
+        if dists[i, child] <= d:
+            break
+
+        dists[i, p] = dists[i, child]
+        idxs[i, p] = idxs[i, child]
+        flags[i, p] = flags[i, child]
+        p = child
+
+    dists[i, p] = d
+    idxs[i, p] = j
+    flags[i, p] = flag
+    return 1
+
+
+@njit(nogil=True, fastmath=True)
+def _nn_candidates(idxs, flags, new, new_priorities, old, old_priorities):
+    """Sample new and old candidates from the neighbors in both directions."""
+
+    n, k = idxs.shape
+    new_flags = numpy.zeros(new.shape, dtype=numpy.int8)
+    old_flags = numpy.zeros(old.shape, dtype=numpy.int8)
+
+    for i in range(n):
+        for p in range(k):
+            j = idxs[i, p]
+            if j < 0:
+                continue
+
+            priority = numpy.random.random()
+            if flags[i, p] == 1:
+                _nn_heap_push(new_priorities, new, new_flags, i, priority, j, 
+                    0)
+                _nn_heap_push(new_priorities, new, new_flags, j, priority, i, 
+                    0)
+            else:
+                _nn_heap_push(old_priorities, old, old_flags, i, priority, j, 
+                    0)
+                _nn_heap_push(old_priorities, old, old_flags, j, priority, i, 
+                    0)
+
+    # Neighbors that have been sampled as new candidates are compared to the
+    # other candidates in this iteration and so are no longer new.
+    for i in range(n):
+        for p in range(k):
+            if flags[i, p] == 1:
+                for q in range(new.shape[1]):
+                    if new[i, q] == idxs[i, p]:
+                        flags[i, p] = 0
+                        break
+
+
+@njit(nogil=True, parallel=True, fastmath=True)
+def _nn_join(X, metric, dists, new, old, start, pairs, pair_dists, n_pairs):
+    """Calculate the distances between the candidates of a block of rows.
+
+    Only pairs that would improve the neighbors of either row are kept, and
+    they are written to per-row buffers so that the heaps can be updated
+    afterwards in a fixed order.
+    """
+
+    c = new.shape[1]
+    for b in prange(pairs.shape[0]):
+        i = start + b
+        if i >= new.shape[0]:
+            n_pairs[b] = 0
+            continue
+
+        m = 0
+        for a in range(c):
+            u = new[i, a]
+            if u < 0:
+                continue
+
+            for q in range(a + 1, 2 * c):
+                v = new[i, q] if q < c else old[i, q - c]
+                if v < 0 or v == u:
+                    continue
+
+                d = _nn_distance(X, u, v, metric)
+                if d < dists[u, 0] or d < dists[v, 0]:
+                    pairs[b, m, 0] = u
+                    pairs[b, m, 1] = v
+                    pair_dists[b, m] = d
+                    m += 1
+
+        n_pairs[b] = m
+
+
+@njit(nogil=True, fastmath=True)
+def _nn_descent(X, metric, k, max_candidates, n_iters, delta, block_size,
+    seed):
+    """Find approximate nearest neighbors with NN-descent."""
+
+    numpy.random.seed(seed)
+    n = X.shape[0]
+
+    dists = numpy.full((n, k), numpy.inf)
+    idxs = numpy.full((n, k), -1, dtype=numpy.int64)
+    flags = numpy.zeros((n, k), dtype=numpy.int8)
+
+    for i in range(n):
+        for _ in range(k):
+            j = numpy.random.randint(n)
+            if j != i:
+                _nn_heap_push(dists, idxs, flags, i, 
+                    _nn_distance(X, i, j, metric), j, 1)
+
+    c = max_candidates
+    block_size = min(block_size, n)
+    pairs = numpy.empty((block_size, c * (2 * c - 1), 2), dtype=numpy.int64)
+    pair_dists = numpy.empty((block_size, c * (2 * c - 1)))
+    n_pairs = numpy.empty(block_size, dtype=numpy.int64)
+
+    for _ in range(n_iters):
+        new = numpy.full((n, c), -1, dtype=numpy.int64)
+        old = numpy.full((n, c), -1, dtype=numpy.int64)
+        new_priorities = numpy.full((n, c), numpy.inf)
+        old_priorities = numpy.full((n, c), numpy.inf)
+        _nn_candidates(idxs, flags, new, new_priorities, old, old_priorities)
+
+        n_updates = 0
+        for start in range(0, n, block_size):
+            _nn_join(X, metric, dists, new, old, start, pairs, pair_dists, 
+                n_pairs)
+
+            for b in range(min(block_size, n - start)):
+                for m in range(n_pairs[b]):
+                    u, v, d = pairs[b, m, 0], pairs[b, m, 1], pair_dists[b, m]
+                    n_updates += _nn_heap_push(dists, idxs, flags, u, d, v, 1)
+                    n_updates += _nn_heap_push(dists, idxs, flags, v, d, u, 1)
+
+        if n_updates <= delta * n * k:
+            break
+
+    return idxs, dists
+
+
+class NNDescent(object):
+    """Approximate nearest neighbors found using NN-descent.
+
+    Passing this object in as the `n_neighbors` parameter of a graph-based
+    selector builds the sparse similarity matrix from approximate nearest
+    neighbors instead of exact ones. NN-descent starts from random neighbors
+    and repeatedly compares the neighbors of each example's neighbors to
+    each other, keeping the closest ones, which is much faster than an exact
+    search when there are many examples or many features. The distances are
+    calculated by a compiled kernel and the same metrics are used as for
+    dense similarity matrices, but only 'euclidean', 'cosine' and
+    'correlation' are supported.
+
+    For more details, see https://dl.acm.org/doi/10.1145/1963405.1963487
+
+    Parameters
+    ----------
+    n_neighbors : int, optional
+        The number of nearest neighbors to find for each example. As with
+        KNeighborsTransformer, each example is also kept as its own nearest
+        neighbor. Default is 10.
+
+    max_candidates : int or None, optional
+        The number of new and of old candidates sampled for each example in
+        each iteration. Larger values find more of the true neighbors but
+        take longer. If None, use twice `n_neighbors`, up to 60. Default is
+        None.
+
+    n_iters : int, optional
+        The maximum number of iterations. Default is 10.
+
+    delta : float, optional
+        Stop early once fewer than delta * n * n_neighbors neighbors are
+        updated in an iteration. Smaller values find more of the true
+        neighbors but take longer. Default is 0.001.
+
+    block_size : int or None, optional
+        The number of examples whose candidates are compared in parallel
+        before the neighbors are updated. If None, the size is chosen so that
+        the buffered comparisons of a block take about 64MB. Default is None.
+
+    random_state : int or RandomState or None, optional
+        The random seed to use for the initial neighbors and the sampling of
+        candidates. Default is None.
+    """
+
+    def __init__(self, n_neighbors=10, max_candidates=None, n_iters=10,
+        delta=0.001, block_size=None, random_state=None):
+        self.n_neighbors = n_neighbors
+        self.max_candidates = max_candidates
+        self.n_iters = n_iters
+        self.delta = delta
+        self.block_size = block_size
+        self.random_state = check_random_state(random_state)
+
+    def kneighbors_graph(self, X, metric='euclidean'):
+        """Find the approximate nearest neighbors of each example.
+
+        Parameters
+        ----------
+        X : numpy.ndarray, shape=(n, d)
+            The data to find the nearest neighbors in.
+
+        metric : str, optional
+            The distance metric to use. Default is 'euclidean'.
+
+        Returns
+        -------
+        X_pairwise : scipy.sparse.csr_matrix, shape=(n, n)
+            The distances to the nearest neighbors of each example, in the
+            same form as `_calculate_nearest_neighbors_blocked`.
+        """
+
+        if metric not in ('euclidean', 'cosine', 'correlation'):
+            raise ValueError("NNDescent only supports the 'euclidean', " \
+                "'cosine' and 'correlation' metrics.")
+
+        if metric == 'euclidean':
+            X = numpy.array(X, dtype='float64')
+        else:
+            X = _normalize_rows(X, metric)
+
+        n = X.shape[0]
+        k = min(self.n_neighbors, n - 1)
+
+        c = self.max_candidates or min(2 * self.n_neighbors, 60)
+        block_size = self.block_size or max(1, 2 ** 26 // (24 * c * (2*c-1)))
+
+        seed = self.random_state.randint(2 ** 31)
+        idxs, dists = _nn_descent(X, 0 if metric == 'euclidean' else 1, k,
+            c, self.n_iters, self.delta, block_size, seed)
+
+        idxs = numpy.concatenate([numpy.arange(n)[:, None], idxs], axis=1)
+        dists = numpy.concatenate([numpy.zeros((n, 1)), dists], axis=1)
+        dists = numpy.maximum(dists, 0)
+        if metric == 'euclidean':
+            dists = numpy.sqrt(dists)
+
+        # Unfilled neighbors, which only occur for tiny data sets, are sorted
+        # to the end of each row and dropped.
+        order = numpy.argsort(numpy.where(idxs < 0, n, idxs), axis=1)
+        idxs = numpy.take_along_axis(idxs, order, axis=1)
+        dists = numpy.take_along_axis(dists, order, axis=1)
+
+        mask = idxs >= 0
+        indptr = numpy.concatenate([[0], numpy.cumsum(mask.sum(axis=1))])
+        return csr_matrix((dists[mask], idxs[mask].astype('int32'),
+            indptr.astype('int32')), shape=(n, n))
+
+class SimilarityCache(object):
+    """A cache of similarity matrices stored on disk.
+
+    Passing this object, or the path to a directory, in as the
+    `similarity_cache` parameter of a graph-based selector stores each
+    similarity matrix that the selector builds from a feature matrix. The
+    matrices are keyed by a hash of the contents of the feature matrix and
+    the parameters used to build them, so when the same similarity matrix is
+    needed again, such as when selecting a different number of examples or
+    using a different optimizer or function, it is memory-mapped from disk
+    instead of being recalculated. Pages of a memory-mapped matrix are only
+    read from disk when they are used. Once the cache is larger than
+    `max_size`, the least recently used matrices are removed.
+
+    Dense matrices, sparse matrices and packed symmetric matrices are each
+    stored as .npy files in their own directory. Approximate nearest
+    neighbors, such as those from `NNDescent`, are not cached because they
+    depend on a random state.
+
+    Parameters
+    ----------
+    directory : str or os.PathLike
+        The directory to store the similarity matrices in. It is created if
+        it does not exist.
+
+    max_size : int or None, optional
+        The maximum number of bytes that the stored similarity matrices can
+        take. If None, matrices are never removed. Default is None.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = str(directory)
+        self.max_size = max_size
+
+    def key(self, X, Y=None, **params):
+        """Hash a feature matrix and the parameters of a similarity matrix.
+
+        Parameters
+        ----------
+        X : numpy.ndarray, shape=(n, d)
+            The feature matrix.
+
+        Y : numpy.ndarray or None, shape=(m, d), optional
+            The ground set, if one is used. Default is None.
+
+        **params : dict
+            The parameters used to build the similarity matrix.
+
+        Returns
+        -------
+        key : str
+            The hexadecimal digest of the hash.
+        """
+
+        digest = hashlib.blake2b(digest_size=20)
+        for A in (X, Y):
+            if A is None:
+                digest.update(b'None')
+                continue
+
+            A = numpy.ascontiguousarray(A)
+            digest.update(repr((A.shape, A.dtype.str)).encode())
+            digest.update(A.reshape(-1).view('uint8'))
+
+        digest.update(repr(sorted(params.items())).encode())
+        return digest.hexdigest()
+
+    def load(self, key):
+        """Memory-map a stored similarity matrix, or return None if missing.
+
+        The matrix is mapped copy-on-write, so that it can be passed to the
+        compiled kernels without being copied and the file on disk is never
+        modified.
+        """
+
+        path = os.path.join(self.directory, key)
+        if not os.path.isdir(path):
+            return None
+
+        def load_array(name):
+            return numpy.load(os.path.join(path, name + '.npy'), 
+                mmap_mode='c').view(numpy.ndarray)
+
+        try:
+            if os.path.exists(os.path.join(path, 'packed.npy')):
+                packed = load_array('packed')
+                n = int(round((numpy.sqrt(8 * packed.shape[0] + 1) - 1) / 2))
+                X_pairwise = _PackedSymmetric(packed, n)
+            elif os.path.exists(os.path.join(path, 'indptr.npy')):
+                X_pairwise = csr_matrix((load_array('data'), 
+                    load_array('indices'), load_array('indptr')), 
+                    shape=tuple(load_array('shape')), copy=False)
+            else:
+                X_pairwise = load_array('X')
+        except (OSError, ValueError):
+            return None
+
+        # The modification time of each directory records when it was last
+        # used, because access times are not updated on many file systems.
+        os.utime(path)
+        return X_pairwise
+
+    def store(self, key, X_pairwise):
+        """Store a similarity matrix and remove the least recently used ones.
+
+        The files are written to a temporary directory that is then renamed,
+        so that a partially written matrix is never loaded.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key)
+        tmp = tempfile.mkdtemp(prefix='.', dir=self.directory)
+
+        if isinstance(X_pairwise, _PackedSymmetric):
+            arrays = {'packed': X_pairwise.packed}
+        elif isinstance(X_pairwise, csr_matrix):
+            arrays = {'data': X_pairwise.data, 'indices': X_pairwise.indices,
+                'indptr': X_pairwise.indptr, 'shape': numpy.array(
+                X_pairwise.shape)}
+        else:
+            arrays = {'X': X_pairwise}
+
+        try:
+            for name, X in arrays.items():
+                numpy.save(os.path.join(tmp, name + '.npy'), X)
+            os.rename(tmp, path)
+        except OSError:
+            # Another process may have stored the same matrix first.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Remove the least recently used matrices until under max_size."""
+
+        if self.max_size is None or not os.path.isdir(self.directory):
+            return
+
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.stat(path).st_mtime, size, name, path))
+
+        total = sum(entry[1] for entry in entries)
+        for _, size, name, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+class SimilarityGraph(object):
+    """A similarity matrix that is built once and shared by selectors.
+
+    Passing this object in to the `fit` method of a graph-based selector, or
+    of a mixture of them, selects examples using its similarity matrix
+    instead of building a new one, so that several functions, optimizers or
+    numbers of examples can be used on the same data without recalculating
+    or copying the similarities. The row sums, diagonal, minimum and maximum
+    of the matrix are calculated once when the graph is built and are used
+    by the selectors in place of their own passes over the matrix. The
+    similarity parameters of the selectors themselves, such as `metric` and
+    `n_neighbors`, are ignored.
+
+    Parameters
+    ----------
+    X : list, numpy.ndarray, scipy.sparse.csr_matrix, str or os.PathLike
+        The feature matrix to build the graph from or, if `metric` is
+        'precomputed', a square similarity matrix. A precomputed matrix can
+        be dense, sparse, memory-mapped, or the path to a .npy file or a
+        directory of .npy files containing blocks of its rows.
+
+    metric : str, optional
+        The metric to convert the features into similarities with, as in the
+        graph-based selectors. Default is 'euclidean'.
+
+    n_neighbors : int, NNDescent or None, optional
+        The number of nearest neighbors to keep for each example, as in the
+        graph-based selectors. Default is None.
+
+    min_similarity : float or None, optional
+        The smallest similarity to keep, as in the graph-based selectors.
+        Default is None.
+
+    block_size : int or None, optional
+        The number of rows whose similarities are calculated at a time, as
+        in the graph-based selectors. Default is None.
+
+    packed : bool, optional
+        Whether to store only the upper triangle of a dense similarity
+        matrix, as in the graph-based selectors. Default is False.
+
+    cache : str, os.PathLike, SimilarityCache or None, optional
+        A cache to load the similarity matrix from, or store it in, as with
+        the `similarity_cache` parameter of the graph-based selectors.
+        Default is None.
+
+    n_jobs : int, optional
+        The number of threads to calculate blocks of similarities with.
+        Default is 1.
+
+    Attributes
+    ----------
+    X : numpy.ndarray or None
+        The feature matrix, or None if the similarities were precomputed.
+
+    X_pairwise : numpy.ndarray, scipy.sparse.csr_matrix or _RowBlocks
+        The similarity matrix.
+
+    row_sums : numpy.ndarray, shape=(n,)
+        The sum of each row of the similarity matrix.
+
+    diagonal : numpy.ndarray, shape=(n,)
+        The similarity of each example to itself.
+
+    min : float
+        The smallest similarity.
+
+    max : float
+        The largest similarity.
+    """
+
+    def __init__(self, X, metric='euclidean', n_neighbors=None, 
+        min_similarity=None, block_size=None, packed=False, cache=None, 
+        n_jobs=1):
+        if n_neighbors is not None and min_similarity is not None:
+            raise ValueError("Only one of n_neighbors and min_similarity " \
+                "can be set.")
+        if packed and (n_neighbors is not None or min_similarity is not None):
+            raise ValueError("Only dense similarity matrices can be packed.")
+
+        metric = "correlation" if metric == "corr" else metric
+        if isinstance(cache, (str, os.PathLike)):
+            cache = SimilarityCache(cache)
+
+        if metric == 'precomputed':
+            if isinstance(X, (str, os.PathLike, numpy.memmap)):
+                X_pairwise = _open_row_blocks(X)
+            elif isinstance(X, csr_matrix):
+                X_pairwise = X.astype('float64', copy=False)
+            else:
+                X_pairwise = numpy.asarray(X, dtype='float64')
+
+            if X_pairwise.ndim != 2 or \
+                X_pairwise.shape[0] != X_pairwise.shape[1]:
+                raise ValueError("Precomputed similarity matrices must be " \
+                    "square and symmetric.")
+            if packed and not isinstance(X_pairwise, numpy.ndarray):
+                raise ValueError("Only dense similarity matrices can be " \
+                    "packed.")
+            elif packed:
+                X_pairwise = _PackedSymmetric.from_dense(X_pairwise)
+
+            self.X = None
+        else:
+            if isinstance(X, csr_matrix):
+                raise ValueError("Similarity graphs can only be built from " \
+                    "a dense feature matrix or a precomputed similarity " \
+                    "matrix.")
+
+            self.X = numpy.asarray(X, dtype='float64')
+            X_pairwise = _calculate_pairwise_distances(self.X, metric=metric,
+                n_neighbors=n_neighbors, min_similarity=min_similarity,
+                block_size=block_size, packed=packed, cache=cache, 
+                n_jobs=n_jobs)
+
+        self.X_pairwise = X_pairwise
+        self.metric = metric
+        self.shape = X_pairwise.shape
+
+        if isinstance(X_pairwise, csr_matrix):
+            self.row_sums = numpy.asarray(X_pairwise.sum(axis=1)).ravel()
+            self.diagonal = X_pairwise.diagonal().astype('float64')
+            self.min, self.max = X_pairwise.min(), X_pairwise.max()
+        elif isinstance(X_pairwise, _RowBlocks):
+            # The row sums, minimum and maximum are found in a single pass
+            # over the rows, which are read from disk or unpacked only once.
+            self.row_sums = numpy.empty(self.shape[0], dtype='float64')
+            self.min, self.max = numpy.inf, -numpy.inf
+            for start, end, X_block in X_pairwise.iter_rows(
+                numpy.arange(self.shape[0]), block_size):
+                self.row_sums[start:end] = X_block.sum(axis=1)
+                self.min = min(self.min, X_block.min())
+                self.max = max(self.max, X_block.max())
+
+            self.diagonal = X_pairwise.diagonal()
+        else:
+            self.row_sums = X_pairwise.sum(axis=1)
+            self.diagonal = numpy.diag(X_pairwise).astype('float64')
+            self.min, self.max = X_pairwise.min(), X_pairwise.max()
+
+def _calculate_pairwise_distances(X, Y=None, metric='precomputed', 
+    n_neighbors=None, min_similarity=None, block_size=None, packed=False,
+    cache=None, n_jobs=1):
+    if cache is not None and metric not in ('precomputed', 'ignore') and (
+        n_neighbors is None or isinstance(n_neighbors, int)):
+        params = {'metric': metric, 'n_neighbors': n_neighbors, 
+            'min_similarity': min_similarity, 'packed': packed}
+
+        key = cache.key(X, Y, **params)
+        X_pairwise = cache.load(key)
+        if X_pairwise is None:
+            X_pairwise = _calculate_pairwise_distances(X, Y=Y, 
+                block_size=block_size, n_jobs=n_jobs, **params)
+            cache.store(key, X_pairwise)
+
+        return X_pairwise
+
+    if packed and metric == 'precomputed':
+        return _PackedSymmetric.from_dense(X)
+    elif packed:
+        return _calculate_pairwise_distances_packed(X, metric=metric,
+            block_size=block_size, n_jobs=n_jobs)
+
     if metric in ('precomputed', 'ignore'):
         return X
 
+    if n_neighbors is None and min_similarity is not None:
+        return _calculate_pairwise_distances_thresholded(X, Y=Y, 
+            metric=metric, min_similarity=min_similarity, 
+            block_size=block_size, n_jobs=n_jobs)
+
+    if n_neighbors is None and block_size is not None:
+        return _calculate_pairwise_distances_blocked(X, Y=Y, metric=metric,
+            block_size=block_size, n_jobs=n_jobs)
+
     if n_neighbors is None:
         if metric == 'euclidean':
             X_pairwise = pairwise_distances(X, Y=Y, metric=metric, squared=True)
@@ -195,6 +1199,19 @@ def _calculate_pairwise_distances(X, Y=None, metric='precomputed', n_neighbors=N
             X_pairwise = numpy.subtract(1, X_pairwise, out=X_pairwise)
         else:
             X_pairwise = pairwise_distances(X, Y=Y, metric=metric)
+    elif isinstance(n_neighbors, NNDescent):
+        if Y is not None:
+            raise ValueError("NNDescent cannot be used with a separate " \
+                "ground set.")
+
+        X_pairwise = n_neighbors.kneighbors_graph(X, metric=metric)
+    elif isinstance(n_neighbors, int) and (Y is not None or 
+        metric == 'correlation' or metric == 'cosine'):
+        X_pairwise = _calculate_nearest_neighbors_blocked(X, Y=Y, 
+            metric=metric, n_neighbors=n_neighbors, block_size=block_size,
+            n_jobs=n_jobs)
+    elif Y is not None:
+        X_pairwise = n_neighbors.fit(Y).transform(X)
     else:
         if metric == 'correlation' or metric == 'cosine':
             # An in-place version of:
@@ -229,4 +1246,546 @@ def _calculate_pairwise_distances(X, Y=None, metric='precomputed', n_neighbors=N
             X_pairwise = numpy.subtract(X_pairwise.max(), X_pairwise,
                 out=X_pairwise)
 
-    return X_pairwise
\ No newline at end of file
+    # The sparse kernels take 32-bit indices but newer versions of sklearn
+    # return nearest neighbor graphs with 64-bit indices.
+    if isinstance(X_pairwise, csr_matrix) and X_pairwise.indices.dtype != 'int32':
+        X_pairwise = csr_matrix((X_pairwise.data, 
+            X_pairwise.indices.astype('int32'), 
+            X_pairwise.indptr.astype('int32')), shape=X_pairwise.shape)
+
+    return X_pairwise
+
+def _keep_nearest_neighbors(X_pairwise, n_neighbors):
+    """Keep only the largest similarities in each row of a dense matrix.
+
+    This is used to sparsify the similarities between a batch of examples
+    and the reservoir when streaming, where the rows are not symmetric and
+    so the neighbors are found only among the columns.
+
+    Parameters
+    ----------
+    X_pairwise : numpy.ndarray, shape=(n, m)
+        A dense matrix of similarities.
+
+    n_neighbors : int
+        The number of similarities to keep in each row.
+
+    Returns
+    -------
+    X_pairwise : scipy.sparse.csr_matrix, shape=(n, m)
+        The sparse matrix containing the largest similarities in each row.
+    """
+
+    n, m = X_pairwise.shape
+    n_neighbors = min(n_neighbors, m)
+
+    idxs = numpy.argpartition(-X_pairwise, n_neighbors-1, axis=1)
+    idxs = numpy.sort(idxs[:, :n_neighbors], axis=1)
+    data = numpy.take_along_axis(X_pairwise, idxs, axis=1)
+    indptr = numpy.arange(0, n * n_neighbors + 1, n_neighbors)
+
+    return csr_matrix((data.ravel(), idxs.ravel().astype('int32'),
+        indptr.astype('int32')), shape=(n, m))
+
+def _drop_small_similarities(X_pairwise, min_similarity):
+    """Keep only the similarities of a dense matrix above a threshold.
+
+    Parameters
+    ----------
+    X_pairwise : numpy.ndarray, shape=(n, m)
+        A dense matrix of similarities.
+
+    min_similarity : float
+        The smallest similarity to keep.
+
+    Returns
+    -------
+    X_pairwise : scipy.sparse.csr_matrix, shape=(n, m)
+        The sparse matrix containing the kept similarities.
+    """
+
+    X_pairwise = numpy.where(X_pairwise >= min_similarity, X_pairwise, 0)
+    X_pairwise = csr_matrix(X_pairwise)
+    return csr_matrix((X_pairwise.data, X_pairwise.indices.astype('int32'),
+        X_pairwise.indptr.astype('int32')), shape=X_pairwise.shape)
+
+def _as_chunk(X):
+    """Convert a chunk of a stream to a float64 array or CSR matrix."""
+
+    if isinstance(X, csr_matrix):
+        return X if X.dtype == 'float64' else X.astype('float64')
+    
+    X = numpy.asarray(X)
+    if X.ndim != 2:
+        raise ValueError("Each chunk must have exactly two dimensions.")
+
+    return X if X.dtype == 'float64' else X.astype('float64')
+
+def _rechunk(chunks, chunk_size=None):
+    """Convert a stream of chunks into chunks with a fixed number of rows.
+
+    Chunks from the stream are cast to float64 and, if a chunk size is
+    given, are split or concatenated so that each yielded chunk has exactly
+    `chunk_size` rows, except possibly the last one. Only as many rows as
+    are needed to fill one chunk are held in memory at a time.
+
+    Parameters
+    ----------
+    chunks : iterable
+        An iterable of 2D numpy arrays, lists of lists, or CSR matrices.
+
+    chunk_size : int or None, optional
+        The number of rows in each yielded chunk. If None, chunks are
+        yielded as they come. Default is None.
+
+    Returns
+    -------
+    chunks : generator
+        A generator of float64 numpy arrays or CSR matrices.
+    """
+
+    if chunk_size is None:
+        for X in chunks:
+            yield _as_chunk(X)
+        return
+
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer.")
+
+    buffer, n = [], 0
+    for X in chunks:
+        X = _as_chunk(X)
+        buffer.append(X)
+        n += X.shape[0]
+
+        if n < chunk_size:
+            continue
+
+        if any(isinstance(Y, csr_matrix) for Y in buffer):
+            X = vstack(buffer, format='csr')
+        else:
+            X = numpy.concatenate(buffer)
+
+        for start in range(0, n - chunk_size + 1, chunk_size):
+            yield X[start:start+chunk_size]
+
+        n = n % chunk_size
+        buffer = [X[X.shape[0]-n:]] if n > 0 else []
+
+    if n > 0:
+        if any(isinstance(Y, csr_matrix) for Y in buffer):
+            yield vstack(buffer, format='csr')
+        else:
+            yield numpy.concatenate(buffer)
+
+def _prefetch(iterable, n=2):
+    """Produce the items of an iterable in a background thread.
+
+    The items are produced by a background thread and placed in a queue
+    holding at most `n` items, so that producing the next items, such as
+    reading them from disk, overlaps with processing the current one while
+    the memory used stays bounded. Errors raised while producing an item
+    are raised again when that item is requested.
+
+    Parameters
+    ----------
+    iterable : iterable
+        The iterable to produce the items of.
+
+    n : int, optional
+        The maximum number of items to produce ahead of the consumer. If 0,
+        the items are produced in the calling thread. Default is 2.
+
+    Returns
+    -------
+    items : generator
+        A generator of the items of the iterable.
+    """
+
+    if n == 0:
+        yield from iterable
+        return
+
+    items = queue.Queue(maxsize=n)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((done, e))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def _read_npy_header(f):
+    """Read the header of a .npy file and return its shape and dtype."""
+
+    version = numpy.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(f)
+    else:
+        raise ValueError("Unsupported .npy file version {}.".format(version))
+
+    return shape, dtype
+
+def _read_array(f, n, dtype):
+    """Read the next n items of a .npy file into a new writeable array."""
+
+    X = numpy.empty(n, dtype=dtype)
+    buffer = memoryview(X).cast('B')
+
+    start = 0
+    while start < buffer.nbytes:
+        n_read = f.readinto(buffer[start:])
+        if n_read == 0:
+            raise ValueError("Unexpected end of file.")
+
+        start += n_read
+
+    return X
+
+def _read_chunks(path, chunk_rows):
+    """Read a data set from disk in chunks of rows.
+
+    Dense .npy files are memory-mapped and each chunk is a view into the
+    file, so that only the rows in use are read into memory. Sparse .npz
+    files, as written by `scipy.sparse.save_npz`, must contain a CSR matrix.
+    The row pointers are loaded up front and the data and column indices
+    are read sequentially, one chunk at a time, so that the full matrix is
+    never held in memory even when the file is compressed.
+
+    Parameters
+    ----------
+    path : str or os.PathLike
+        The path to a .npy or .npz file.
+
+    chunk_rows : int
+        The number of rows in each chunk.
+
+    Returns
+    -------
+    chunks : generator
+        A generator of numpy arrays or CSR matrices.
+    """
+
+    path = str(path)
+    if chunk_rows < 1:
+        raise ValueError("chunk_rows must be a positive integer.")
+
+    if path.endswith('.npy'):
+        # Copy-on-write keeps the views writeable, which the compiled
+        # kernels require, without ever modifying the file.
+        X = numpy.load(path, mmap_mode='c')
+        if X.ndim != 2:
+            raise ValueError("The array must have exactly two dimensions.")
+
+        for start in range(0, X.shape[0], chunk_rows):
+            yield X[start:start+chunk_rows]
+
+    elif path.endswith('.npz'):
+        with zipfile.ZipFile(path) as archive:
+            names = archive.namelist()
+            if 'format.npy' not in names:
+                raise ValueError("The .npz file must be written by " \
+                    "scipy.sparse.save_npz.")
+
+            with archive.open('format.npy') as f:
+                matrix_format = numpy.lib.format.read_array(f).item()
+
+            if isinstance(matrix_format, bytes):
+                matrix_format = matrix_format.decode('ascii')
+            if matrix_format != 'csr':
+                raise ValueError("The .npz file must contain a CSR matrix.")
+
+            with archive.open('shape.npy') as f:
+                n, d = numpy.lib.format.read_array(f)
+            with archive.open('indptr.npy') as f:
+                indptr = numpy.lib.format.read_array(f)
+
+            with archive.open('data.npy') as data, \
+                archive.open('indices.npy') as indices:
+                _, data_dtype = _read_npy_header(data)
+                _, indices_dtype = _read_npy_header(indices)
+
+                for start in range(0, n, chunk_rows):
+                    end = min(start + chunk_rows, n)
+                    m = indptr[end] - indptr[start]
+
+                    X_data = _read_array(data, m, data_dtype)
+                    X_indices = _read_array(indices, m, indices_dtype)
+                    X_indptr = indptr[start:end+1] - indptr[start]
+
+                    yield csr_matrix((X_data, X_indices, X_indptr), 
+                        shape=(end - start, d))
+
+    else:
+        raise ValueError("Only .npy and .npz files are supported.")
+
+class _RowBlocks(object):
+    """A similarity matrix stored on disk as one or more blocks of rows.
+
+    Each block is a memory-mapped array, and rows are only read from disk
+    when they are requested, at which point they are converted to float64.
+    The gain kernels read the rows of the candidates that they evaluate in
+    blocks, reading the next block in a background thread while the current
+    one is processed, so that the lazy greedy algorithm only ever reads the
+    rows that it re-evaluates.
+
+    Parameters
+    ----------
+    blocks : list of numpy.ndarray
+        The blocks of rows, in order, which must all have the same number of
+        columns.
+    """
+
+    def __init__(self, blocks):
+        if len(blocks) == 0:
+            raise ValueError("There must be at least one block of rows.")
+        if any(block.ndim != 2 for block in blocks):
+            raise ValueError("Each block of rows must have exactly two " \
+                "dimensions.")
+        if len(set(block.shape[1] for block in blocks)) != 1:
+            raise ValueError("Each block of rows must have the same number " \
+                "of columns.")
+
+        self.blocks = blocks
+        self.offsets = numpy.cumsum([0] + [block.shape[0] for block in 
+            blocks])
+        self.shape = (int(self.offsets[-1]), blocks[0].shape[1])
+        self.ndim = 2
+        self.dtype = numpy.dtype('float64')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.rows(numpy.arange(self.shape[0])[idx])
+        if isinstance(idx, (numbers.Integral, numpy.integer)):
+            return self.rows(numpy.array([idx]))[0]
+        return self.rows(numpy.asarray(idx))
+
+    def rows(self, idxs):
+        """Read the given rows into memory as a float64 array."""
+
+        idxs = numpy.asarray(idxs, dtype='int64')
+        if len(self.blocks) == 1:
+            return numpy.asarray(self.blocks[0][idxs], dtype='float64')
+
+        X = numpy.empty((idxs.shape[0], self.shape[1]), dtype='float64')
+        positions = numpy.searchsorted(self.offsets, idxs, side='right') - 1
+        for i in numpy.unique(positions):
+            mask = positions == i
+            X[mask] = self.blocks[i][idxs[mask] - self.offsets[i]]
+
+        return X
+
+    def iter_rows(self, idxs, block_size=None, prefetch=2):
+        """Read the given rows one block at a time.
+
+        Parameters
+        ----------
+        idxs : numpy.ndarray, shape=(n,)
+            The rows to read.
+
+        block_size : int or None, optional
+            The number of rows to read at a time. If None, blocks of about
+            64MB are read. Default is None.
+
+        prefetch : int, optional
+            The number of blocks to read ahead in a background thread. Only
+            used when there is more than one block. Default is 2.
+
+        Returns
+        -------
+        blocks : generator
+            A generator of tuples of the start and end of each block in
+            idxs and the rows in that block.
+        """
+
+        if block_size is None:
+            block_size = max(1, 2 ** 23 // max(self.shape[1], 1))
+
+        blocks = ((start, min(start + block_size, len(idxs)), 
+            self.rows(idxs[start:start+block_size])) 
+            for start in range(0, len(idxs), block_size))
+
+        if len(idxs) <= block_size:
+            prefetch = 0
+
+        return _prefetch(blocks, n=prefetch)
+
+    def sum(self, axis=None):
+        idxs = numpy.arange(self.shape[0])
+        if axis == 1:
+            return numpy.concatenate([X.sum(axis=1) for _, _, X in 
+                self.iter_rows(idxs)])
+
+        X_sum = numpy.zeros(self.shape[1], dtype='float64')
+        for _, _, X in self.iter_rows(idxs):
+            X_sum += X.sum(axis=0)
+
+        return X_sum if axis == 0 else X_sum.sum()
+
+    def diagonal(self):
+        return numpy.concatenate([numpy.diagonal(block, offset=offset) for 
+            block, offset in zip(self.blocks, self.offsets)]).astype('float64')
+
+    def min(self, axis=None, out=None, **kwargs):
+        idxs = numpy.arange(self.shape[0])
+        return min(X.min() for _, _, X in self.iter_rows(idxs))
+
+    def max(self, axis=None, out=None, **kwargs):
+        idxs = numpy.arange(self.shape[0])
+        return max(X.max() for _, _, X in self.iter_rows(idxs))
+
+@njit(nogil=True, fastmath=True)
+def _pack_rows(X, packed, start, n):
+    """Write the upper triangle of a block of rows into a packed array.
+
+    The block holds rows `start` onwards of a symmetric matrix and only
+    its columns from `start` onwards.
+    """
+
+    for r in range(X.shape[0]):
+        i = start + r
+        offset = i * n - i * (i - 1) // 2
+        for j in range(i, n):
+            packed[offset + j - i] = X[r, j - start]
+
+
+@njit(nogil=True, fastmath=True)
+def _unpack_rows(packed, n, idxs, X):
+    """Read full rows of a symmetric matrix from its packed upper triangle.
+
+    The entries to the left of the diagonal are read down the columns of
+    the upper triangle and the rest are read along its rows.
+    """
+
+    for r in range(idxs.shape[0]):
+        i = idxs[r]
+        for j in range(i):
+            X[r, j] = packed[j * n - j * (j - 1) // 2 + i - j]
+
+        offset = i * n - i * (i - 1) // 2 - i
+        for j in range(i, n):
+            X[r, j] = packed[offset + j]
+
+
+class _PackedSymmetric(_RowBlocks):
+    """A symmetric similarity matrix that stores only its upper triangle.
+
+    The similarities on and above the diagonal are stored row by row in a
+    single flat array, which takes half the memory of the full matrix. Full
+    rows are read through the symmetry by a compiled kernel when they are
+    requested, and so the gain kernels operate on one block of rows at a
+    time in the same way as for similarity matrices stored on disk.
+
+    Parameters
+    ----------
+    packed : numpy.ndarray, shape=(n * (n + 1) // 2,)
+        The upper triangle of the matrix, including the diagonal, in row
+        major order.
+
+    n : int
+        The number of rows in the matrix.
+    """
+
+    def __init__(self, packed, n):
+        if packed.ndim != 1 or packed.shape[0] != n * (n + 1) // 2:
+            raise ValueError("A packed symmetric matrix with {} rows must " \
+                "have {} entries.".format(n, n * (n + 1) // 2))
+
+        self.packed = numpy.asarray(packed, dtype='float64')
+        self.shape = (n, n)
+        self.ndim = 2
+        self.dtype = numpy.dtype('float64')
+
+    @classmethod
+    def from_dense(cls, X):
+        """Pack the upper triangle of a dense symmetric matrix."""
+
+        n = X.shape[0]
+        packed = numpy.empty(n * (n + 1) // 2, dtype='float64')
+        _pack_rows(numpy.asarray(X, dtype='float64'), packed, 0, n)
+        return cls(packed, n)
+
+    def rows(self, idxs):
+        """Read the given rows into memory as a float64 array."""
+
+        idxs = numpy.asarray(idxs, dtype='int64')
+        X = numpy.empty((idxs.shape[0], self.shape[1]), dtype='float64')
+        _unpack_rows(self.packed, self.shape[0], idxs, X)
+        return X
+
+    def diagonal(self):
+        idxs = numpy.arange(self.shape[0])
+        return self.packed[idxs * self.shape[0] - idxs * (idxs - 1) // 2]
+
+    def min(self, axis=None, out=None, **kwargs):
+        return self.packed.min()
+
+    def max(self, axis=None, out=None, **kwargs):
+        return self.packed.max()
+
+def _open_row_blocks(X):
+    """Open a similarity matrix stored on disk without reading it.
+
+    Parameters
+    ----------
+    X : numpy.memmap or str or os.PathLike
+        A memory-mapped array, the path to a .npy file, or the path to a
+        directory of .npy files that each contain a block of rows. The
+        files in a directory are ordered by name.
+
+    Returns
+    -------
+    X : _RowBlocks
+        The similarity matrix.
+    """
+
+    if isinstance(X, numpy.memmap):
+        return _RowBlocks([X])
+
+    path = str(X)
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path) 
+            if name.endswith('.npy'))
+        return _RowBlocks([numpy.load(os.path.join(path, name), 
+            mmap_mode='r') for name in names])
+    elif path.endswith('.npy'):
+        return _RowBlocks([numpy.load(path, mmap_mode='r')])
+    
+    raise ValueError("Similarity matrices on disk must be stored in a .npy " \
+        "file or a directory of .npy files.")
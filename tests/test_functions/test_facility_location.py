@@ -1,5 +1,7 @@
+import os
 import scipy
 import numpy
+import tempfile
 
 try:
 	import cupy
@@ -7,14 +9,19 @@ except:
 	import numpy as cupy
 
 from apricot import FacilityLocationSelection
+from apricot.utils import NNDescent
+from apricot.utils import SimilarityCache
+from apricot.utils import _calculate_pairwise_distances
 from apricot.optimizers import NaiveGreedy, LazyGreedy, TwoStageGreedy, GreeDi, ApproximateLazyGreedy, StochasticGreedy, SampleGreedy, ModularGreedy
 
 from sklearn.datasets import load_digits
 from sklearn.metrics import pairwise_distances
+from sklearn.neighbors import KNeighborsTransformer
 
 from numpy.testing import assert_almost_equal
 from numpy.testing import assert_array_equal
 from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_raises
 
 digits_data = load_digits()
 X_digits = digits_data.data
@@ -281,6 +288,254 @@ def test_digits_cosine_lazy():
 	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_lazy_packed():
+	model = FacilityLocationSelection(100, 'cosine', optimizer='lazy',
+		packed=True, block_size=500)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_euclidean_naive_packed():
+	model = FacilityLocationSelection(100, 'euclidean', optimizer='naive',
+		packed=True, block_size=500)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking[:30], digits_euclidean_ranking[:30])
+	assert_array_equal(model.ranking[-30:], digits_euclidean_ranking[-30:])
+	assert_array_almost_equal(model.gains, digits_euclidean_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_packed_raises():
+	assert_raises(ValueError, FacilityLocationSelection, 10, 'cosine',
+		n_neighbors=10, packed=True)
+	assert_raises(ValueError, FacilityLocationSelection, 10, 'cosine',
+		packed=True, implicit=True)
+
+	model = FacilityLocationSelection(10, 'cosine', packed=True)
+	assert_raises(ValueError, model.fit, X_digits, ground=X_digits[:100])
+
+def test_digits_cosine_lazy_similarity_cache():
+	with tempfile.TemporaryDirectory() as directory:
+		for optimizer in 'lazy', 'naive':
+			model = FacilityLocationSelection(100, 'cosine', 
+				optimizer=optimizer, similarity_cache=directory)
+			model.fit(X_digits)
+			assert_array_equal(model.ranking, digits_cosine_ranking)
+			assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+			assert len(os.listdir(directory)) == 1
+
+		model = FacilityLocationSelection(100, 'cosine', optimizer='lazy',
+			packed=True, similarity_cache=directory)
+		model.fit(X_digits)
+		assert_array_equal(model.ranking, digits_cosine_ranking)
+		assert len(os.listdir(directory)) == 2
+
+		cache = SimilarityCache(directory, max_size=1)
+		model = FacilityLocationSelection(10, 'cosine', n_neighbors=10, 
+			similarity_cache=cache)
+		model.fit(X_digits)
+		assert len(os.listdir(directory)) == 1
+
+def test_digits_euclidean_lazy_blocked():
+	model = FacilityLocationSelection(100, 'euclidean', optimizer='lazy',
+		block_size=128, n_jobs=2)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_euclidean_ranking)
+	assert_array_almost_equal(model.gains, digits_euclidean_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_lazy_blocked():
+	model = FacilityLocationSelection(100, 'cosine', optimizer='lazy',
+		block_size=100)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_euclidean_lazy_implicit():
+	model = FacilityLocationSelection(100, 'euclidean', optimizer='lazy',
+		block_size=128, implicit=True)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_euclidean_ranking)
+	assert_array_almost_equal(model.gains, digits_euclidean_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+	assert model.current_values.shape == (X_digits.shape[0],)
+
+def test_digits_cosine_naive_implicit():
+	model = FacilityLocationSelection(100, 'cosine', optimizer='naive',
+		implicit=True)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_lazy_implicit():
+	model = FacilityLocationSelection(100, 'cosine', optimizer='lazy',
+		block_size=100, implicit=True)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_implicit_raises():
+	assert_raises(ValueError, FacilityLocationSelection, 100, 'precomputed',
+		implicit=True)
+	assert_raises(ValueError, FacilityLocationSelection, 100, 'cosine',
+		n_neighbors=10, implicit=True)
+
+	model = FacilityLocationSelection(100, 'cosine', implicit=True)
+	assert_raises(ValueError, model.fit, X_digits_cosine_sparse)
+	assert_raises(ValueError, model.partial_fit, X_digits)
+
+def test_digits_cosine_lazy_ground():
+	X_candidates = X_digits[::4]
+	X_pairwise = (1 - pairwise_distances(X_candidates, X_digits, 
+		metric='cosine')) ** 2
+
+	model = FacilityLocationSelection(50, 'cosine', optimizer='lazy')
+	model.fit(X_candidates, ground=X_digits)
+	assert_almost_equal(model.gains.sum(), 
+		X_pairwise[model.ranking].max(axis=0).sum(), 4)
+	assert_array_almost_equal(model.subset, X_candidates[model.ranking])
+
+	model2 = FacilityLocationSelection(50, 'cosine', optimizer='lazy',
+		block_size=100)
+	model2.fit(X_candidates, ground=X_digits)
+	assert_array_equal(model2.ranking, model.ranking)
+	assert_array_almost_equal(model2.gains, model.gains, 4)
+
+def test_digits_euclidean_lazy_ground_implicit():
+	X_candidates = X_digits[::4]
+
+	model = FacilityLocationSelection(50, 'euclidean', optimizer='lazy')
+	model.fit(X_candidates, ground=X_digits)
+
+	model2 = FacilityLocationSelection(50, 'euclidean', optimizer='lazy',
+		block_size=100, implicit=True)
+	model2.fit(X_candidates, ground=X_digits)
+	assert_array_equal(model2.ranking, model.ranking)
+	assert_array_almost_equal(model2.gains, model.gains, 4)
+	assert model2.current_values.shape == (X_digits.shape[0],)
+
+def test_digits_cosine_lazy_ground_sparse():
+	X_candidates = X_digits[::4]
+	X_pairwise = _calculate_pairwise_distances(X_candidates, Y=X_digits,
+		metric='cosine', n_neighbors=10)
+
+	model = FacilityLocationSelection(50, 'cosine', optimizer='lazy', 
+		n_neighbors=10)
+	model.fit(X_candidates, ground=X_digits)
+	assert X_pairwise.shape == (X_candidates.shape[0], X_digits.shape[0])
+	assert_almost_equal(model.gains.sum(), 
+		X_pairwise[model.ranking].max(axis=0).sum(), 4)
+
+def test_digits_cosine_ground_raises():
+	model = FacilityLocationSelection(50, 'precomputed')
+	assert_raises(ValueError, model.fit, X_digits_cosine_sparse, 
+		ground=X_digits)
+
+	model = FacilityLocationSelection(50, 'cosine')
+	assert_raises(ValueError, model.fit, X_digits, ground=X_digits[:, :10])
+
+def test_digits_cosine_lazy_memmap():
+	X_pairwise = _calculate_pairwise_distances(X_digits, metric='cosine')
+
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'digits.npy')
+		numpy.save(path, X_pairwise)
+
+		model = FacilityLocationSelection(100, 'precomputed', optimizer='lazy',
+			block_size=300)
+		model.fit(numpy.load(path, mmap_mode='r'))
+
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+
+def test_digits_cosine_naive_row_blocks():
+	X_pairwise = _calculate_pairwise_distances(X_digits, metric='cosine')
+
+	with tempfile.TemporaryDirectory() as directory:
+		for i, start in enumerate(range(0, X_pairwise.shape[0], 500)):
+			path = os.path.join(directory, 'block{}.npy'.format(i))
+			numpy.save(path, X_pairwise[start:start+500])
+
+		model = FacilityLocationSelection(100, 'precomputed', optimizer='naive')
+		model.fit(directory)
+
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+
+def test_digits_cosine_row_blocks_raises():
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'digits.npy')
+		numpy.save(path, X_digits)
+
+		model = FacilityLocationSelection(100, 'cosine')
+		assert_raises(ValueError, model.fit, path)
+
+		model = FacilityLocationSelection(100, 'precomputed')
+		assert_raises(ValueError, model.fit, os.path.join(directory, 
+			'digits.csv'))
+
+def test_digits_cosine_lazy_neighbors():
+	X_cosine = 1 - (1 - pairwise_distances(X_digits, metric='cosine')) ** 2
+	X_exact = KNeighborsTransformer(n_neighbors=10, 
+		metric='precomputed').fit_transform(X_cosine)
+
+	X_pairwise = _calculate_pairwise_distances(X_digits, metric='cosine',
+		n_neighbors=10, block_size=500)
+	assert X_pairwise.nnz == X_exact.nnz
+	assert_array_almost_equal(numpy.sort(X_pairwise.data), 
+		numpy.sort(1 - X_exact.data))
+
+	model = FacilityLocationSelection(50, 'cosine', optimizer='lazy',
+		n_neighbors=10)
+	model.fit(X_digits)
+	assert_almost_equal(model.gains.sum(), 
+		X_pairwise[model.ranking].max(axis=0).sum(), 4)
+
+def test_digits_cosine_lazy_min_similarity():
+	X_exact = (1 - pairwise_distances(X_digits, metric='cosine')) ** 2
+	X_exact[X_exact < 0.75] = 0
+
+	X_pairwise = _calculate_pairwise_distances(X_digits, metric='cosine',
+		min_similarity=0.75, block_size=500)
+	assert X_pairwise.nnz == numpy.count_nonzero(X_exact)
+	assert_array_almost_equal(X_pairwise.toarray(), X_exact)
+
+	model = FacilityLocationSelection(50, 'cosine', optimizer='lazy',
+		min_similarity=0.75)
+	model.fit(X_digits)
+	assert_almost_equal(model.gains.sum(), 
+		X_pairwise[model.ranking].max(axis=0).sum(), 4)
+
+def test_digits_min_similarity_raises():
+	assert_raises(ValueError, FacilityLocationSelection, 10, 'cosine',
+		n_neighbors=10, min_similarity=0.5)
+	assert_raises(ValueError, FacilityLocationSelection, 10, 'cosine',
+		min_similarity=0.5, implicit=True)
+
+def test_digits_euclidean_nn_descent():
+	X_pairwise = NNDescent(10, random_state=0).kneighbors_graph(X_digits)
+	X_exact = KNeighborsTransformer(n_neighbors=10).fit_transform(X_digits)
+
+	recall = numpy.mean([numpy.intersect1d(X_pairwise[i].indices, 
+		X_exact[i].indices).shape[0] for i in range(X_digits.shape[0])]) / 11
+	assert X_pairwise.shape == X_exact.shape
+	assert X_pairwise.nnz == X_exact.nnz
+	assert recall > 0.95
+
+def test_digits_cosine_lazy_nn_descent():
+	X_pairwise = _calculate_pairwise_distances(X_digits, metric='cosine',
+		n_neighbors=NNDescent(10, random_state=0))
+	assert_array_almost_equal(X_pairwise.diagonal(), 1)
+
+	model = FacilityLocationSelection(50, 'cosine', optimizer='lazy',
+		n_neighbors=NNDescent(10, random_state=0))
+	model.fit(X_digits)
+	assert_almost_equal(model.gains.sum(), 
+		X_pairwise[model.ranking].max(axis=0).sum(), 4)
+
 def test_digits_cosine_two_stage():
 	model = FacilityLocationSelection(100, 'cosine', optimizer='two-stage')
 	model.fit(X_digits)
@@ -439,6 +694,15 @@ def test_digits_cosine_greedi_nl():
 	assert_array_almost_equal(model.gains[:30], digits_cosine_greedi_gains[:30], 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_coreset():
+	model = FacilityLocationSelection(100, 'cosine', optimizer='coreset',
+		optimizer_kwds={'m': 4, 'n_jobs': 1}, random_state=0)
+	model.fit(X_digits)
+	assert_array_equal(numpy.unique(model.ranking).shape[0], 100)
+	assert_array_equal(model.ranking[0], digits_cosine_ranking[0])
+	assert model.gains.sum() > 0.99 * sum(digits_cosine_gains)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
 def test_digits_cosine_approximate():
 	model = FacilityLocationSelection(100, 'cosine', optimizer='approximate-lazy')
 	model.fit(X_digits)
@@ -490,6 +754,41 @@ def test_digits_cosine_sieve_minibatch():
 	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_sieve_batch_sparse():
+	model = FacilityLocationSelection(100, 'cosine', random_state=0, 
+		reservoir=X_digits, n_neighbors=X_digits.shape[0])
+	model.partial_fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_sieve_minibatch_sparse():
+	model = FacilityLocationSelection(100, 'cosine', random_state=0,
+		reservoir=X_digits, n_neighbors=X_digits.shape[0])
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+	assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_sieve_reservoir_sampling():
+	model = FacilityLocationSelection(100, 'cosine', random_state=0,
+		max_reservoir_size=200)
+	model.partial_fit(X_digits[:150])
+	assert_array_equal(model.reservoir[:150], X_digits[:150])
+	assert model.reservoir_size == 150
+
+	model.partial_fit(X_digits[150:900])
+	model.partial_fit(X_digits[900:])
+	assert model.reservoir_size == 200
+
+	idxs = [numpy.where((X_digits == row).all(axis=1))[0][0] 
+		for row in model.reservoir]
+	assert len(set(idxs)) == 200
+	assert max(idxs) >= 900
+	assert len(model.ranking) == 100
+
 # Using Optimizer Objects
 
 def test_digits_cosine_naive_object():
@@ -655,4 +954,56 @@ def test_digits_sqrt_modular_sparse():
 	model.fit(X_digits_cosine_sparse)
 	assert_array_equal(model.ranking, digits_cosine_modular_ranking)
 	assert_array_almost_equal(model.gains, digits_cosine_modular_gains, 4)
-	
\ No newline at end of file
+	
+# Test local search refinement
+
+def test_digits_cosine_refine():
+	model = FacilityLocationSelection(20, 'cosine', optimizer='lazy')
+	model.fit(X_digits)
+	gains = model.gains.sum()
+
+	model.refine(X_digits, max_swaps=10)
+	assert model.n_swaps_ > 0
+	assert model.gains.sum() > gains
+	assert_array_equal(numpy.unique(model.ranking).shape[0], 20)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+	X_pairwise = 1 - (1 - pairwise_distances(X_digits, metric='cosine')) ** 2
+	X_pairwise = 1 - X_pairwise
+	assert_almost_equal(model.gains.sum(),
+		X_pairwise[model.ranking].max(axis=0).sum(), 4)
+
+def test_digits_cosine_refine_sparse():
+	model = FacilityLocationSelection(20, 'precomputed', optimizer='lazy')
+	model.fit(X_digits_cosine_sparse)
+	gains = model.gains.sum()
+
+	model.refine(X_digits_cosine_sparse, max_swaps=10)
+	assert model.n_swaps_ > 0
+	assert model.gains.sum() > gains
+	assert_almost_equal(model.gains.sum(), X_digits_cosine_sparse[
+		model.ranking].toarray().max(axis=0).sum(), 4)
+
+def test_digits_cosine_refine_init():
+	model = FacilityLocationSelection(20, 'cosine', optimizer='lazy',
+		initial_subset=digits_cosine_ranking[:5])
+	model.fit(X_digits)
+	model.refine(X_digits, max_swaps=10)
+	assert len(set(model.ranking) & set(digits_cosine_ranking[:5])) == 0
+
+# Test selecting from many small data sets
+
+def test_digits_euclidean_select_many():
+	Xs = [X_digits[:50], X_digits[50:60], X_digits[60:250]]
+
+	model = FacilityLocationSelection(20, 'euclidean')
+	rankings, gains = model.select_many(Xs)
+	assert len(rankings) == 3
+	assert len(rankings[1]) == 10
+
+	for X, ranking, gain in zip(Xs, rankings, gains):
+		model = FacilityLocationSelection(min(20, X.shape[0]), 'euclidean',
+			optimizer='naive')
+		model.fit(X)
+		assert_array_equal(ranking, model.ranking)
+		assert_array_almost_equal(gain, model.gains, 4)
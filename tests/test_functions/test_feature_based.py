@@ -1,4 +1,7 @@
+import os
 import scipy
+import asyncio
+import tempfile
 import numpy
 
 from apricot import FeatureBasedSelection
@@ -10,6 +13,7 @@ from sklearn.metrics import pairwise_distances
 from numpy.testing import assert_almost_equal
 from numpy.testing import assert_array_equal
 from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_raises
 
 #	print("[" + ", ".join(map(str, model.ranking)) + "]")
 #	print("[" + ", ".join([str(round(gain, 4)) for gain in model.gains]) + "]")
@@ -392,6 +396,22 @@ def test_digits_sqrt_greedi_nl():
 	assert_array_almost_equal(model.gains[:30], digits_sqrt_greedi_gains[:30], 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_sqrt_coreset():
+	model = FeatureBasedSelection(100, 'sqrt', optimizer='coreset',
+		optimizer_kwds={'m': 4, 'n_jobs': 1}, random_state=0)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_sqrt_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_sqrt_coreset_parallel():
+	model = FeatureBasedSelection(100, 'sqrt', optimizer='coreset',
+		optimizer_kwds={'m': 4, 'n_jobs': 2}, random_state=0)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_sqrt_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
 def test_digits_sqrt_approximate():
 	model = FeatureBasedSelection(100, 'sqrt', optimizer='approximate-lazy')
 	model.fit(X_digits)
@@ -442,6 +462,170 @@ def test_digits_sqrt_sieve_minibatch():
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
 
+def test_digits_sqrt_sieve_prune():
+	model = FeatureBasedSelection(100, 'sqrt', random_state=0,
+		optimizer_kwds={'prune': False})
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+
+	model2 = FeatureBasedSelection(100, 'sqrt', random_state=0)
+	model2.partial_fit(X_digits[:300])
+	model2.partial_fit(X_digits[300:500])
+	model2.partial_fit(X_digits[500:])
+
+	n_sieves = model.optimizer.function.sieve_total_gains_.shape[0]
+	n_pruned_sieves = model2.optimizer.function.sieve_total_gains_.shape[0]
+
+	assert n_pruned_sieves < n_sieves
+	assert n_pruned_sieves == len(model2.optimizer.thresholds)
+	assert_array_equal(model.ranking, model2.ranking)
+	assert_array_almost_equal(model.gains, model2.gains, 4)
+
+def test_digits_sqrt_sieve_rows():
+	model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+
+	function = model.optimizer.function
+	selections = function.sieve_selections_
+	row_ids = numpy.unique(selections[selections >= 0])
+
+	assert_array_equal(function.sieve_row_ids_, row_ids)
+	assert_array_almost_equal(function.sieve_rows_, X_digits[row_ids])
+
+	for i in range(selections.shape[0]):
+		ranking = selections[i, :function.sieve_n_selected_[i]]
+		assert_array_almost_equal(function._sieve_subset(i), X_digits[ranking])
+
+def test_digits_sqrt_sieve_window():
+	model = FeatureBasedSelection(20, 'sqrt', random_state=0)
+	for i in range(0, X_digits.shape[0], 100):
+		model.partial_fit(X_digits[i:i+100], window=400)
+
+		start = min(i + 100, X_digits.shape[0]) - 400
+		assert model.ranking.min() >= start
+		assert len(model.ranking) == 20
+		assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+	model2 = FeatureBasedSelection(20, 'sqrt', random_state=0)
+	for i in range(1400, X_digits.shape[0], 100):
+		model2.partial_fit(X_digits[i:i+100])
+
+	assert_almost_equal(model.gains.sum(), model2.gains.sum(), 4)
+
+def test_digits_sqrt_sieve_window_raises():
+	model = FeatureBasedSelection(20, 'sqrt', random_state=0)
+	assert_raises(ValueError, model.partial_fit, X_digits[:500], window=400)
+
+	model.partial_fit(X_digits[:300], window=400)
+	assert_raises(ValueError, model.partial_fit, X_digits[300:500], window=200)
+
+def test_digits_sqrt_fit_stream():
+	chunks = (X_digits[i:i+70].astype('int32') for i in range(0, 
+		X_digits.shape[0], 70))
+
+	model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+	model.fit_stream(chunks, chunk_size=300)
+	assert model.optimizer.n_seen_ == X_digits.shape[0]
+	assert_array_equal(model.ranking, digits_sqrt_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_sqrt_fit_stream_sparse():
+	chunks = (X_digits_sparse[i:i+70] for i in range(0, 
+		X_digits.shape[0], 70))
+
+	model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+	model.fit_stream(chunks, chunk_size=300, prefetch=0)
+	assert_array_equal(model.ranking, digits_sqrt_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_sieve_gains, 4)
+
+def test_digits_sqrt_fit_stream_raises():
+	def chunks():
+		yield X_digits[:300]
+		raise IOError("Cannot read chunk.")
+
+	model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+	assert_raises(IOError, model.fit_stream, chunks())
+
+def test_digits_sqrt_partial_fit_from_npy():
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'digits.npy')
+		numpy.save(path, X_digits.astype('float32'))
+
+		model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+		model.partial_fit_from_file(path, chunk_rows=300)
+
+	assert model.optimizer.n_seen_ == X_digits.shape[0]
+	assert_array_equal(model.ranking, digits_sqrt_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_sqrt_partial_fit_from_npz():
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'digits.npz')
+		scipy.sparse.save_npz(path, X_digits_sparse)
+
+		model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+		model.partial_fit_from_file(path, chunk_rows=300)
+
+	assert model.optimizer.n_seen_ == X_digits.shape[0]
+	assert_array_equal(model.ranking, digits_sqrt_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_sieve_gains, 4)
+
+def test_digits_sqrt_partial_fit_from_file_raises():
+	model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+	assert_raises(ValueError, model.partial_fit_from_file, 'digits.csv')
+
+def test_digits_sqrt_afit():
+	model = FeatureBasedSelection(100, 'sqrt', optimizer='naive')
+	asyncio.run(model.afit(X_digits))
+	assert_array_equal(model.ranking, digits_sqrt_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_sqrt_afit_cancel():
+	async def cancel():
+		model = FeatureBasedSelection(100, 'sqrt', optimizer='naive')
+		task = asyncio.ensure_future(model.afit(X_digits))
+		await asyncio.sleep(0)
+		task.cancel()
+		await task
+
+	assert_raises(asyncio.CancelledError, asyncio.run, cancel())
+
+def test_digits_sqrt_apartial_fit():
+	async def stream(model):
+		await asyncio.gather(*[model.apartial_fit(X_digits[i:i+300]) 
+			for i in range(0, X_digits.shape[0], 300)])
+
+	model = FeatureBasedSelection(100, 'sqrt', random_state=0)
+	asyncio.run(stream(model))
+	assert_array_equal(model.ranking, digits_sqrt_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_sqrt_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_sqrt_preemption():
+	model = FeatureBasedSelection(50, 'sqrt', optimizer='preemption')
+	for i in range(0, X_digits.shape[0], 300):
+		model.partial_fit(X_digits[i:i+300])
+
+	model2 = FeatureBasedSelection(50, 'sqrt', optimizer='preemption')
+	for i in range(0, X_digits.shape[0], 300):
+		model2.partial_fit(X_digits_sparse[i:i+300])
+
+	value = numpy.sqrt(X_digits[model.ranking].sum(axis=0)).sum()
+	greedy_value = numpy.sqrt(X_digits[digits_sqrt_ranking[:50]].sum(axis=0)).sum()
+
+	assert len(set(model.ranking)) == 50
+	assert value > 0.85 * greedy_value
+	assert_array_equal(model.ranking, model2.ranking)
+	assert_array_almost_equal(model.gains, model2.gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+	assert_array_almost_equal(model2.subset, X_digits[model.ranking])
+
 def test_digits_sqrt_sieve_batch_sparse():
 	model = FeatureBasedSelection(100, 'sqrt', random_state=0)
 	model.partial_fit(X_digits_sparse)
@@ -634,3 +818,46 @@ def test_digits_sqrt_modular_sparse():
 	assert_array_equal(model.ranking, digits_sqrt_modular_ranking)
 	assert_array_almost_equal(model.gains, digits_sqrt_modular_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits_sparse[model.ranking].toarray())
+
+# Test local search refinement
+
+def test_digits_sqrt_refine():
+	model = FeatureBasedSelection(10, 'sqrt', optimizer='lazy')
+	model.fit(X_digits[:200])
+	gains = model.gains.sum()
+
+	model.refine(X_digits[:200], max_swaps=5)
+	assert model.gains.sum() >= gains
+	assert_array_equal(numpy.unique(model.ranking).shape[0], 10)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+# Test selecting from many small data sets
+
+def test_digits_sqrt_select_many():
+	Xs = [X_digits[:50], X_digits[50:60], X_digits[60:250]]
+
+	model = FeatureBasedSelection(20, 'sqrt')
+	rankings, gains = model.select_many(Xs)
+	assert len(rankings) == 3
+	assert len(rankings[1]) == 10
+
+	for X, ranking, gain in zip(Xs, rankings, gains):
+		model = FeatureBasedSelection(min(20, X.shape[0]), 'sqrt',
+			optimizer='naive')
+		model.fit(X)
+		assert_array_equal(ranking, model.ranking)
+		assert_array_almost_equal(gain, model.gains, 4)
+
+def test_digits_sqrt_select_many_sparse():
+	Xs = [X_digits_sparse[:50], X_digits_sparse[50:60]]
+
+	model = FeatureBasedSelection(20, 'sqrt')
+	rankings, gains = model.select_many(Xs)
+	assert len(rankings[1]) == 10
+
+	for X, ranking, gain in zip(Xs, rankings, gains):
+		model = FeatureBasedSelection(min(20, X.shape[0]), 'sqrt',
+			optimizer='naive')
+		model.fit(X)
+		assert_array_equal(ranking, model.ranking)
+		assert_array_almost_equal(gain, model.gains, 4)
@@ -7,6 +7,7 @@ except:
 	import numpy as cupy
 
 from apricot import GraphCutSelection
+from apricot import SimilarityGraph
 from apricot.optimizers import NaiveGreedy, LazyGreedy, TwoStageGreedy, GreeDi, ApproximateLazyGreedy, StochasticGreedy, SampleGreedy, ModularGreedy
 
 from sklearn.datasets import load_digits
@@ -227,6 +228,46 @@ digits_cosine_modular_gains = [1125.631, 1116.4334, 1110.3619, 1107.8682,
 	889.754, 888.8964, 889.4109, 883.4413, 883.4955, 879.0293, 877.3982, 
 	887.7923, 879.2123, 867.5755, 877.9051]
 
+digits_cosine_sieve_ranking = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13,
+	14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32,
+	33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51,
+	52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70,
+	71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89,
+	90, 91, 92, 93, 94, 95, 96, 97, 98, 99]
+
+digits_cosine_sieve_gains = [0.4855, 0.5086, 0.4906, 0.4832, 0.3798, 0.5246,
+	0.5032, 0.3866, 0.5519, 0.5057, 0.5104, 0.448, 0.4235, 0.5048, 0.4851, 0.4597,
+	0.4316, 0.5318, 0.4598, 0.4045, 0.5141, 0.4619, 0.4591, 0.4535, 0.3946,
+	0.4486, 0.5124, 0.4428, 0.5109, 0.4668, 0.4562, 0.3903, 0.4994, 0.5012,
+	0.4533, 0.486, 0.5203, 0.449, 0.461, 0.5001, 0.5359, 0.4999, 0.4118, 0.4325,
+	0.4458, 0.4464, 0.4555, 0.4135, 0.4842, 0.4676, 0.4161, 0.3976, 0.4597,
+	0.4947, 0.367, 0.5228, 0.4115, 0.3813, 0.4628, 0.463, 0.4334, 0.4923, 0.4702,
+	0.4798, 0.4379, 0.4416, 0.4483, 0.3797, 0.4267, 0.4381, 0.405, 0.4398, 0.4994,
+	0.4442, 0.5125, 0.3227, 0.5209, 0.363, 0.4372, 0.4675, 0.4023, 0.4697, 0.4489,
+	0.4161, 0.4253, 0.4004, 0.4048, 0.4443, 0.4435, 0.4383, 0.3933, 0.4526,
+	0.4572, 0.4313, 0.451, 0.4576, 0.4603, 0.4157, 0.4386, 0.4358]
+
+digits_cosine_sieve_minibatch_ranking = [300, 301, 302, 303, 304, 305, 306,
+	307, 308, 309, 310, 311, 312, 313, 314, 315, 316, 317, 318, 319, 320, 321,
+	322, 323, 324, 325, 326, 327, 328, 329, 330, 331, 332, 333, 334, 335, 336,
+	337, 338, 339, 340, 341, 342, 343, 344, 345, 346, 347, 348, 349, 350, 351,
+	352, 353, 354, 355, 356, 357, 358, 359, 360, 361, 362, 363, 364, 365, 366,
+	367, 368, 369, 370, 371, 372, 373, 374, 375, 376, 377, 378, 379, 380, 381,
+	382, 383, 384, 385, 386, 387, 388, 389, 390, 391, 392, 393, 394, 395, 396,
+	397, 398, 399]
+
+digits_cosine_sieve_minibatch_gains = [0.4256, 0.5696, 0.4939, 0.4984, 0.4893,
+	0.4935, 0.436, 0.4882, 0.4571, 0.5674, 0.5149, 0.4899, 0.4188, 0.4678, 0.4455,
+	0.5247, 0.5309, 0.3662, 0.4977, 0.5254, 0.4582, 0.4333, 0.4671, 0.4155,
+	0.4318, 0.4433, 0.507, 0.4779, 0.5056, 0.4413, 0.4817, 0.5121, 0.5601, 0.4515,
+	0.4962, 0.5038, 0.4113, 0.5087, 0.4226, 0.5406, 0.4896, 0.3749, 0.4736,
+	0.4685, 0.413, 0.5084, 0.4697, 0.475, 0.4365, 0.4726, 0.4316, 0.484, 0.5511,
+	0.4428, 0.4612, 0.4523, 0.4522, 0.4693, 0.4467, 0.4511, 0.4491, 0.4318,
+	0.4275, 0.5028, 0.4221, 0.4864, 0.404, 0.4098, 0.461, 0.4195, 0.5242, 0.4126,
+	0.4319, 0.4504, 0.4189, 0.3928, 0.3835, 0.4117, 0.4937, 0.5025, 0.4516,
+	0.3761, 0.4456, 0.4896, 0.4438, 0.4328, 0.4456, 0.4134, 0.4186, 0.4704,
+	0.4171, 0.4847, 0.4953, 0.3783, 0.4951, 0.4844, 0.47, 0.49, 0.4275, 0.4723]
+
 
 # Test some similarity functions
 
@@ -286,6 +327,27 @@ def test_digits_cosine_lazy():
 	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_lazy_packed():
+	model = GraphCutSelection(100, 'cosine', optimizer='lazy',
+		packed=True, block_size=500)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_lazy_similarity_graph():
+	graph = SimilarityGraph(X_digits, metric='cosine', packed=True)
+	assert_array_almost_equal(graph.row_sums, 
+		graph.X_pairwise.sum(axis=1))
+	assert_array_almost_equal(graph.diagonal, numpy.ones(X_digits.shape[0]))
+
+	for optimizer in 'lazy', 'naive':
+		model = GraphCutSelection(100, optimizer=optimizer)
+		model.fit(graph)
+		assert_array_equal(model.ranking, digits_cosine_ranking)
+		assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+		assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
 def test_digits_cosine_two_stage():
 	model = GraphCutSelection(100, 'cosine', optimizer='two-stage')
 	model.fit(X_digits)
@@ -475,6 +537,47 @@ def test_digits_cosine_modular():
 	assert_array_almost_equal(model.gains, digits_cosine_modular_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_sieve_batch():
+	model = GraphCutSelection(100, 'cosine', random_state=0, 
+		reservoir=X_digits)
+	model.partial_fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_sieve_minibatch():
+	model = GraphCutSelection(100, 'cosine', random_state=0,
+		reservoir=X_digits)
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+	assert_array_equal(model.ranking, digits_cosine_sieve_minibatch_ranking)
+	assert_array_almost_equal(model.gains, 
+		digits_cosine_sieve_minibatch_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_sieve_minibatch_sparse():
+	model = GraphCutSelection(100, 'cosine', random_state=0,
+		reservoir=X_digits, n_neighbors=X_digits.shape[0])
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+	assert_array_equal(model.ranking, digits_cosine_sieve_minibatch_ranking)
+	assert_array_almost_equal(model.gains, 
+		digits_cosine_sieve_minibatch_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_sieve_objective():
+	model = GraphCutSelection(100, 'cosine', random_state=0,
+		reservoir=X_digits)
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:])
+
+	X_pairwise = (1 - pairwise_distances(X_digits, metric='cosine')) ** 2
+	idxs = model.ranking
+	value = (X_pairwise[:, idxs].sum() - X_pairwise[idxs][:, idxs].sum())
+	assert_almost_equal(model.gains.sum(), value / X_digits.shape[0], 4)
+
 # Using Optimizer Objects
 
 def test_digits_cosine_naive_object():
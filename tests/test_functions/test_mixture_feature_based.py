@@ -344,6 +344,17 @@ def test_digits_sqrt_sieve_minibatch():
 	assert_array_almost_equal(model.gains, digits_sieve_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_sqrt_sieve_minibatch_sparse():
+	model1 = FeatureBasedSelection(100, 'sqrt')
+	model2 = FeatureBasedSelection(100, 'log')
+	model = MixtureSelection(100, [model1, model2], [1.0, 0.3], random_state=0)
+	model.partial_fit(X_digits_sparse[:300])
+	model.partial_fit(X_digits_sparse[300:500])
+	model.partial_fit(X_digits_sparse[500:])
+	assert_array_equal(model.ranking, digits_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
 # Using Optimizer Objects
 
 def test_digits_naive_object():
@@ -9,6 +9,7 @@ except:
 from apricot import MixtureSelection
 from apricot import FacilityLocationSelection
 from apricot import GraphCutSelection
+from apricot import SimilarityGraph
 from apricot.optimizers import (
     NaiveGreedy,
     LazyGreedy,
@@ -316,6 +317,18 @@ def test_digits_cosine_lazy():
 	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_lazy_similarity_graph():
+	graph = SimilarityGraph(X_digits, metric='cosine')
+
+	model1 = FacilityLocationSelection(100)
+	model2 = GraphCutSelection(100)
+	model = MixtureSelection(100, [model1, model2], [1.0, 0.3],
+		optimizer='lazy')
+	model.fit(graph)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
 def test_digits_cosine_two_stage():
 	model1 = FacilityLocationSelection(100)
 	model2 = GraphCutSelection(100)
@@ -1,5 +1,7 @@
+import os
 import scipy
 import numpy
+import tempfile
 
 try:
 	import cupy
@@ -7,6 +9,7 @@ except:
 	import numpy as cupy
 
 from apricot import SaturatedCoverageSelection
+from apricot.utils import _calculate_pairwise_distances
 from apricot.optimizers import (
     NaiveGreedy,
     LazyGreedy,
@@ -24,6 +27,7 @@ from sklearn.metrics import pairwise_distances
 from numpy.testing import assert_almost_equal
 from numpy.testing import assert_array_equal
 from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_raises
 
 digits_data = load_digits()
 X_digits = digits_data.data
@@ -241,6 +245,47 @@ digits_cosine_modular_gains = [1126.631, 1119.2491, 1114.6764, 1114.0146,
 	1018.9646, 1018.9303, 1018.9035, 1017.9999, 1017.917, 1016.8509, 1016.8133, 
 	1016.5919, 1016.1574, 1015.4388, 1015.015, 1014.406]
 
+digits_cosine_sieve_ranking = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13,
+	14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32,
+	33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51,
+	52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70,
+	71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89,
+	90, 91, 92, 93, 94, 95, 96, 97, 98, 99]
+
+digits_cosine_sieve_gains = [0.4861, 0.5095, 0.4923, 0.4852, 0.3821, 0.5282,
+	0.5074, 0.3895, 0.5573, 0.5113, 0.5167, 0.4547, 0.4292, 0.5129, 0.4937,
+	0.4673, 0.4404, 0.5423, 0.4699, 0.4137, 0.5261, 0.4745, 0.4706, 0.4656,
+	0.4073, 0.4613, 0.5285, 0.4574, 0.5282, 0.4831, 0.4716, 0.4054, 0.5175,
+	0.5209, 0.4721, 0.5068, 0.5426, 0.4691, 0.4813, 0.5231, 0.5621, 0.5249,
+	0.4348, 0.455, 0.4688, 0.4711, 0.482, 0.4394, 0.5108, 0.4945, 0.4401, 0.4231,
+	0.4889, 0.5268, 0.3929, 0.5581, 0.4428, 0.4107, 0.4943, 0.4963, 0.4652,
+	0.5291, 0.5072, 0.5187, 0.4732, 0.4754, 0.4844, 0.4093, 0.4625, 0.4733,
+	0.4435, 0.4767, 0.5431, 0.4839, 0.5596, 0.3562, 0.5679, 0.4015, 0.477, 0.512,
+	0.4464, 0.5171, 0.4957, 0.4603, 0.4676, 0.4476, 0.4495, 0.4924, 0.4935,
+	0.4882, 0.444, 0.5057, 0.51, 0.4853, 0.5032, 0.5141, 0.5161, 0.4712, 0.4945,
+	0.4928]
+
+digits_cosine_sieve_minibatch_ranking = [300, 301, 302, 303, 304, 305, 306,
+	307, 308, 309, 310, 311, 312, 313, 314, 315, 316, 317, 318, 319, 320, 321,
+	322, 323, 324, 325, 326, 327, 328, 329, 330, 331, 332, 333, 334, 335, 336,
+	337, 338, 339, 340, 341, 342, 343, 344, 345, 346, 347, 348, 349, 350, 351,
+	352, 353, 354, 355, 356, 357, 358, 359, 360, 361, 362, 363, 364, 365, 366,
+	367, 368, 369, 370, 371, 372, 373, 374, 375, 376, 377, 378, 379, 380, 381,
+	382, 383, 384, 385, 386, 387, 388, 389, 390, 391, 392, 393, 394, 395, 396,
+	397, 398, 399]
+
+digits_cosine_sieve_minibatch_gains = [0.4262, 0.5707, 0.4956, 0.5005, 0.4915,
+	0.4968, 0.4394, 0.493, 0.4617, 0.5736, 0.5219, 0.497, 0.4247, 0.4762, 0.4534,
+	0.5347, 0.5417, 0.374, 0.5095, 0.5388, 0.4675, 0.4439, 0.4797, 0.4276, 0.4437,
+	0.4554, 0.5221, 0.4927, 0.5219, 0.4561, 0.4989, 0.5319, 0.5816, 0.4709,
+	0.5164, 0.5252, 0.4286, 0.5314, 0.4425, 0.5665, 0.5155, 0.3939, 0.4981,
+	0.4917, 0.4362, 0.5363, 0.4963, 0.5031, 0.4611, 0.501, 0.4596, 0.5152, 0.5857,
+	0.47, 0.4929, 0.4833, 0.4825, 0.5007, 0.477, 0.4846, 0.4835, 0.4637, 0.4617,
+	0.5427, 0.457, 0.5249, 0.437, 0.444, 0.501, 0.4574, 0.5696, 0.4517, 0.4735,
+	0.4908, 0.4582, 0.427, 0.4211, 0.452, 0.5425, 0.552, 0.4957, 0.4113, 0.4898,
+	0.542, 0.4906, 0.4789, 0.492, 0.4552, 0.466, 0.5223, 0.4627, 0.5394, 0.5535,
+	0.4223, 0.5539, 0.5405, 0.526, 0.5489, 0.4806, 0.5327]
+
 # Test some similarity functions
 
 def test_digits_euclidean_naive():
@@ -299,6 +344,84 @@ def test_digits_cosine_lazy():
 	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_lazy_packed():
+	model = SaturatedCoverageSelection(100, 'cosine', optimizer='lazy',
+		packed=True, block_size=500)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_lazy_ground():
+	X_candidates = X_digits[::4]
+	X_pairwise = (1 - pairwise_distances(X_candidates, X_digits, 
+		metric='cosine')) ** 2
+	max_values = 0.1 * X_pairwise.sum(axis=0)
+
+	model = SaturatedCoverageSelection(50, 'cosine', optimizer='lazy')
+	model.fit(X_candidates, ground=X_digits)
+	assert_almost_equal(model.gains.sum(), numpy.minimum(
+		X_pairwise[model.ranking].sum(axis=0), max_values).sum(), 4)
+	assert_array_almost_equal(model.subset, X_candidates[model.ranking])
+
+	model2 = SaturatedCoverageSelection(50, 'cosine', optimizer='lazy',
+		block_size=100)
+	model2.fit(X_candidates, ground=X_digits)
+	assert_array_equal(model2.ranking, model.ranking)
+	assert_array_almost_equal(model2.gains, model.gains, 4)
+
+def test_digits_cosine_lazy_ground_sparse():
+	X_candidates = X_digits[::4]
+	X_pairwise = _calculate_pairwise_distances(X_candidates, Y=X_digits,
+		metric='cosine', n_neighbors=10)
+	max_values = 0.1 * numpy.asarray(X_pairwise.sum(axis=0)).ravel()
+
+	model = SaturatedCoverageSelection(50, 'cosine', optimizer='lazy', 
+		n_neighbors=10)
+	model.fit(X_candidates, ground=X_digits)
+	assert_almost_equal(model.gains.sum(), numpy.minimum(numpy.asarray(
+		X_pairwise[model.ranking].sum(axis=0)).ravel(), max_values).sum(), 4)
+
+def test_digits_cosine_lazy_memmap():
+	X_pairwise = _calculate_pairwise_distances(X_digits, metric='cosine')
+
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'digits.npy')
+		numpy.save(path, X_pairwise)
+
+		model = SaturatedCoverageSelection(100, 'precomputed', optimizer='lazy',
+			block_size=300)
+		model.fit(numpy.load(path, mmap_mode='r'))
+
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+
+def test_digits_cosine_naive_row_blocks():
+	X_pairwise = _calculate_pairwise_distances(X_digits, metric='cosine')
+
+	with tempfile.TemporaryDirectory() as directory:
+		for i, start in enumerate(range(0, X_pairwise.shape[0], 500)):
+			path = os.path.join(directory, 'block{}.npy'.format(i))
+			numpy.save(path, X_pairwise[start:start+500])
+
+		model = SaturatedCoverageSelection(100, 'precomputed', optimizer='naive')
+		model.fit(directory)
+
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+
+def test_digits_cosine_row_blocks_raises():
+	with tempfile.TemporaryDirectory() as directory:
+		path = os.path.join(directory, 'digits.npy')
+		numpy.save(path, X_digits)
+
+		model = SaturatedCoverageSelection(100, 'cosine')
+		assert_raises(ValueError, model.fit, path)
+
+		model = SaturatedCoverageSelection(100, 'precomputed')
+		assert_raises(ValueError, model.fit, os.path.join(directory, 
+			'digits.csv'))
+
 def test_digits_cosine_two_stage():
 	model = SaturatedCoverageSelection(100, 'cosine', optimizer='two-stage')
 	model.fit(X_digits)
@@ -491,26 +614,32 @@ def test_digits_sqrt_modular():
 # Using the partial_fit method
 
 def test_digits_cosine_sieve_batch():
-	return
-	# model = SaturatedCoverageSelection(100, 'cosine', random_state=0, 
-	# 	reservoir=X_digits)
-	# model.partial_fit(X_digits)
-	# print("[" + ", ".join(map(str, model.ranking)) + "]")
-	# print("[" + ", ".join([str(round(gain, 4)) for gain in model.gains]) + "]")
-	# assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
-	# assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
-	# assert_array_almost_equal(model.subset, X_digits[model.ranking])
+	model = SaturatedCoverageSelection(100, 'cosine', random_state=0, 
+		reservoir=X_digits)
+	model.partial_fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
 def test_digits_cosine_sieve_minibatch():
-	return
-	# model = SaturatedCoverageSelection(100, 'cosine', random_state=0,
-	# 	reservoir=X_digits)
-	# model.partial_fit(X_digits[:300])
-	# model.partial_fit(X_digits[300:500])
-	# model.partial_fit(X_digits[500:])
-	# assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
-	# assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
-	# assert_array_almost_equal(model.subset, X_digits[model.ranking])
+	model = SaturatedCoverageSelection(100, 'cosine', random_state=0,
+		reservoir=X_digits)
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+	assert_array_equal(model.ranking, digits_cosine_sieve_minibatch_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_minibatch_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_sieve_minibatch_sparse():
+	model = SaturatedCoverageSelection(100, 'cosine', random_state=0,
+		reservoir=X_digits, n_neighbors=X_digits.shape[0])
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+	assert_array_equal(model.ranking, digits_cosine_sieve_minibatch_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_minibatch_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
 # Using Optimizer Objects
 
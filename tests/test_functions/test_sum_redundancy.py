@@ -198,6 +198,25 @@ digits_cosine_modular_gains = [-1.0, -1.5389, -3.0365, -3.5809, -4.1258, -6.3708
 	-79.2383, -85.0744, -84.2064, -79.5252, -75.8808, -84.791, -80.2349, -86.4289, -89.9171, -89.6284,
 	-91.0734, -95.421, -94.9176, -97.0423, -93.7396, -101.5086, -100.2028, -99.8039, -100.3847, -102.4461]
 
+digits_cosine_sieve_ranking = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13,
+	14, 15, 16, 17, 18, 19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32,
+	33, 34, 35, 36, 37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51,
+	52, 53, 54, 55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 70,
+	71, 72, 73, 74, 75, 76, 77, 78, 79, 80, 81, 82, 83, 84, 85, 86, 87, 88, 89,
+	90, 91, 92, 93, 94, 95, 96, 97, 98, 99]
+
+digits_cosine_sieve_gains = [0.1102, 0.1099, 0.1091, 0.1087, 0.1084, 0.1072,
+	0.1066, 0.1078, 0.1053, 0.1051, 0.1045, 0.1041, 0.105, 0.1027, 0.1022, 0.1032,
+	0.102, 0.1003, 0.1006, 0.1015, 0.0988, 0.0981, 0.0993, 0.0986, 0.0981, 0.0981,
+	0.0947, 0.0961, 0.0934, 0.0944, 0.0954, 0.0956, 0.0927, 0.091, 0.0919, 0.0899,
+	0.0884, 0.0906, 0.0904, 0.0878, 0.0846, 0.0858, 0.0878, 0.0882, 0.0878,
+	0.0861, 0.0842, 0.0848, 0.0842, 0.0838, 0.0868, 0.0853, 0.0815, 0.0786,
+	0.0848, 0.0755, 0.0794, 0.0813, 0.0792, 0.0774, 0.079, 0.0739, 0.0738, 0.0719,
+	0.0755, 0.0769, 0.0746, 0.0811, 0.0749, 0.0756, 0.0722, 0.0739, 0.067, 0.071,
+	0.0636, 0.0773, 0.0638, 0.0722, 0.0709, 0.0663, 0.0666, 0.0634, 0.0639,
+	0.0665, 0.0685, 0.0636, 0.0661, 0.0626, 0.0607, 0.0609, 0.0601, 0.0576,
+	0.0579, 0.0567, 0.0586, 0.0543, 0.055, 0.0552, 0.0549, 0.0537]
+
 # Test some similarity functions
 
 def test_digits_euclidean_naive():
@@ -256,6 +275,14 @@ def test_digits_cosine_lazy():
 	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
 	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
+def test_digits_cosine_lazy_packed():
+	model = SumRedundancySelection(100, 'cosine', optimizer='lazy',
+		packed=True, block_size=500)
+	model.fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
 def test_digits_cosine_two_stage():
 	model = SumRedundancySelection(100, 'cosine', optimizer='two-stage')
 	model.fit(X_digits)
@@ -448,26 +475,32 @@ def test_digits_sqrt_modular():
 # Using the partial_fit method
 
 def test_digits_cosine_sieve_batch():
-	return
-	# model = SumRedundancySelection(100, 'cosine', random_state=0, 
-	# 	reservoir=X_digits)
-	# model.partial_fit(X_digits)
-	# print("[" + ", ".join(map(str, model.ranking)) + "]")
-	# print("[" + ", ".join([str(round(gain, 4)) for gain in model.gains]) + "]")
-	# assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
-	# assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
-	# assert_array_almost_equal(model.subset, X_digits[model.ranking])
+	model = SumRedundancySelection(100, 'cosine', random_state=0, 
+		reservoir=X_digits)
+	model.partial_fit(X_digits)
+	assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
 def test_digits_cosine_sieve_minibatch():
-	return
-	# model = SumRedundancySelection(100, 'cosine', random_state=0, 
-	# 	reservoir=X_digits)
-	# model.partial_fit(X_digits[:300])
-	# model.partial_fit(X_digits[300:500])
-	# model.partial_fit(X_digits[500:])
-	# assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
-	# assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
-	# assert_array_almost_equal(model.subset, X_digits[model.ranking])
+	model = SumRedundancySelection(100, 'cosine', random_state=0,
+		reservoir=X_digits)
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+	assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
+
+def test_digits_cosine_sieve_minibatch_sparse():
+	model = SumRedundancySelection(100, 'cosine', random_state=0,
+		reservoir=X_digits, n_neighbors=X_digits.shape[0])
+	model.partial_fit(X_digits[:300])
+	model.partial_fit(X_digits[300:500])
+	model.partial_fit(X_digits[500:])
+	assert_array_equal(model.ranking, digits_cosine_sieve_ranking)
+	assert_array_almost_equal(model.gains, digits_cosine_sieve_gains, 4)
+	assert_array_almost_equal(model.subset, X_digits[model.ranking])
 
 # Using Optimizer Objects
 